@@ -0,0 +1,133 @@
+import numpy as np
+
+
+SEKUND_NA_DOBE = 86400
+
+
+class KolumnyKursow:
+    """Historia kursów jako kolumny NumPy, po jednej pozycji na kurs.
+
+    Czas to sekundy od 1970-01-01 liczone z zapisanego czasu lokalnego (bez
+    strefy), więc godzina i dzień tygodnia wynikają wprost z dzielenia
+    całkowitego. Platforma jest zakodowana indeksem w liście platformy.
+    """
+
+    def __init__(self, kursy):
+        kursy = kursy if isinstance(kursy, list) else list(kursy)
+        liczba = len(kursy)
+        self.daty = [k.data_czas for k in kursy]
+        self.czas = np.array(self.daty, dtype='datetime64[s]').astype(np.int64)
+        self.zysk = np.fromiter((k.zysk for k in kursy), dtype=np.float64, count=liczba)
+        self.stawka = np.fromiter((k.stawka for k in kursy), dtype=np.float64, count=liczba)
+        self.kwota = np.fromiter((k.kwota for k in kursy), dtype=np.float64, count=liczba)
+        self.km = np.fromiter((k.dystans_dojazdu + k.dystans_kursu for k in kursy), dtype=np.float64, count=liczba)
+        self.czas_h = np.fromiter((k.czas_dojazdu + k.czas_kursu for k in kursy), dtype=np.float64, count=liczba) / 60
+        kody = {}
+        self.platforma = np.fromiter((kody.setdefault(k.platforma or 'Nieznana', len(kody)) for k in kursy),
+                                     dtype=np.int32, count=liczba)
+        self.platformy = list(kody)
+
+    def __len__(self):
+        return len(self.czas)
+
+    def rozmiar(self):
+        """Przybliżony rozmiar w bajtach (tablice i teksty dat)."""
+        tablice = (self.czas, self.zysk, self.stawka, self.kwota, self.km, self.czas_h, self.platforma)
+        return sum(t.nbytes for t in tablice) + len(self.daty) * 80
+
+    @property
+    def godzina(self):
+        return (self.czas % SEKUND_NA_DOBE) // 3600
+
+    @property
+    def dzien_tygodnia(self):
+        """Dzień tygodnia (0 = poniedziałek); 1970-01-01 był czwartkiem."""
+        return (self.czas // SEKUND_NA_DOBE + 3) % 7
+
+    def zakres(self, od=None, do=None):
+        """Maska kursów z zakresu [od, do) (RRRR-MM-DD lub RRRR-MM-DD GG:MM:SS)."""
+        maska = np.ones(len(self), dtype=bool)
+        if od is not None:
+            maska &= self.czas >= np.datetime64(od, 's').astype(np.int64)
+        if do is not None:
+            maska &= self.czas < np.datetime64(do, 's').astype(np.int64)
+        return maska
+
+    def po_godzinach(self):
+        """Godziny z kursami oraz liczba kursów, suma stawek i suma zysków w każdej z nich."""
+        godzina = self.godzina
+        liczba = np.bincount(godzina, minlength=24)
+        suma_stawek = np.bincount(godzina, weights=self.stawka, minlength=24)
+        suma_zyskow = np.bincount(godzina, weights=self.zysk, minlength=24)
+        godziny = np.flatnonzero(liczba)
+        return godziny, liczba[godziny], suma_stawek[godziny], suma_zyskow[godziny]
+
+    def po_platformach(self):
+        """Lista (platforma, liczba kursów, suma stawek, suma zysków) w kolejności pierwszego dnia z kursem."""
+        ile = len(self.platformy)
+        liczba = np.bincount(self.platforma, minlength=ile)
+        suma_stawek = np.bincount(self.platforma, weights=self.stawka, minlength=ile)
+        suma_zyskow = np.bincount(self.platforma, weights=self.zysk, minlength=ile)
+        pierwszy_dzien = np.full(ile, np.iinfo(np.int64).max)
+        np.minimum.at(pierwszy_dzien, self.platforma, self.czas // SEKUND_NA_DOBE)
+        kolejnosc = sorted(range(ile), key=lambda kod: (pierwszy_dzien[kod], self.platformy[kod]))
+        return [(self.platformy[kod], int(liczba[kod]), float(suma_stawek[kod]), float(suma_zyskow[kod]))
+                for kod in kolejnosc]
+
+    def po_dniach_tygodnia_i_godzinach(self):
+        """Tablice 7 × 24 (dzień tygodnia, godzina): liczba kursów i suma zysków."""
+        slot = self.dzien_tygodnia * 24 + self.godzina
+        liczba = np.bincount(slot, minlength=7 * 24).reshape(7, 24)
+        suma_zyskow = np.bincount(slot, weights=self.zysk, minlength=7 * 24).reshape(7, 24)
+        return liczba, suma_zyskow
+
+
+def siatka_scenariuszy(kwota, dystans, czas_h, ceny_paliwa, spalania, procenty, min_stawka):
+    """Zysk i stawka godzinowa historii kursów dla każdego scenariusza (cena paliwa × spalanie × procent).
+
+    Dla kursu i scenariusza zysk = kwota * procent/100 - dystans * koszt_km,
+    gdzie koszt_km = cena_paliwa * spalanie / 100, a stawka = zysk / czas
+    (0 dla kursu bez czasu), tak jak w kalkulatorze. Zysk jest liniowy w
+    procencie i koszcie kilometra, więc sumy po kursach są iloczynem
+    zewnętrznym sum kolumn z osiami siatki (broadcast), bez macierzy
+    kursy × scenariusze. Liczba kursów ze stawką >= min_stawka to dla
+    ustalonego procentu próg na koszt_km, liczony przez sortowanie i
+    searchsorted.
+
+    Zwraca słownik tablic o kształcie (ceny, spalania, procenty).
+    """
+    ceny_paliwa = np.asarray(ceny_paliwa, dtype=np.float64)
+    spalania = np.asarray(spalania, dtype=np.float64)
+    udzialy = np.asarray(procenty, dtype=np.float64) / 100
+    koszt_km = np.multiply.outer(ceny_paliwa, spalania) / 100
+    liczba = len(kwota)
+
+    ma_czas = czas_h > 0
+    kwota_na_h = np.divide(kwota, czas_h, out=np.zeros_like(kwota), where=ma_czas)
+    dystans_na_h = np.divide(dystans, czas_h, out=np.zeros_like(dystans), where=ma_czas)
+
+    suma_zysku = udzialy * kwota.sum() - koszt_km[:, :, None] * dystans.sum()
+    suma_stawek = udzialy * kwota_na_h.sum() - koszt_km[:, :, None] * dystans_na_h.sum()
+
+    # Kurs z czasem spełnia próg, gdy kwota*udzial - min_stawka*czas >= dystans*koszt_km
+    oplacalne = np.zeros(koszt_km.shape + udzialy.shape, dtype=np.int64)
+    bez_czasu_oplacalne = int(np.count_nonzero(~ma_czas)) if min_stawka <= 0 else 0
+    kwota_c, dystans_c, czas_c = kwota[ma_czas], dystans[ma_czas], czas_h[ma_czas]
+    jazda = dystans_c > 0
+    for indeks, udzial in enumerate(udzialy):
+        zapas = kwota_c * udzial - min_stawka * czas_c
+        stale = np.count_nonzero(zapas[~jazda] >= 0)
+        progi = np.sort(zapas[jazda] / dystans_c[jazda])
+        ponizej = np.searchsorted(progi, koszt_km, side='left')
+        oplacalne[:, :, indeks] = len(progi) - ponizej + stale + bez_czasu_oplacalne
+
+    if liczba == 0:
+        zerowe = np.zeros_like(suma_zysku)
+        return {"suma_zysku": zerowe, "sredni_zysk": zerowe, "srednia_stawka": zerowe,
+                "procent_oplacalnych": zerowe}
+    return {
+        "suma_zysku": suma_zysku,
+        "sredni_zysk": suma_zysku / liczba,
+        "srednia_stawka": suma_stawek / liczba,
+        "procent_oplacalnych": oplacalne * 100.0 / liczba,
+    }
@@ -1,14 +1,23 @@
-from flask import Flask, render_template, request, jsonify, redirect, url_for, flash
+from flask import Flask, Response, render_template, request, jsonify, redirect, url_for, flash, g, send_file, stream_with_context
 from flask_login import LoginManager, login_user, logout_user, login_required, current_user
 from werkzeug.middleware.proxy_fix import ProxyFix
 from urllib.parse import urlparse, urljoin
 import datetime
+import fcntl
+import functools
+import hashlib
+import itertools
+import json
+import operator
 import os
-import smtplib
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from database import db, User, get_user_folder, init_db
+import shutil
+from database import db, User, Ride, RideRollup, RideBatch, ReportSnapshot, AiJob, EmailOutbox, RateLimitBucket, DataVersion, get_user_folder, init_db, importuj_plik_kursow
 from forms import LoginForm, RegistrationForm
+from kursy import Kurs, CacheKursow, czytaj_plik_kursow, podsumuj_historie
+from pamiec import CacheLRU, CacheTTL, JednoWywolanie
+import asystent
+import limity
+import poczta
 
 app = Flask(__name__)
 app.secret_key = os.environ.get("SESSION_SECRET")
@@ -30,6 +39,57 @@ app.config["SQLALCHEMY_ENGINE_OPTIONS"] = {
     }
 }
 
+# Magazyn historii kursów: "plik" (user_data/*/kursy.txt) lub "baza" (tabela rides)
+app.config["RIDES_STORAGE"] = os.environ.get("RIDES_STORAGE", "plik")
+# Limit pamięci na sparsowane historie kursów (w MB, wspólny dla wszystkich użytkowników)
+app.config["RIDES_CACHE_BYTES"] = int(os.environ.get("RIDES_CACHE_MB", 64)) * 1024 * 1024
+# Limit pamięci na gotowe odpowiedzi JSON ze statystykami (w MB, na worker)
+app.config["RESPONSE_CACHE_BYTES"] = int(os.environ.get("RESPONSE_CACHE_MB", 32)) * 1024 * 1024
+# Limit pamięci na historie kursów w kolumnach NumPy do statystyk (w MB, na worker)
+app.config["COLUMNS_CACHE_BYTES"] = int(os.environ.get("COLUMNS_CACHE_MB", 32)) * 1024 * 1024
+# Analizy AI: model ("openrouter" albo lokalny "stub" do testów bez sieci, z opóźnieniem
+# AI_STUB_DELAY sekund), liczba analiz wykonywanych naraz i czekających w kolejce (na worker)
+app.config["AI_BACKEND"] = os.environ.get("AI_BACKEND", "openrouter")
+# Adres API zgodnego z OpenAI (np. lokalna atrapa z atrapa_ai.py w testach)
+app.config["OPENROUTER_BASE_URL"] = os.environ.get("OPENROUTER_BASE_URL", asystent.OPENROUTER_BASE_URL).rstrip("/")
+# Klient API: połączenia keep-alive w puli, liczba prób (ponawiane 429/5xx), limity czasu
+# połączenia i odczytu (s), oraz bezpiecznik: awarie z rzędu i przerwa po nich (s)
+app.config["AI_POOL_SIZE"] = int(os.environ.get("AI_POOL_SIZE", 10))
+app.config["AI_RETRIES"] = int(os.environ.get("AI_RETRIES", 3))
+app.config["AI_CONNECT_TIMEOUT"] = float(os.environ.get("AI_CONNECT_TIMEOUT", 5))
+app.config["AI_READ_TIMEOUT"] = float(os.environ.get("AI_READ_TIMEOUT", 60))
+app.config["AI_BREAKER_FAILURES"] = int(os.environ.get("AI_BREAKER_FAILURES", 5))
+app.config["AI_BREAKER_COOLDOWN"] = float(os.environ.get("AI_BREAKER_COOLDOWN", 30))
+app.config["AI_STUB_DELAY"] = float(os.environ.get("AI_STUB_DELAY", 2))
+app.config["AI_CONCURRENCY"] = int(os.environ.get("AI_CONCURRENCY", 4))
+app.config["AI_QUEUE_LIMIT"] = int(os.environ.get("AI_QUEUE_LIMIT", 16))
+# Cache gotowych analiz AI: liczba wpisów na worker i ważność w sekundach
+app.config["AI_CACHE_SIZE"] = int(os.environ.get("AI_CACHE_SIZE", 256))
+app.config["AI_CACHE_TTL"] = int(os.environ.get("AI_CACHE_TTL", 3600))
+
+# Poczta: serwer SMTP (STARTTLS wyłącza SMTP_STARTTLS=0, logowanie tylko z SMTP_USER i SMTP_PASSWORD,
+# np. lokalny serwer testowy z atrapa_smtp.py) i co ile sekund wysyłka sprawdza zaległe wiadomości
+app.config["SMTP_SERVER"] = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
+app.config["SMTP_PORT"] = int(os.environ.get('SMTP_PORT', 587))
+app.config["SMTP_USER"] = os.environ.get('SMTP_USER')
+app.config["SMTP_PASSWORD"] = os.environ.get('SMTP_PASSWORD')
+app.config["SMTP_STARTTLS"] = os.environ.get('SMTP_STARTTLS', '1') != '0'
+app.config["SMTP_FROM"] = os.environ.get('SMTP_FROM') or app.config["SMTP_USER"] or 'taxi-calculator@localhost'
+app.config["EMAIL_OUTBOX_INTERVAL"] = float(os.environ.get('EMAIL_OUTBOX_INTERVAL', 30))
+
+# Zalogowani użytkownicy zapamiętani w workerze (liczba i czas ważności w sekundach)
+app.config["USER_CACHE_SIZE"] = int(os.environ.get("USER_CACHE_SIZE", 4096))
+app.config["USER_CACHE_TTL"] = int(os.environ.get("USER_CACHE_TTL", 60))
+
+# Limit prób logowania, rejestracji i ponownej wysyłki emaila: kubełki tokenów na adres IP
+# (wspólny dla tych akcji) i na email (osobno dla każdej akcji) - pojemność i tokeny na minutę.
+# RATE_LIMIT_BACKEND=baza trzyma kubełki w bazie, wspólne dla wszystkich workerów
+app.config["RATE_LIMIT_BACKEND"] = os.environ.get("RATE_LIMIT_BACKEND", "pamiec")
+app.config["RATE_LIMIT_IP_BURST"] = int(os.environ.get("RATE_LIMIT_IP_BURST", 10))
+app.config["RATE_LIMIT_IP_PER_MINUTE"] = float(os.environ.get("RATE_LIMIT_IP_PER_MINUTE", 10))
+app.config["RATE_LIMIT_EMAIL_BURST"] = int(os.environ.get("RATE_LIMIT_EMAIL_BURST", 5))
+app.config["RATE_LIMIT_EMAIL_PER_MINUTE"] = float(os.environ.get("RATE_LIMIT_EMAIL_PER_MINUTE", 1))
+
 # Konfiguracja Flask-Login
 login_manager = LoginManager()
 login_manager.init_app(app)
@@ -40,9 +100,42 @@ login_manager.login_message_category = 'info'
 # Inicjalizacja bazy danych
 init_db(app)
 
+cache_kursow = CacheKursow(app.config["RIDES_CACHE_BYTES"])
+cache_odpowiedzi = CacheLRU(app.config["RESPONSE_CACHE_BYTES"])
+cache_kolumn = CacheLRU(app.config["COLUMNS_CACHE_BYTES"])
+kolejka_analiz = asystent.KolejkaAnaliz(app.config["AI_CONCURRENCY"], app.config["AI_QUEUE_LIMIT"])
+klient_ai = asystent.KlientOpenRouter(
+    app.config["OPENROUTER_BASE_URL"], rozmiar_puli=app.config["AI_POOL_SIZE"], proby=app.config["AI_RETRIES"],
+    timeout=(app.config["AI_CONNECT_TIMEOUT"], app.config["AI_READ_TIMEOUT"]),
+    prog_bledow=app.config["AI_BREAKER_FAILURES"], przerwa=app.config["AI_BREAKER_COOLDOWN"])
+cache_analiz = CacheTTL(app.config["AI_CACHE_SIZE"], app.config["AI_CACHE_TTL"])
+analizy_w_toku = JednoWywolanie()
+cache_uzytkownikow = CacheTTL(app.config["USER_CACHE_SIZE"], app.config["USER_CACHE_TTL"])
+kubelki_limitu = limity.PamiecKubelkow()
+ogranicznik_prob = limity.Ogranicznik(
+    {"ip": (app.config["RATE_LIMIT_IP_BURST"], app.config["RATE_LIMIT_IP_PER_MINUTE"]),
+     "email": (app.config["RATE_LIMIT_EMAIL_BURST"], app.config["RATE_LIMIT_EMAIL_PER_MINUTE"])},
+    RateLimitBucket.take if app.config["RATE_LIMIT_BACKEND"] == "baza" else kubelki_limitu.pobierz)
+polaczenie_smtp = poczta.PolaczenieSmtp(
+    app.config["SMTP_SERVER"], app.config["SMTP_PORT"], app.config["SMTP_USER"], app.config["SMTP_PASSWORD"],
+    starttls=app.config["SMTP_STARTTLS"])
+# Liczba wiadomości wysyłanych jednym połączeniem w jednej porcji
+ROZMIAR_PORCJI_POCZTY = 20
+# Zadanie bez wyniku po tym czasie uznajemy za przerwane (np. restart workera)
+AI_JOB_TIMEOUT = datetime.timedelta(minutes=5)
+# Użytkownicy, dla których w tym procesie potwierdzono kompletne agregaty kursów
+_rollupy_gotowe = set()
+
 @login_manager.user_loader
 def load_user(user_id):
-    return User.get_by_id(user_id)
+    """Użytkownik sesji (UserIdentity) z cache_uzytkownikow; baza tylko przy chybieniu"""
+    user_id = int(user_id)
+    user = cache_uzytkownikow.pobierz(user_id)
+    if user is None:
+        user = User.get_identity(user_id)
+        if user is not None:
+            cache_uzytkownikow.zapisz(user_id, user)
+    return user
 
 def is_safe_url(target):
     """Validate that a redirect URL is safe (relative path only)"""
@@ -52,25 +145,29 @@ def is_safe_url(target):
     test_url = urlparse(urljoin(request.host_url, target))
     return test_url.scheme in ('http', 'https') and ref_url.netloc == test_url.netloc
 
+def limit_prob(akcja, email):
+    """Zabiera próbę akcji z limitu adresu IP klienta i emaila; zwraca 0 albo sekundy do ponownej próby"""
+    return ogranicznik_prob.sprawdz(akcja, ip=request.remote_addr, email=(email or '').strip().lower())
+
+def odmowa_limitu(czekaj, szablon, **kontekst):
+    """Odpowiedź 429 z Retry-After dla przekroczonego limitu prób"""
+    sekundy = int(czekaj) + 1
+    flash(f'Zbyt wiele prób. Spróbuj ponownie za {sekundy} s.', 'error')
+    return render_template(szablon, **kontekst), 429, {'Retry-After': str(sekundy)}
+
 def wyslij_email_weryfikacyjny(email, token):
-    """Wysyła email z linkiem weryfikacyjnym"""
+    """Dodaje email z linkiem weryfikacyjnym do kolejki wysyłki (email_outbox).
+    
+    Wysyła go wątek wysylka_poczty, więc żądanie nie czeka na serwer SMTP.
+    Zwraca False, gdy poczta nie jest skonfigurowana.
+    """
+    if app.config["SMTP_STARTTLS"] and not (app.config["SMTP_USER"] and app.config["SMTP_PASSWORD"]):
+        print("SMTP credentials not configured")
+        return False
+    
     try:
-        smtp_server = os.environ.get('SMTP_SERVER', 'smtp.gmail.com')
-        smtp_port = int(os.environ.get('SMTP_PORT', 587))
-        smtp_user = os.environ.get('SMTP_USER')
-        smtp_password = os.environ.get('SMTP_PASSWORD')
-        
-        if not smtp_user or not smtp_password:
-            print("SMTP credentials not configured")
-            return False
-        
         link_weryfikacyjny = url_for('verify_email', token=token, _external=True)
         
-        msg = MIMEMultipart('alternative')
-        msg['Subject'] = 'Potwierdź swój adres email - Taxi Calculator'
-        msg['From'] = smtp_user
-        msg['To'] = email
-        
         text = f"""
 Witaj!
 
@@ -123,21 +220,54 @@ Zespół Taxi Calculator
 </html>
         """
         
-        part1 = MIMEText(text, 'plain')
-        part2 = MIMEText(html, 'html')
-        
-        msg.attach(part1)
-        msg.attach(part2)
-        
-        with smtplib.SMTP(smtp_server, smtp_port) as server:
-            server.starttls()
-            server.login(smtp_user, smtp_password)
-            server.send_message(msg)
-        
-        return True
+        EmailOutbox.add(email, 'Potwierdź swój adres email - Taxi Calculator', text, html)
     except Exception as e:
-        print(f"Error sending email: {str(e)}")
+        print(f"Error queueing email: {str(e)}")
         return False
+    
+    wysylka_poczty.obudz()
+    return True
+
+def wyslij_zalegle_emaile():
+    """Wysyła zaległe wiadomości z email_outbox porcjami przez jedno połączenie SMTP.
+    
+    Nieudana wiadomość wraca do kolejki z rosnącą przerwą (poczta.opoznienie_proby),
+    a po poczta.MAKS_PROB próbach albo trwałym błędzie serwera (kod 5xx) zostaje
+    oznaczona jako failed. Błąd połączenia przerywa porcję do następnej próby.
+    """
+    with app.app_context():
+        while True:
+            wiadomosci = EmailOutbox.claim(ROZMIAR_PORCJI_POCZTY)
+            if not wiadomosci:
+                break
+            for numer, w in enumerate(wiadomosci):
+                try:
+                    polaczenie_smtp.wyslij(poczta.wiadomosc(app.config["SMTP_FROM"], w.recipient, w.subject,
+                                                            w.body_text, w.body_html))
+                except Exception as e:
+                    print(f"Error sending email {w.id}: {str(e)}")
+                    rodzaj = poczta.rodzaj_bledu(e)
+                    proba = w.attempts + 1
+                    ponowienie = datetime.datetime.utcnow() + datetime.timedelta(seconds=poczta.opoznienie_proby(proba))
+                    koniec_prob = rodzaj == 'odrzucona' or proba >= poczta.MAKS_PROB
+                    EmailOutbox.failed(w.id, str(e), None if koniec_prob else ponowienie)
+                    if rodzaj == 'polaczenie':
+                        # Serwer niedostępny - reszta porcji wraca do kolejki na ten sam termin
+                        polaczenie_smtp.zamknij()
+                        for pozostala in wiadomosci[numer + 1:]:
+                            EmailOutbox.release(pozostala.id, ponowienie)
+                        return
+                else:
+                    EmailOutbox.sent(w.id)
+        polaczenie_smtp.zamknij_bezczynne()
+
+wysylka_poczty = poczta.WatekWysylki(wyslij_zalegle_emaile, app.config["EMAIL_OUTBOX_INTERVAL"])
+
+@app.before_request
+def uruchom_wysylke_poczty():
+    # Pierwsze żądanie workera (po restarcie lub wdrożeniu) startuje wysyłkę, więc
+    # zaległe i czekające na ponowienie wiadomości nie czekają na nową rejestrację
+    wysylka_poczty.uruchom()
 
 def get_user_file(filename):
     """Zwraca ścieżkę do pliku użytkownika"""
@@ -146,18 +276,211 @@ def get_user_file(filename):
     user_folder = get_user_folder(current_user.id)
     return f'{user_folder}/{filename}'
 
-def zapisz_do_pliku(dane):
+def kursy_w_bazie():
+    """Czy historia kursów jest przechowywana w tabeli rides."""
+    return app.config["RIDES_STORAGE"] == "baza"
+
+def zakres_dnia(dzien=None):
+    """Zwraca granice (od, do) dnia w formacie RRRR-MM-DD."""
+    dzien = dzien or datetime.date.today()
+    return dzien.isoformat(), (dzien + datetime.timedelta(days=1)).isoformat()
+
+def zakres_miesiaca(miesiac):
+    """Zwraca granice (od, do) miesiąca podanego jako RRRR-MM."""
+    poczatek = datetime.datetime.strptime(miesiac, '%Y-%m').date()
+    koniec = (poczatek + datetime.timedelta(days=32)).replace(day=1)
+    return poczatek.isoformat(), koniec.isoformat()
+
+def wczytaj_kursy(od=None, do=None):
+    """Kursy zalogowanego użytkownika w kolejności chronologicznej.
+    
+    Opcjonalne granice od/do (RRRR-MM-DD lub RRRR-MM-DD GG:MM:SS) zawężają
+    wynik do zakresu [od, do); w bazie korzystają z indeksu (user_id, timestamp),
+    a dla pliku z bisekcji w posortowanym indeksie czasów, więc koszt zależy
+    od długości okresu, nie całej historii.
+    Historia z pliku jest parsowana raz i trzymana w cache_kursow do jego zmiany.
+    """
+    if kursy_w_bazie():
+        return Ride.iter_for_user(current_user.id, od, do)
+    
+    # Plik jest w kolejności zapisu, więc chronologię daje indeks czasów także bez granic
+    return cache_kursow.zakres(current_user.id, get_user_file('kursy.txt'), od, do)
+
+def odpowiedz_wersjonowana(widok):
+    """Dekorator widoku JSON: gotowe bajty odpowiedzi w cache i silny ETag.
+    
+    Klucz cache to (użytkownik, ścieżka, parametry, wersja danych, dzień).
+    Wersja danych rośnie przy każdym zapisie kursu lub celów, a dzień
+    unieważnia wyniki zależne od daty (prognoza, bieżący miesiąc). ETag to
+    skrót treści, więc jest taki sam we wszystkich workerach; zgodny
+    If-None-Match daje 304 bez liczenia statystyk.
+    """
+    @functools.wraps(widok)
+    def opakowanie(*args, **kwargs):
+        klucz = (current_user.id, request.path, tuple(sorted(request.args.items(multi=True))),
+                 DataVersion.get(current_user.id), datetime.date.today())
+        wpis = cache_odpowiedzi.pobierz(klucz)
+        if wpis is None:
+            odpowiedz = app.make_response(widok(*args, **kwargs))
+            if odpowiedz.status_code != 200:
+                return odpowiedz
+            tresc = odpowiedz.get_data()
+            wpis = (tresc, hashlib.sha1(tresc).hexdigest())
+            cache_odpowiedzi.zapisz(klucz, wpis, len(tresc))
+        
+        tresc, etag = wpis
+        odpowiedz = app.response_class(tresc, mimetype='application/json')
+        odpowiedz.set_etag(etag)
+        odpowiedz.headers['Cache-Control'] = 'private, no-cache'
+        return odpowiedz.make_conditional(request)
+    return opakowanie
+
+def wykres_odpowiedzi(typ, *dane):
+    """Wykres pełny albo, przy ?wykresy=kompakt, same kolumny danych z identyfikatorem."""
+    from wykresy import wykres, wykres_kompaktowy
+    if request.args.get('wykresy') == 'kompakt':
+        return wykres_kompaktowy(typ, *dane)
+    return wykres(typ, *dane)
+
+def kursy_z_zakresu(od, do):
+    """Lista kursów z zakresu [od, do), wczytywana raz na żądanie.
+    
+    Sekcje panelu liczone w jednym żądaniu (np. raport i kilometry za bieżący
+    miesiąc) korzystają z tej samej listy zamiast czytać kursy ponownie.
+    """
+    zakresy = g.setdefault('kursy_z_zakresu', {})
+    if (od, do) not in zakresy:
+        zakresy[(od, do)] = list(wczytaj_kursy(od, do))
+    return zakresy[(od, do)]
+
+def kolumny_historii():
+    """Cała historia kursów jako kolumny NumPy (analityka.KolumnyKursow).
+    
+    Kolumny są budowane raz na wersję danych użytkownika i trzymane
+    w cache_kolumn; statystyki liczą z nich grupowania bez pętli po kursach.
+    """
+    from analityka import KolumnyKursow
+    klucz = (current_user.id, DataVersion.get(current_user.id))
+    kolumny = cache_kolumn.pobierz(klucz)
+    if kolumny is None:
+        kolumny = KolumnyKursow(wczytaj_kursy())
+        cache_kolumn.zapisz(klucz, kolumny, kolumny.rozmiar())
+    return kolumny
+
+def podsumowanie_historii():
+    """Zwraca sumy z całej historii kursów (liczba, kwoty, zyski, stawki, km, paliwo)."""
+    if kursy_w_bazie():
+        return Ride.totals(current_user.id)
+    return podsumuj_historie(get_user_file('kursy.txt'), get_user_file('kursy.stan.json'))
+
+def podsumowanie_platform():
+    """Zwraca listę (platforma, liczba kursów, suma stawek, suma zysków)."""
+    zapewnij_rollupy()
+    return RideRollup.by_platform(current_user.id)
+
+def zapewnij_rollupy():
+    """Przelicza agregaty kursów użytkownika, jeśli nie obejmują jeszcze całej historii."""
+    user_id = current_user.id
+    if user_id in _rollupy_gotowe:
+        return
+    if not RideRollup.is_built(user_id):
+        RideRollup.rebuild(user_id, wczytaj_kursy)
+    _rollupy_gotowe.add(user_id)
+
+def zapisz_kurs(kurs):
+    """Zapisuje kurs razem z agregatami i zwraca podsumowanie dnia."""
+    zapisz_kursy([kurs])
+    return wczytaj_podsumowanie_dnia()
+
+def zapisz_kursy(kursy, paczka=None):
+    """Zapisuje kursy jednym dopisaniem do pliku (lub jedną transakcją) i jedną aktualizacją agregatów.
+    
+    Z identyfikatorem paczki (kolejka offline) paczka jest rezerwowana w ride_batches
+    w tej samej transakcji co kursy (w bazie) lub agregaty (przy pliku), więc ta sama
+    paczka wysłana równolegle jest zapisana raz. Zwraca False, gdy paczka była już zapisana.
+    """
+    zapewnij_rollupy()
+    if kursy_w_bazie():
+        if not Ride.add(current_user.id, kursy, batch_id=paczka):
+            return False
+    else:
+        # Rezerwacja paczki jest zatwierdzana razem z agregatami dopiero po dopisaniu
+        # kursów do pliku, więc worker przerwany przed zapisem nie zostawia paczki
+        # oznaczonej jako zapisana (ponowna wysyłka zapisze kursy)
+        if paczka is not None and not RideBatch.claim(current_user.id, paczka, len(kursy), commit=False):
+            return False
+        # Dopisanie i doliczenie agregatów pod blokadą użytkownika, żeby przeliczanie
+        # agregatów z pliku w innym workerze nie policzyło tych kursów drugi raz
+        RideRollup.lock(current_user.id)
+        try:
+            zapisz_do_pliku(kursy)
+        except Exception:
+            db.session.rollback()
+            raise
+        RideRollup.add(current_user.id, kursy)
+    # Kursy z zamkniętych miesięcy - gotowe eksporty tych miesięcy są nieaktualne.
+    # Usuwane przed podbiciem wersji, żeby nowa wersja nigdy nie szła ze starym eksportem
+    biezacy = datetime.date.today().strftime('%Y-%m')
+    for miesiac in {kurs.data_czas[:7] for kurs in kursy if kurs.data_czas[:7] < biezacy}:
+        usun_segmenty_eksportu(current_user.id, miesiac)
+    # Kursy z zakończonych dni - migawki raportów obejmujących te dni są nieaktualne
+    # i znikają w tej samej transakcji, która podbija wersję
+    dzisiaj = datetime.date.today().isoformat()
+    dni = sorted(kurs.data for kurs in kursy if kurs.data < dzisiaj)
+    DataVersion.bump(current_user.id, snapshots=(datetime.date.fromisoformat(dni[0]),
+                                                 datetime.date.fromisoformat(dni[-1])) if dni else None)
+    return True
+
+def folder_segmentow(user_id):
+    """Folder z gotowymi eksportami zamkniętych miesięcy."""
+    return f'{get_user_folder(user_id)}/eksport'
+
+def usun_segmenty_eksportu(user_id, miesiac=None):
+    """Usuwa gotowe eksporty miesiąca RRRR-MM albo wszystkie."""
+    if miesiac is None:
+        shutil.rmtree(folder_segmentow(user_id), ignore_errors=True)
+        return
+    for format in ('csv', 'ndjson'):
+        try:
+            os.remove(f'{folder_segmentow(user_id)}/{miesiac}.{format}')
+        except FileNotFoundError:
+            pass
+
+def zapisz_do_pliku(kursy):
+    """Dopisuje kursy na końcu pliku jednym zapisem.
+    
+    Plik kursów jest tylko dopisywany; blokada na pliku serializuje zapisy
+    tego samego użytkownika z różnych workerów.
+    """
+    tekst = ""
+    for kurs in kursy:
+        tekst += f"\n[{kurs.data_czas}]\n"
+        for klucz, wartosc in kurs.pola_tekstowe().items():
+            tekst += f"{klucz}: {wartosc}\n"
+        tekst += "-" * 40 + "\n"
+    
     try:
         plik_path = get_user_file('kursy.txt')
         with open(plik_path, "a", encoding="utf-8") as plik:
-            plik.write(f"\n[{datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S')}]\n")
-            for klucz, wartosc in dane.items():
-                plik.write(f"{klucz}: {wartosc}\n")
-            plik.write("-" * 40 + "\n")
+            fcntl.flock(plik, fcntl.LOCK_EX)
+            plik.write(tekst)
     except Exception as e:
         print(f"Błąd zapisu do pliku: {e}")
         raise
 
+def wczytaj_podsumowanie_dnia():
+    """Zwraca bieżące sumy dnia: liczbę kursów, sumę zysków i sumę stawek."""
+    zapewnij_rollupy()
+    dzisiaj = datetime.date.today()
+    liczba, suma_zysku, suma_stawek = RideRollup.day_totals(current_user.id, dzisiaj)
+    return {"data": dzisiaj.isoformat(), "liczba": liczba, "suma_zysku": suma_zysku, "suma_stawek": suma_stawek}
+
+def srednia_stawka_dnia(podsumowanie):
+    """Średnia stawka godzinowa z podsumowania dnia lub None bez kursów."""
+    if podsumowanie["liczba"]:
+        return podsumowanie["suma_stawek"] / podsumowanie["liczba"]
+    return None
+
 def wczytaj_cele():
     """Wczytuje cele użytkownika z pliku."""
     try:
@@ -179,30 +502,17 @@ def zapisz_cele(cele):
     with open(plik_path, "w", encoding="utf-8") as plik:
         for klucz, wartosc in cele.items():
             plik.write(f"{klucz}:{wartosc}\n")
+    DataVersion.bump(current_user.id)
 
-def oblicz_postep_celu():
+def oblicz_postep_celu(cele=None, podsumowanie=None):
     """Oblicza postęp do dziennego celu."""
-    dzisiaj = datetime.datetime.now().strftime("%Y-%m-%d")
-    cele = wczytaj_cele()
+    if cele is None:
+        cele = wczytaj_cele()
+    if podsumowanie is None:
+        podsumowanie = wczytaj_podsumowanie_dnia()
     cel_dzienny = float(cele.get("cel_dzienny", 300))
     
-    try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return {"postep": 0, "cel": cel_dzienny, "procent": 0, "pozostalo": cel_dzienny}
-    
-    suma_zysku = 0
-    dzien = None
-    
-    for linia in linie:
-        if linia.startswith("["):
-            data = linia[1:11]
-            dzien = data
-        elif "Zysk netto:" in linia and dzien == dzisiaj:
-            wartosc = float(linia.strip().split(":")[1].replace("zł", "").strip())
-            suma_zysku += wartosc
+    suma_zysku = podsumowanie["suma_zysku"]
     
     procent = min((suma_zysku / cel_dzienny) * 100, 100) if cel_dzienny > 0 else 0
     pozostalo = max(cel_dzienny - suma_zysku, 0)
@@ -214,97 +524,84 @@ def oblicz_postep_celu():
         "pozostalo": pozostalo
     }
 
-def aktualizuj_srednia_dnia():
-    """Aktualizuje średnią stawkę godzinową dla dzisiejszego dnia."""
-    try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return None
-
-    dzisiaj = datetime.datetime.now().strftime("%Y-%m-%d")
-    stawki = []
-    nowe_linie = []
-    dzien = None
-
-    for linia in linie:
-        if linia.startswith("📊 Podsumowanie dnia") and dzisiaj in linia:
-            continue
-        nowe_linie.append(linia)
-        if linia.startswith("["):
-            data = linia[1:11]
-            dzien = data
-        elif "Stawka godzinowa:" in linia and dzien == dzisiaj:
-            wartosc = float(linia.strip().split(":")[1].replace("zł/h", "").strip())
-            stawki.append(wartosc)
-
-    if stawki:
-        srednia = sum(stawki) / len(stawki)
-        nowe_linie.append(f"\n📊 Podsumowanie dnia {dzisiaj} - średnia stawka godzinowa: {srednia:.2f} zł/h\n")
-        nowe_linie.append("=" * 40 + "\n")
-
-        with open(plik_path, "w", encoding="utf-8") as plik:
-            plik.writelines(nowe_linie)
-        return srednia
+def filtry_historii(parametry):
+    """Filtry historii z parametrów zapytania; błędna wartość zgłasza ValueError.
+    
+    od/do to daty RRRR-MM-DD (obie włącznie), platnosc to gotowka lub karta.
+    """
+    filtry = {}
+    if parametry.get('od'):
+        filtry['od'] = datetime.date.fromisoformat(parametry['od']).isoformat()
+    if parametry.get('do'):
+        filtry['do'] = (datetime.date.fromisoformat(parametry['do']) + datetime.timedelta(days=1)).isoformat()
+    if parametry.get('platforma'):
+        filtry['platforma'] = parametry['platforma']
+    if parametry.get('platnosc'):
+        if parametry['platnosc'] not in ('gotowka', 'karta'):
+            raise ValueError(parametry['platnosc'])
+        filtry['gotowka'] = parametry['platnosc'] == 'gotowka'
+    if parametry.get('min_zysk'):
+        filtry['min_zysk'] = float(parametry['min_zysk'])
+    if parametry.get('max_zysk'):
+        filtry['max_zysk'] = float(parametry['max_zysk'])
+    return filtry
+
+def pasuje_do_filtrow(kurs, filtry):
+    """Czy kurs spełnia filtry z filtry_historii()."""
+    return (('od' not in filtry or kurs.data_czas >= filtry['od'])
+            and ('do' not in filtry or kurs.data_czas < filtry['do'])
+            and ('platforma' not in filtry or (kurs.platforma or 'Nieznana') == filtry['platforma'])
+            and ('gotowka' not in filtry or kurs.gotowka == filtry['gotowka'])
+            and ('min_zysk' not in filtry or kurs.zysk >= filtry['min_zysk'])
+            and ('max_zysk' not in filtry or kurs.zysk <= filtry['max_zysk']))
+
+def strona_historii(filtry, limit, kursor=None):
+    """Do limit kursów od najnowszych, starszych niż kursor (data_czas, pozycja).
+    
+    Pozycja to id wiersza w bazie albo numer kursu w pliku, więc kursy z tą
+    samą sekundą mają stałą kolejność. Zwraca listę par (pozycja, kurs).
+    """
+    if kursy_w_bazie():
+        return Ride.page_for_user(
+            current_user.id, limit, before=kursor, od=filtry.get('od'), do=filtry.get('do'),
+            platform=filtry.get('platforma'), cash=filtry.get('gotowka'),
+            min_profit=filtry.get('min_zysk'), max_profit=filtry.get('max_zysk'))
+    
+    # Z pliku: od kursora wstecz po posortowanym indeksie czasów, aż strona się zapełni
+    kursy = cache_kursow.od_najnowszych(current_user.id, get_user_file('kursy.txt'),
+                                        filtry.get('od'), filtry.get('do'), kursor)
+    return list(itertools.islice(((pozycja, kurs) for pozycja, kurs in kursy if pasuje_do_filtrow(kurs, filtry)), limit))
+
+# Wymagane pola formularza kalkulatora (liczby)
+POLA_KURSU = ['dystans_dojazdu', 'czas_dojazdu', 'dystans_kursu', 'czas_kursu',
+              'kwota', 'procent_dla_kierowcy', 'spalanie', 'cena_paliwa']
+
+def blad_danych_kursu(dane):
+    """Komunikat błędu dla niepełnych lub nieliczbowych danych kursu, None gdy są poprawne."""
+    if not isinstance(dane, dict):
+        return "Nieprawidłowe dane kursu"
+    brakujace = [pole for pole in POLA_KURSU if pole not in dane]
+    if brakujace:
+        return f"Brakujące pola: {', '.join(brakujace)}"
+    for pole in POLA_KURSU:
+        try:
+            float(dane[pole])
+        except (ValueError, TypeError):
+            return f"Pole {pole} musi być liczbą"
     return None
 
-def wczytaj_historie_kursow():
-    """Wczytuje pełną historię kursów z pliku."""
-    try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return []
-    
-    kursy = []
-    kurs = {}
-    data_czas = None
-    
-    for linia in linie:
-        linia = linia.strip()
-        
-        # Pomijaj linie podsumowań i separatorów
-        if linia.startswith("📊") or linia.startswith("=") or not linia:
-            continue
-            
-        # Znacznik czasu
-        if linia.startswith("[") and linia.endswith("]"):
-            # Zapisz poprzedni kurs jeśli istnieje
-            if kurs and data_czas:
-                kurs['data_czas'] = data_czas
-                kursy.append(kurs)
-            # Rozpocznij nowy kurs
-            data_czas = linia[1:-1]
-            kurs = {}
-        # Separator między kursami
-        elif linia.startswith("-"):
-            if kurs and data_czas:
-                kurs['data_czas'] = data_czas
-                kursy.append(kurs)
-                kurs = {}
-                data_czas = None
-        # Parsuj dane kursu
-        elif ":" in linia and linia.count(":") >= 1:
-            parts = linia.split(":", 1)
-            if len(parts) == 2:
-                klucz = parts[0].strip()
-                wartosc = parts[1].strip()
-                if klucz:  # Tylko jeśli klucz nie jest pusty
-                    kurs[klucz] = wartosc
-    
-    # Dodaj ostatni kurs jeśli istnieje
-    if kurs and data_czas:
-        kurs['data_czas'] = data_czas
-        kursy.append(kurs)
-    
-    # Odwróć listę, aby najnowsze kursy były pierwsze
-    kursy.reverse()
-    
-    return kursy
-
-def oblicz_oplacalnosc(dane):
+def ocen_stawke(stawka_godzinowa):
+    """Ocena kursu i klasa alertu dla stawki godzinowej."""
+    if stawka_godzinowa >= 50:
+        return "💰 Kurs bardzo opłacalny!", "success"
+    if stawka_godzinowa >= 30:
+        return "👍 Kurs opłacalny.", "info"
+    if stawka_godzinowa >= 20:
+        return "😐 Kurs średnio opłacalny.", "warning"
+    return "❌ Kurs nieopłacalny.", "danger"
+
+def policz_kurs(dane, data_czas):
+    """Liczy kurs z danych formularza (bez zapisu)."""
     dystans_dojazdu = float(dane['dystans_dojazdu'])
     czas_dojazdu = float(dane['czas_dojazdu'])
     dystans_kursu = float(dane['dystans_kursu'])
@@ -313,50 +610,53 @@ def oblicz_oplacalnosc(dane):
     procent_dla_kierowcy = float(dane['procent_dla_kierowcy'])
     spalanie = float(dane['spalanie'])
     cena_paliwa = float(dane['cena_paliwa'])
-    platforma = dane.get('platforma', 'Nieznana')
-    platnosc_gotowka = dane.get('platnosc_gotowka', 'nie')
 
     dystans_calkowity = dystans_dojazdu + dystans_kursu
     czas_calkowity_h = (czas_dojazdu + czas_kursu) / 60
     koszt_paliwa = (dystans_calkowity * spalanie / 100) * cena_paliwa
-    zarobek_dla_kierowcy = kwota * (procent_dla_kierowcy / 100)
-    zysk_netto = zarobek_dla_kierowcy - koszt_paliwa
+    zysk_netto = kwota * (procent_dla_kierowcy / 100) - koszt_paliwa
     stawka_godzinowa = zysk_netto / czas_calkowity_h if czas_calkowity_h > 0 else 0
 
-    if stawka_godzinowa >= 50:
-        ocena = "💰 Kurs bardzo opłacalny!"
-        ocena_klasa = "success"
-    elif stawka_godzinowa >= 30:
-        ocena = "👍 Kurs opłacalny."
-        ocena_klasa = "info"
-    elif stawka_godzinowa >= 20:
-        ocena = "😐 Kurs średnio opłacalny."
-        ocena_klasa = "warning"
-    else:
-        ocena = "❌ Kurs nieopłacalny."
-        ocena_klasa = "danger"
-
-    dane_do_zapisu = {
-        "Platforma": platforma,
-        "Dystans dojazdu (km)": f"{dystans_dojazdu:.2f}",
-        "Czas dojazdu (min)": f"{czas_dojazdu:.0f}",
-        "Dystans z klientem (km)": f"{dystans_kursu:.2f}",
-        "Czas kursu (min)": f"{czas_kursu:.0f}",
-        "Kwota (z napiwkiem)": f"{kwota:.2f} zł",
-        "Procent dla kierowcy": f"{procent_dla_kierowcy:.0f}%",
-        "Koszt paliwa": f"{koszt_paliwa:.2f} zł",
-        "Zysk netto": f"{zysk_netto:.2f} zł",
-        "Stawka godzinowa": f"{stawka_godzinowa:.2f} zł/h",
-        "Płatność gotówką": platnosc_gotowka,
-        "Ocena": ocena
+    return Kurs(
+        data_czas,
+        platforma=dane.get('platforma', 'Nieznana'),
+        dystans_dojazdu=dystans_dojazdu,
+        czas_dojazdu=czas_dojazdu,
+        dystans_kursu=dystans_kursu,
+        czas_kursu=czas_kursu,
+        kwota=kwota,
+        procent=procent_dla_kierowcy,
+        koszt_paliwa=koszt_paliwa,
+        zysk=zysk_netto,
+        stawka=stawka_godzinowa,
+        gotowka=dane.get('platnosc_gotowka', 'nie') == 'tak',
+        ocena=ocen_stawke(stawka_godzinowa)[0]
+    )
+
+def wycena_kursu(kurs):
+    """Wyniki kalkulatora dla policzonego kursu (same obliczenia, bez odczytu i zapisu danych)."""
+    ocena, ocena_klasa = ocen_stawke(kurs.stawka)
+    return {
+        "dystans_calkowity": f"{kurs.dystans:.2f}",
+        "czas_calkowity_h": f"{(kurs.czas_dojazdu + kurs.czas_kursu) / 60:.2f}",
+        "koszt_paliwa": f"{kurs.koszt_paliwa:.2f}",
+        "zarobek_dla_kierowcy": f"{kurs.kwota * (kurs.procent / 100):.2f}",
+        "zysk_netto": f"{kurs.zysk:.2f}",
+        "stawka_godzinowa": f"{kurs.stawka:.2f}",
+        "ocena": ocena,
+        "ocena_klasa": ocena_klasa
     }
 
-    zapisz_do_pliku(dane_do_zapisu)
-    srednia_dnia = aktualizuj_srednia_dnia()
+def oblicz_oplacalnosc(dane):
+    kurs = policz_kurs(dane, datetime.datetime.now().strftime('%Y-%m-%d %H:%M:%S'))
+    stawka_godzinowa = kurs.stawka
+
+    podsumowanie = zapisz_kurs(kurs)
+    srednia_dnia = srednia_stawka_dnia(podsumowanie)
     
     cele = wczytaj_cele()
     min_stawka = float(cele.get("min_stawka", 30))
-    postep = oblicz_postep_celu()
+    postep = oblicz_postep_celu(cele, podsumowanie)
     
     powiadomienia = []
     
@@ -377,19 +677,13 @@ def oblicz_oplacalnosc(dane):
             "tekst": f"💪 Blisko celu! Pozostało tylko {postep['pozostalo']:.2f} zł do dziennego celu."
         })
 
-    return {
-        "dystans_calkowity": f"{dystans_calkowity:.2f}",
-        "czas_calkowity_h": f"{czas_calkowity_h:.2f}",
-        "koszt_paliwa": f"{koszt_paliwa:.2f}",
-        "zarobek_dla_kierowcy": f"{zarobek_dla_kierowcy:.2f}",
-        "zysk_netto": f"{zysk_netto:.2f}",
-        "stawka_godzinowa": f"{stawka_godzinowa:.2f}",
-        "ocena": ocena,
-        "ocena_klasa": ocena_klasa,
+    wynik = wycena_kursu(kurs)
+    wynik.update({
         "srednia_dnia": f"{srednia_dnia:.2f}" if srednia_dnia else "Brak danych",
         "postep": postep,
         "powiadomienia": powiadomienia
-    }
+    })
+    return wynik
 
 # Routes autentykacji
 @app.route('/login', methods=['GET', 'POST'])
@@ -399,6 +693,11 @@ def login():
     
     form = LoginForm()
     if form.validate_on_submit():
+        # Limit sprawdzany przed check_password_hash, więc odrzucona próba nie liczy PBKDF2
+        czekaj = limit_prob('login', form.email.data)
+        if czekaj:
+            return odmowa_limitu(czekaj, 'login.html', form=form, show_resend=False)
+        
         user = User.verify_password(form.email.data, form.password.data)
         
         if user:
@@ -407,7 +706,8 @@ def login():
                 flash('⚠️ Musisz najpierw potwierdzić swój adres email. Sprawdź swoją skrzynkę pocztową (także folder SPAM).', 'warning')
                 return render_template('login.html', form=form, show_resend=True)
             
-            # Email zweryfikowany - zaloguj użytkownika
+            # Email zweryfikowany - zaloguj użytkownika (kolejne żądania wczytają świeże dane)
+            cache_uzytkownikow.usun(user.id)
             login_user(user)
             flash('Zalogowano pomyślnie!', 'success')
             next_page = request.args.get('next')
@@ -426,6 +726,10 @@ def register():
     
     form = RegistrationForm()
     if form.validate_on_submit():
+        czekaj = limit_prob('register', form.email.data)
+        if czekaj:
+            return odmowa_limitu(czekaj, 'register.html', form=form)
+        
         user = User.create(form.email.data, form.password.data)
         if user:
             # Wysyłanie emaila weryfikacyjnego
@@ -453,6 +757,7 @@ def verify_email(token):
         return redirect(url_for('login'))
     
     if User.verify_email(token):
+        cache_uzytkownikow.usun(user.id)
         flash('Email został pomyślnie zweryfikowany! Możesz się teraz zalogować.', 'success')
     else:
         flash('Wystąpił błąd podczas weryfikacji emaila.', 'error')
@@ -463,6 +768,10 @@ def verify_email(token):
 def resend_verification():
     """Ponownie wysyła email weryfikacyjny"""
     email = request.form.get('email')
+    czekaj = limit_prob('resend', email)
+    if czekaj:
+        return odmowa_limitu(czekaj, 'login.html', form=LoginForm(), show_resend=True)
+    
     user = User.get_by_email(email)
     
     if not user:
@@ -483,6 +792,7 @@ def resend_verification():
 @app.route('/logout')
 @login_required
 def logout():
+    cache_uzytkownikow.usun(current_user.id)
     logout_user()
     flash('Wylogowano pomyślnie.', 'success')
     return redirect(url_for('login'))
@@ -496,7 +806,27 @@ def index():
 @app.route('/static/service-worker.js')
 def service_worker():
     from flask import send_from_directory
-    return send_from_directory('static', 'service-worker.js', mimetype='application/javascript')
+    odpowiedz = send_from_directory('static', 'service-worker.js', mimetype='application/javascript')
+    # Worker z /static/ obsługuje całą aplikację (strony i POST /oblicz w kolejce offline)
+    odpowiedz.headers['Service-Worker-Allowed'] = '/'
+    return odpowiedz
+
+@app.route('/wykresy/uklady.js')
+def uklady_wykresow():
+    """Style i układy wykresów dla odpowiedzi kompaktowych (?wykresy=kompakt)."""
+    from wykresy import uklady_json, wersja_ukladow
+    odpowiedz = app.response_class(f"const UKLADY_WYKRESOW = {uklady_json()};\n", mimetype='application/javascript')
+    if request.args.get('v') == wersja_ukladow():
+        # Adres z wersją zmienia się razem z treścią, więc można go trzymać na stałe
+        odpowiedz.headers['Cache-Control'] = 'public, max-age=31536000, immutable'
+    return odpowiedz
+
+@app.context_processor
+def adres_ukladow():
+    def adres_ukladow_wykresow():
+        from wykresy import wersja_ukladow
+        return url_for('uklady_wykresow', v=wersja_ukladow())
+    return {"adres_ukladow_wykresow": adres_ukladow_wykresow}
 
 @app.route('/ads.txt')
 def ads_txt():
@@ -508,24 +838,94 @@ def ads_txt():
 def oblicz():
     dane = request.json
     
-    # Walidacja wymaganych pól
-    wymagane_pola = ['dystans_dojazdu', 'czas_dojazdu', 'dystans_kursu', 'czas_kursu', 
-                     'kwota', 'procent_dla_kierowcy', 'spalanie', 'cena_paliwa']
-    
-    brakujace = [pole for pole in wymagane_pola if pole not in dane]
-    if brakujace:
-        return jsonify({"error": f"Brakujące pola: {', '.join(brakujace)}"}), 400
-    
-    # Walidacja czy wartości są liczbami
-    try:
-        for pole in wymagane_pola:
-            float(dane[pole])
-    except (ValueError, TypeError):
-        return jsonify({"error": f"Pole {pole} musi być liczbą"}), 400
+    blad = blad_danych_kursu(dane)
+    if blad:
+        return jsonify({"error": blad}), 400
     
     wynik = oblicz_oplacalnosc(dane)
     return jsonify(wynik)
 
+@app.route('/oblicz/quote', methods=['POST'])
+@login_required
+def oblicz_quote():
+    """Szacunek opłacalności kursu na żywo, bez zapisu.
+    
+    Same obliczenia z /oblicz, bez plików i bazy (wynik zależy tylko od
+    przesłanych danych). Kurs zapisuje dopiero /oblicz. Jak kalkulator, który
+    ją wywołuje, wymaga zalogowania - nie jest otwartym API do liczenia.
+    """
+    dane = request.get_json(silent=True)
+    blad = blad_danych_kursu(dane)
+    if blad:
+        return jsonify({"error": blad}), 400
+    return jsonify(wycena_kursu(policz_kurs(dane, None)))
+
+# Największa paczka kursów z kolejki offline przyjmowana w jednym żądaniu
+MAKS_PACZKA_KURSOW = 500
+
+def czas_kursu_z_urzadzenia(wartosc):
+    """Czas kursu zapisany przez urządzenie (RRRR-MM-DD GG:MM:SS, czas lokalny).
+    
+    Czas ze strefą jest przeliczany na czas lokalny serwera; czas z przyszłości
+    (poza kilkoma minutami różnicy zegarów) zgłasza ValueError.
+    """
+    czas = datetime.datetime.fromisoformat(wartosc).replace(microsecond=0)
+    if czas.tzinfo is not None:
+        czas = czas.astimezone().replace(tzinfo=None)
+    if czas > datetime.datetime.now() + datetime.timedelta(minutes=5):
+        raise ValueError(wartosc)
+    return czas.strftime('%Y-%m-%d %H:%M:%S')
+
+@app.route('/oblicz/batch', methods=['POST'])
+@login_required
+def oblicz_batch():
+    """Zapisuje kursy z kolejki offline service workera.
+    
+    Body: {"paczka": identyfikator, "uzytkownik": id kierowcy, który zapisał kursy,
+    "kursy": [dane formularza + data_czas z urządzenia]}. Paczka innego kierowcy
+    (wspólny telefon) dostaje 409 z id zalogowanego, bez zapisu. Wszystkie poprawne kursy są zapisywane jednym dopisaniem do pliku (lub jedną
+    transakcją) i jedną aktualizacją agregatów. Błędne kursy są pomijane i zwracane
+    w "odrzucone"; ponownie wysłana paczka nie jest zapisywana drugi raz.
+    """
+    dane = request.get_json(silent=True)
+    if not isinstance(dane, dict) or not isinstance(dane.get('kursy'), list):
+        return jsonify({"error": "Brak listy kursów"}), 400
+    if len(dane['kursy']) > MAKS_PACZKA_KURSOW:
+        return jsonify({"error": f"Najwyżej {MAKS_PACZKA_KURSOW} kursów w paczce"}), 400
+    paczka = str(dane.get('paczka') or '')[:64]
+    if dane.get('uzytkownik') is not None and str(dane['uzytkownik']) != str(current_user.id):
+        return jsonify({"error": "Kursy innego użytkownika", "uzytkownik": current_user.id}), 409
+    
+    if paczka:
+        zapisana = RideBatch.get(current_user.id, paczka)
+        if zapisana is not None:
+            return jsonify({"zapisane": zapisana.rides, "odrzucone": [], "powtorzona": True})
+    
+    kursy = []
+    odrzucone = []
+    for indeks, dane_kursu in enumerate(dane['kursy']):
+        blad = blad_danych_kursu(dane_kursu)
+        if blad is None:
+            try:
+                data_czas = czas_kursu_z_urzadzenia(str(dane_kursu.get('data_czas')))
+            except ValueError:
+                blad = "Nieprawidłowy czas kursu"
+        if blad:
+            odrzucone.append({"indeks": indeks, "error": blad})
+            continue
+        kursy.append(policz_kurs(dane_kursu, data_czas))
+    
+    if kursy:
+        kursy.sort(key=operator.attrgetter('data_czas'))
+        zapisana = zapisz_kursy(kursy, paczka or None)
+    else:
+        zapisana = not paczka or RideBatch.claim(current_user.id, paczka, 0)
+    if not zapisana:
+        # Tę samą paczkę zapisało w międzyczasie inne żądanie
+        poprzednia = RideBatch.get(current_user.id, paczka)
+        return jsonify({"zapisane": poprzednia.rides if poprzednia else 0, "odrzucone": [], "powtorzona": True})
+    return jsonify({"zapisane": len(kursy), "odrzucone": odrzucone, "powtorzona": False})
+
 @app.route('/statystyki')
 @login_required
 def statystyki():
@@ -548,9 +948,43 @@ def historia():
 
 @app.route('/api/historia')
 @login_required
+@odpowiedz_wersjonowana
 def api_historia():
-    kursy = wczytaj_historie_kursow()
-    return jsonify(kursy)
+    """Strona historii kursów od najnowszych, z filtrami i kursorem.
+    
+    Parametry: od, do, platforma, platnosc, min_zysk, max_zysk (filtry),
+    limit (domyślnie 50, najwyżej 200) i kursor z poprzedniej odpowiedzi.
+    """
+    try:
+        filtry = filtry_historii(request.args)
+        limit = min(max(int(request.args.get('limit', 50)), 1), 200)
+        kursor = None
+        if request.args.get('kursor'):
+            data_czas, _, pozycja = request.args['kursor'].rpartition('|')
+            datetime.datetime.fromisoformat(data_czas)
+            kursor = (data_czas, int(pozycja))
+    except ValueError:
+        return jsonify({"error": "Nieprawidłowe parametry"}), 400
+    
+    strona = strona_historii(filtry, limit + 1, kursor)
+    nastepny_kursor = None
+    if len(strona) > limit:
+        strona = strona[:limit]
+        pozycja, kurs = strona[-1]
+        nastepny_kursor = f"{kurs.data_czas}|{pozycja}"
+    
+    wynik = {"kursy": [kurs.jako_slownik() for _, kurs in strona], "nastepny_kursor": nastepny_kursor}
+    if kursor is None:
+        wynik["liczba_wszystkich"] = podsumowanie_historii()["liczba"]
+    return jsonify(wynik)
+
+@app.route('/api/historia/platformy')
+@login_required
+@odpowiedz_wersjonowana
+def api_historia_platformy():
+    """Platformy z liczbą kursów do filtra historii."""
+    platformy = sorted((platforma, liczba) for platforma, liczba, _, _ in podsumowanie_platform())
+    return jsonify({"platformy": [{"nazwa": platforma, "liczba": liczba} for platforma, liczba in platformy]})
 
 @app.route('/cele', methods=['GET', 'POST'])
 @login_required
@@ -561,267 +995,100 @@ def cele():
         return jsonify({"sukces": True})
     else:
         cele = wczytaj_cele()
-        postep = oblicz_postep_celu()
+        postep = oblicz_postep_celu(cele)
         return jsonify({"cele": cele, "postep": postep})
 
 @app.route('/srednia_dnia')
 @login_required
 def srednia_dnia():
     """Endpoint do pobierania średniej stawki godzinowej z dzisiaj."""
-    dzisiaj = datetime.datetime.now().strftime("%Y-%m-%d")
-    
-    try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return jsonify({"srednia_dnia": "Brak danych"})
+    srednia = srednia_stawka_dnia(wczytaj_podsumowanie_dnia())
     
-    stawki = []
-    dzien = None
-    
-    for linia in linie:
-        if linia.startswith("["):
-            data = linia[1:11]
-            dzien = data
-        elif "Stawka godzinowa:" in linia and dzien == dzisiaj:
-            wartosc = float(linia.strip().split(":")[1].replace("zł/h", "").strip())
-            stawki.append(wartosc)
-    
-    if stawki:
-        srednia = sum(stawki) / len(stawki)
+    if srednia is not None:
         return jsonify({"srednia_dnia": f"{srednia:.2f}"})
     else:
         return jsonify({"srednia_dnia": "Brak danych"})
 
-@app.route('/dane_statystyk')
-@login_required
-def dane_statystyk():
-    import plotly.graph_objects as go
-    import plotly.utils
-    import json
+def sekcja_statystyki():
+    """Wykresy i statystyki ze wszystkich kursów użytkownika."""
     
-    try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return jsonify({"error": "Brak danych"})
+    kursy = kolumny_historii()
     
-    kursy = []
-    kurs = {}
-    
-    for linia in linie:
-        if linia.startswith("["):
-            if kurs:
-                kursy.append(kurs)
-            kurs = {"data": linia[1:20]}
-        elif "Stawka godzinowa:" in linia:
-            kurs["stawka"] = float(linia.strip().split(":")[1].replace("zł/h", "").strip())
-        elif "Zysk netto:" in linia:
-            kurs["zysk"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-        elif "Kwota (z napiwkiem):" in linia:
-            kurs["kwota"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-    
-    if kurs and "stawka" in kurs:
-        kursy.append(kurs)
-    
-    if not kursy:
-        return jsonify({"error": "Brak danych"})
-    
-    daty = [k["data"] for k in kursy if "stawka" in k]
-    stawki = [k["stawka"] for k in kursy if "stawka" in k]
-    
-    fig_stawka = go.Figure()
-    fig_stawka.add_trace(go.Scatter(
-        x=daty, 
-        y=stawki,
-        mode='lines+markers',
-        name='Stawka godzinowa',
-        line=dict(color='#667eea', width=3),
-        marker=dict(size=8)
-    ))
-    fig_stawka.update_layout(
-        title='Stawka godzinowa w czasie',
-        xaxis_title='Data i czas',
-        yaxis_title='Stawka (zł/h)',
-        template='plotly_white',
-        height=400
-    )
+    if not len(kursy):
+        return {"error": "Brak danych"}
     
-    zyski = [k["zysk"] for k in kursy if "zysk" in k]
-    
-    fig_zysk = go.Figure()
-    fig_zysk.add_trace(go.Bar(
-        x=daty,
-        y=zyski,
-        name='Zysk netto',
-        marker=dict(color='#10b981')
-    ))
-    fig_zysk.update_layout(
-        title='Zysk netto z kursów',
-        xaxis_title='Data i czas',
-        yaxis_title='Zysk (zł)',
-        template='plotly_white',
-        height=400
-    )
+    wykres_stawka = wykres_odpowiedzi('stawka_w_czasie', {"x": kursy.daty, "y": kursy.stawka.tolist()})
+    wykres_zysk = wykres_odpowiedzi('zysk_kursow', {"x": kursy.daty, "y": kursy.zysk.tolist()})
     
-    from collections import defaultdict
-    stawki_po_godzinach = defaultdict(list)
-    
-    for k in kursy:
-        if "data" in k and "stawka" in k:
-            godzina = int(k["data"][11:13])
-            stawki_po_godzinach[godzina].append(k["stawka"])
-    
-    godziny = sorted(stawki_po_godzinach.keys())
-    srednie_stawki = [sum(stawki_po_godzinach[g])/len(stawki_po_godzinach[g]) for g in godziny]
-    
-    fig_godziny = go.Figure()
-    fig_godziny.add_trace(go.Bar(
-        x=[f"{g:02d}:00" for g in godziny],
-        y=srednie_stawki,
-        name='Średnia stawka',
-        marker=dict(color=srednie_stawki, colorscale='RdYlGn', showscale=True)
-    ))
-    fig_godziny.update_layout(
-        title='Średnia stawka godzinowa według godzin dnia',
-        xaxis_title='Godzina',
-        yaxis_title='Średnia stawka (zł/h)',
-        template='plotly_white',
-        height=400
-    )
+    godziny, liczby, sumy_stawek, _ = kursy.po_godzinach()
+    srednie = sumy_stawek / liczby
+    srednie_stawki = srednie.tolist()
     
-    suma_zyskow = sum(zyski)
-    srednia_stawka = sum(stawki) / len(stawki) if stawki else 0
-    najlepsza_stawka = max(stawki) if stawki else 0
-    najgorsza_stawka = min(stawki) if stawki else 0
-    najlepsza_godzina = godziny[srednie_stawki.index(max(srednie_stawki))] if srednie_stawki else 0
+    wykres_godziny = wykres_odpowiedzi('stawka_wg_godzin', {
+        "x": [f"{g:02d}:00" for g in godziny],
+        "y": srednie_stawki,
+        "marker": {"color": srednie_stawki}
+    })
     
-    return jsonify({
-        "wykres_stawka": json.loads(json.dumps(fig_stawka, cls=plotly.utils.PlotlyJSONEncoder)),
-        "wykres_zysk": json.loads(json.dumps(fig_zysk, cls=plotly.utils.PlotlyJSONEncoder)),
-        "wykres_godziny": json.loads(json.dumps(fig_godziny, cls=plotly.utils.PlotlyJSONEncoder)),
+    najlepsza_godzina = int(godziny[srednie.argmax()])
+    
+    return {
+        "wykres_stawka": wykres_stawka,
+        "wykres_zysk": wykres_zysk,
+        "wykres_godziny": wykres_godziny,
         "statystyki": {
-            "suma_zyskow": f"{suma_zyskow:.2f}",
-            "srednia_stawka": f"{srednia_stawka:.2f}",
-            "najlepsza_stawka": f"{najlepsza_stawka:.2f}",
-            "najgorsza_stawka": f"{najgorsza_stawka:.2f}",
+            "suma_zyskow": f"{kursy.zysk.sum():.2f}",
+            "srednia_stawka": f"{kursy.stawka.mean():.2f}",
+            "najlepsza_stawka": f"{kursy.stawka.max():.2f}",
+            "najgorsza_stawka": f"{kursy.stawka.min():.2f}",
             "liczba_kursow": len(kursy),
             "najlepsza_godzina": f"{najlepsza_godzina:02d}:00"
         }
-    })
+    }
 
-@app.route('/statystyki_platform')
+@app.route('/dane_statystyk')
 @login_required
-def statystyki_platform():
-    """Endpoint do porównania platform."""
-    import plotly.graph_objects as go
-    import plotly.utils
-    import json
-    from collections import defaultdict
-    
-    try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return jsonify({"error": "Brak danych"})
-    
-    kursy = []
-    kurs = {}
-    
-    for linia in linie:
-        if linia.startswith("["):
-            if kurs:
-                kursy.append(kurs)
-            kurs = {"data": linia[1:20]}
-        elif "Platforma:" in linia:
-            kurs["platforma"] = linia.strip().split(":", 1)[1].strip()
-        elif "Stawka godzinowa:" in linia:
-            kurs["stawka"] = float(linia.strip().split(":")[1].replace("zł/h", "").strip())
-        elif "Zysk netto:" in linia:
-            kurs["zysk"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-    
-    if kurs and "stawka" in kurs:
-        kursy.append(kurs)
-    
-    if not kursy:
-        return jsonify({"error": "Brak danych"})
+@odpowiedz_wersjonowana
+def dane_statystyk():
+    return jsonify(sekcja_statystyki())
+
+def sekcja_platformy():
+    """Porównanie platform: wykresy stawek, zysków i liczby kursów."""
     
-    dane_platform = defaultdict(lambda: {"stawki": [], "zyski": [], "liczba": 0})
+    dane_platform = kolumny_historii().po_platformach()
     
-    for kurs in kursy:
-        platforma = kurs.get("platforma", "Nieznana")
-        if "stawka" in kurs:
-            dane_platform[platforma]["stawki"].append(kurs["stawka"])
-        if "zysk" in kurs:
-            dane_platform[platforma]["zyski"].append(kurs["zysk"])
-        dane_platform[platforma]["liczba"] += 1
+    if not dane_platform:
+        return {"error": "Brak danych"}
     
     platformy = []
     srednie_stawki = []
     suma_zyskow_platform = []
     liczba_kursow_platform = []
     
-    for platforma, dane in dane_platform.items():
+    for platforma, liczba, suma_stawek, suma_zyskow in dane_platform:
         platformy.append(platforma)
-        srednia = sum(dane["stawki"]) / len(dane["stawki"]) if dane["stawki"] else 0
-        srednie_stawki.append(srednia)
-        suma_zyskow = sum(dane["zyski"])
+        srednie_stawki.append(suma_stawek / liczba if liczba else 0)
         suma_zyskow_platform.append(suma_zyskow)
-        liczba_kursow_platform.append(dane["liczba"])
-    
-    fig_stawki = go.Figure()
-    fig_stawki.add_trace(go.Bar(
-        x=platformy,
-        y=srednie_stawki,
-        name='Średnia stawka',
-        marker=dict(color=srednie_stawki, colorscale='RdYlGn', showscale=True),
-        text=[f"{s:.2f} zł/h" for s in srednie_stawki],
-        textposition='auto'
-    ))
-    fig_stawki.update_layout(
-        title='Średnia stawka godzinowa według platform',
-        xaxis_title='Platforma',
-        yaxis_title='Średnia stawka (zł/h)',
-        template='plotly_white',
-        height=400
-    )
+        liczba_kursow_platform.append(liczba)
     
-    fig_zyski = go.Figure()
-    fig_zyski.add_trace(go.Bar(
-        x=platformy,
-        y=suma_zyskow_platform,
-        name='Suma zysków',
-        marker=dict(color='#10b981'),
-        text=[f"{z:.2f} zł" for z in suma_zyskow_platform],
-        textposition='auto'
-    ))
-    fig_zyski.update_layout(
-        title='Suma zysków według platform',
-        xaxis_title='Platforma',
-        yaxis_title='Suma zysków (zł)',
-        template='plotly_white',
-        height=400
-    )
+    wykres_stawki = wykres_odpowiedzi('platformy_stawki', {
+        "x": platformy,
+        "y": srednie_stawki,
+        "marker": {"color": srednie_stawki},
+        "text": [f"{s:.2f} zł/h" for s in srednie_stawki]
+    })
     
-    fig_liczba = go.Figure()
-    fig_liczba.add_trace(go.Bar(
-        x=platformy,
-        y=liczba_kursow_platform,
-        name='Liczba kursów',
-        marker=dict(color='#667eea'),
-        text=liczba_kursow_platform,
-        textposition='auto'
-    ))
-    fig_liczba.update_layout(
-        title='Liczba kursów według platform',
-        xaxis_title='Platforma',
-        yaxis_title='Liczba kursów',
-        template='plotly_white',
-        height=400
-    )
+    wykres_zyski = wykres_odpowiedzi('platformy_zyski', {
+        "x": platformy,
+        "y": suma_zyskow_platform,
+        "text": [f"{z:.2f} zł" for z in suma_zyskow_platform]
+    })
+    
+    wykres_liczba = wykres_odpowiedzi('platformy_liczba', {
+        "x": platformy,
+        "y": liczba_kursow_platform,
+        "text": [str(n) for n in liczba_kursow_platform]
+    })
     
     if srednie_stawki:
         idx_najlepsza = srednie_stawki.index(max(srednie_stawki))
@@ -831,130 +1098,181 @@ def statystyki_platform():
         najlepsza_platforma = "Brak danych"
         najlepsza_stawka = 0
     
-    return jsonify({
-        "wykres_stawki": json.loads(json.dumps(fig_stawki, cls=plotly.utils.PlotlyJSONEncoder)),
-        "wykres_zyski": json.loads(json.dumps(fig_zyski, cls=plotly.utils.PlotlyJSONEncoder)),
-        "wykres_liczba": json.loads(json.dumps(fig_liczba, cls=plotly.utils.PlotlyJSONEncoder)),
+    return {
+        "wykres_stawki": wykres_stawki,
+        "wykres_zyski": wykres_zyski,
+        "wykres_liczba": wykres_liczba,
         "najlepsza_platforma": najlepsza_platforma,
         "najlepsza_stawka": f"{najlepsza_stawka:.2f}"
-    })
+    }
+
+@app.route('/statystyki_platform')
+@login_required
+@odpowiedz_wersjonowana
+def statystyki_platform():
+    """Endpoint do porównania platform."""
+    return jsonify(sekcja_platformy())
+
+def okres_raportu(parametry):
+    """Granice [od, do) okresu raportu z parametrów; błędna wartość zgłasza ValueError.
+    
+    typ=miesiac (data RRRR-MM), tydzien (data RRRR-Wtt lub dowolny dzień
+    tygodnia RRRR-MM-DD), kwartal i rok (data RRRR-MM lub RRRR), zakres (od i do,
+    daty RRRR-MM-DD włącznie) albo okno (dni - ostatnie dni razem z dzisiaj).
+    Bez daty raport dotyczy bieżącego okresu.
+    """
+    typ = parametry.get('typ') or 'miesiac'
+    data = parametry.get('data')
+    dzisiaj = datetime.date.today()
+    if typ == 'miesiac':
+        return zakres_miesiaca(data or dzisiaj.strftime('%Y-%m'))
+    if typ == 'tydzien':
+        if not data:
+            dzien = dzisiaj
+        elif '-W' in data:
+            rok, tydzien = data.split('-W')
+            dzien = datetime.date.fromisocalendar(int(rok), int(tydzien), 1)
+        else:
+            dzien = datetime.date.fromisoformat(data)
+        poczatek = dzien - datetime.timedelta(days=dzien.weekday())
+        return poczatek.isoformat(), (poczatek + datetime.timedelta(days=7)).isoformat()
+    if typ in ('kwartal', 'rok'):
+        data = data or dzisiaj.strftime('%Y-%m')
+        miesiac = datetime.datetime.strptime(data, '%Y-%m' if len(data) > 4 else '%Y')
+        if typ == 'rok':
+            return f'{miesiac.year:04d}-01-01', f'{miesiac.year + 1:04d}-01-01'
+        pierwszy = (miesiac.month - 1) // 3 * 3 + 1
+        return (zakres_miesiaca(f'{miesiac.year:04d}-{pierwszy:02d}')[0],
+                zakres_miesiaca(f'{miesiac.year:04d}-{pierwszy + 2:02d}')[1])
+    if typ == 'zakres':
+        od = datetime.date.fromisoformat(parametry.get('od') or '')
+        do = datetime.date.fromisoformat(parametry.get('do') or '')
+        if do < od:
+            raise ValueError(parametry.get('do'))
+        return od.isoformat(), (do + datetime.timedelta(days=1)).isoformat()
+    if typ == 'okno':
+        dni = int(parametry.get('dni') or 30)
+        if not 1 <= dni <= 3660:
+            raise ValueError(dni)
+        return (dzisiaj - datetime.timedelta(days=dni - 1)).isoformat(), (dzisiaj + datetime.timedelta(days=1)).isoformat()
+    raise ValueError(typ)
+
+# Okresy, których raport po zakończeniu jest zapisywany jako niezmienna migawka
+OKRESY_KALENDARZOWE = ('tydzien', 'miesiac', 'kwartal', 'rok')
+
+def sumy_okresu(od, do):
+    """Sumy raportu (kwoty, km, podział gotówka/karta) z kursów z zakresu [od, do)."""
+    kursy_okresu = kursy_z_zakresu(od, do)
+    return {
+        "liczba_kursow": len(kursy_okresu),
+        "zarobki_brutto": sum(k.kwota for k in kursy_okresu),
+        "zarobki_netto": sum(k.zysk for k in kursy_okresu),
+        "przejechane_km": sum(k.dystans for k in kursy_okresu),
+        "gotowka_razem": sum(k.kwota for k in kursy_okresu if k.gotowka),
+        "gotowka_kursy": sum(1 for k in kursy_okresu if k.gotowka),
+        "karta_razem": sum(k.kwota for k in kursy_okresu if not k.gotowka),
+        "karta_kursy": sum(1 for k in kursy_okresu if not k.gotowka)
+    }
+
+def sumy_okresow(okresy):
+    """Sumy raportu dla listy okresów kalendarzowych [(od, do)].
+    
+    Zakończone okresy są czytane jedną kwerendą z migawek (report_snapshots),
+    a brakujące liczone raz i zapisywane. Migawkę usuwa tylko zapis kursu
+    z dniem w tym okresie; bieżący okres jest zawsze liczony na żywo.
+    """
+    dzisiaj = datetime.date.today()
+    daty = [(datetime.date.fromisoformat(od), datetime.date.fromisoformat(do)) for od, do in okresy]
+    migawki = ReportSnapshot.get_many(current_user.id, [okres for okres in daty if okres[1] <= dzisiaj])
+    wersja = DataVersion.get(current_user.id)
+    
+    wynik = []
+    for (od, do), okres in zip(okresy, daty):
+        sumy = migawki.get(okres)
+        if sumy is None:
+            sumy = sumy_okresu(od, do)
+            # Migawka tylko z danych, których w międzyczasie nie zmienił inny zapis
+            if okres[1] <= dzisiaj:
+                ReportSnapshot.save(current_user.id, okres[0], okres[1], sumy, wersja)
+        wynik.append(sumy)
+    return wynik
+
+def raport_z_sum(od, do, sumy):
+    """Raport w postaci zwracanej przez /api/raport (kwoty jako tekst z dwoma miejscami)."""
+    return {
+        "od": od,
+        "do": (datetime.date.fromisoformat(do) - datetime.timedelta(days=1)).isoformat(),
+        "zarobki_brutto": f"{sumy['zarobki_brutto']:.2f}",
+        "zarobki_netto": f"{sumy['zarobki_netto']:.2f}",
+        "liczba_kursow": sumy['liczba_kursow'],
+        "przejechane_km": f"{sumy['przejechane_km']:.2f}",
+        "gotowka_razem": f"{sumy['gotowka_razem']:.2f}",
+        "gotowka_kursy": sumy['gotowka_kursy'],
+        "karta_razem": f"{sumy['karta_razem']:.2f}",
+        "karta_kursy": sumy['karta_kursy']
+    }
+
+def sekcja_raport(parametry):
+    """Raport za okres z okres_raportu(); nieprawidłowe parametry zgłaszają ValueError."""
+    od, do = okres_raportu(parametry)
+    if (parametry.get('typ') or 'miesiac') in OKRESY_KALENDARZOWE:
+        sumy = sumy_okresow([(od, do)])[0]
+    else:
+        sumy = sumy_okresu(od, do)
+    return raport_z_sum(od, do, sumy)
+
+def poprzedni_okres(typ, od, krok):
+    """Parametr data okresu typ poprzedzającego okres zaczynający się od (krok okres) lub rok wcześniejszego (krok rok)."""
+    poczatek = datetime.date.fromisoformat(od)
+    if krok == 'okres' or typ == 'rok':
+        dzien_wczesniej = poczatek - datetime.timedelta(days=1)
+        return dzien_wczesniej.isoformat() if typ == 'tydzien' else dzien_wczesniej.strftime('%Y-%m')
+    if typ == 'tydzien':
+        rok, tydzien, _ = poczatek.isocalendar()
+        return datetime.date.fromisocalendar(rok - 1, min(tydzien, 52), 1).isoformat()
+    return f'{poczatek.year - 1:04d}-{poczatek.month:02d}'
 
 @app.route('/api/raport')
 @login_required
+@odpowiedz_wersjonowana
 def api_raport():
-    """Generuje raport za wybrany okres"""
-    typ = request.args.get('typ', 'miesiac')
-    data = request.args.get('data', datetime.datetime.now().strftime('%Y-%m'))
-    
+    """Generuje raport za wybrany okres (parametry jak w okres_raportu)"""
     try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return jsonify({
-            "zarobki_brutto": "0.00",
-            "zarobki_netto": "0.00",
-            "liczba_kursow": 0,
-            "przejechane_km": "0.00"
-        })
-    
-    kursy = []
-    kurs = {}
-    
-    for linia in linie:
-        if linia.startswith("["):
-            if kurs:
-                kursy.append(kurs)
-            kurs = {"data": linia[1:20]}
-        elif "Kwota (z napiwkiem):" in linia:
-            kurs["kwota"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-        elif "Płatność gotówką:" in linia:
-            kurs["platnosc_gotowka"] = linia.strip().split(":")[1].strip()
-        elif "Zysk netto:" in linia:
-            kurs["zysk"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-        elif "Dystans dojazdu (km):" in linia:
-            kurs["dystans_dojazd"] = float(linia.strip().split(":")[1].strip())
-        elif "Dystans z klientem (km):" in linia:
-            kurs["dystans_kurs"] = float(linia.strip().split(":")[1].strip())
-    
-    if kurs and "kwota" in kurs:
-        kursy.append(kurs)
-    
-    kursy_okresu = []
-    for k in kursy:
-        if typ == 'miesiac' and k["data"][:7] == data:
-            kursy_okresu.append(k)
-        elif typ == 'tydzien':
-            pass
-    
-    zarobki_brutto = sum(k.get("kwota", 0) for k in kursy_okresu)
-    zarobki_netto = sum(k.get("zysk", 0) for k in kursy_okresu)
-    liczba_kursow = len(kursy_okresu)
-    przejechane_km = sum(k.get("dystans_dojazd", 0) + k.get("dystans_kurs", 0) for k in kursy_okresu)
-    
-    # Statystyki gotówki
-    gotowka_razem = sum(k.get("kwota", 0) for k in kursy_okresu if k.get("platnosc_gotowka") == "tak")
-    gotowka_kursy = len([k for k in kursy_okresu if k.get("platnosc_gotowka") == "tak"])
-    karta_razem = sum(k.get("kwota", 0) for k in kursy_okresu if k.get("platnosc_gotowka") != "tak")
-    karta_kursy = len([k for k in kursy_okresu if k.get("platnosc_gotowka") != "tak"])
-    
-    return jsonify({
-        "zarobki_brutto": f"{zarobki_brutto:.2f}",
-        "zarobki_netto": f"{zarobki_netto:.2f}",
-        "liczba_kursow": liczba_kursow,
-        "przejechane_km": f"{przejechane_km:.2f}",
-        "gotowka_razem": f"{gotowka_razem:.2f}",
-        "gotowka_kursy": gotowka_kursy,
-        "karta_razem": f"{karta_razem:.2f}",
-        "karta_kursy": karta_kursy
-    })
+        return jsonify(sekcja_raport(request.args))
+    except ValueError:
+        return jsonify({"error": "Nieprawidłowy format daty"}), 400
 
-@app.route('/api/prognoza')
+@app.route('/api/raport/porownanie')
 @login_required
-def api_prognoza():
-    """Prognozuje zarobki na podstawie historii"""
-    import plotly.graph_objects as go
-    import plotly.utils
-    import json
-    from datetime import timedelta
-    
+@odpowiedz_wersjonowana
+def api_raport_porownanie():
+    """Raporty kilku okresów do porównania, od najstarszego.
+    
+    typ i data jak w /api/raport (tylko okresy kalendarzowe), liczba to liczba
+    okresów (domyślnie 12, najwyżej 60), krok=okres daje kolejne okresy
+    wstecz, a krok=rok ten sam okres w poprzednich latach. Zakończone okresy
+    pochodzą z migawek, więc porównanie to głównie odczyt z bazy.
+    """
+    typ = request.args.get('typ') or 'miesiac'
+    krok = request.args.get('krok') or 'okres'
     try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return jsonify({
-            "dni_historii": 0,
-            "prognoza_miesiac": "0.00",
-            "srednia_dzienna": "0.00",
-            "trend": "brak danych",
-            "wykres_data": [],
-            "wykres_layout": {}
-        })
-    
-    kursy = []
-    kurs = {}
-    
-    for linia in linie:
-        if linia.startswith("["):
-            if kurs:
-                kursy.append(kurs)
-            kurs = {"data": linia[1:10], "data_pelna": linia[1:20]}
-        elif "Zysk netto:" in linia:
-            kurs["zysk"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-    
-    if kurs and "zysk" in kurs:
-        kursy.append(kurs)
-    
-    zarobki_dzienne = {}
-    for k in kursy:
-        if "data" in k and "zysk" in k:
-            data = k["data"]
-            if data not in zarobki_dzienne:
-                zarobki_dzienne[data] = 0
-            zarobki_dzienne[data] += k["zysk"]
-    
-    ostatnie_30_dni = sorted(zarobki_dzienne.items())[-30:]
+        liczba = int(request.args.get('liczba') or 12)
+        if typ not in OKRESY_KALENDARZOWE or krok not in ('okres', 'rok') or not 1 <= liczba <= 60:
+            raise ValueError(typ)
+        okresy = [okres_raportu({'typ': typ, 'data': request.args.get('data')})]
+        while len(okresy) < liczba:
+            okresy.append(okres_raportu({'typ': typ, 'data': poprzedni_okres(typ, okresy[-1][0], krok)}))
+    except ValueError:
+        return jsonify({"error": "Nieprawidłowe parametry"}), 400
+    
+    okresy.reverse()
+    return jsonify({"typ": typ, "krok": krok,
+                    "okresy": [raport_z_sum(od, do, sumy) for (od, do), sumy in zip(okresy, sumy_okresow(okresy))]})
+
+def sekcja_prognoza():
+    """Prognozuje zarobki na podstawie historii"""
+    zapewnij_rollupy()
+    ostatnie_30_dni = RideRollup.daily_profit(current_user.id, 30)
     
     if ostatnie_30_dni:
         srednia_dzienna = sum(z for d, z in ostatnie_30_dni) / len(ostatnie_30_dni)
@@ -975,206 +1293,267 @@ def api_prognoza():
         daty = [d for d, z in ostatnie_30_dni]
         zarobki = [z for d, z in ostatnie_30_dni]
         
-        fig = go.Figure()
-        fig.add_trace(go.Scatter(
-            x=daty,
-            y=zarobki,
-            mode='lines+markers',
-            name='Dzienny zysk',
-            line=dict(color='#667eea', width=2)
-        ))
-        fig.add_trace(go.Scatter(
-            x=daty,
-            y=[srednia_dzienna] * len(daty),
-            mode='lines',
-            name='Średnia',
-            line=dict(color='#10b981', width=2, dash='dash')
-        ))
-        fig.update_layout(
-            title='Historia zarobków dziennych',
-            xaxis_title='Data',
-            yaxis_title='Zysk (zł)',
-            template='plotly_white',
-            height=300
-        )
+        fig = wykres_odpowiedzi('zarobki_dzienne',
+                                 {"x": daty, "y": zarobki},
+                                 {"x": daty, "y": [srednia_dzienna] * len(daty)})
         
-        return jsonify({
+        wynik = {
             "dni_historii": len(ostatnie_30_dni),
             "prognoza_miesiac": f"{prognoza_miesiac:.2f}",
             "srednia_dzienna": f"{srednia_dzienna:.2f}",
-            "trend": trend,
-            "wykres_data": json.loads(json.dumps(fig.data, cls=plotly.utils.PlotlyJSONEncoder)),
-            "wykres_layout": json.loads(json.dumps(fig.layout, cls=plotly.utils.PlotlyJSONEncoder))
-        })
+            "trend": trend
+        }
+        if "typ" in fig:
+            wynik["wykres"] = fig
+        else:
+            wynik["wykres_data"] = fig["data"]
+            wynik["wykres_layout"] = fig["layout"]
+        return wynik
     else:
-        return jsonify({
+        return {
             "dni_historii": 0,
             "prognoza_miesiac": "0.00",
             "srednia_dzienna": "0.00",
             "trend": "brak danych",
             "wykres_data": [],
             "wykres_layout": {}
-        })
+        }
 
-@app.route('/api/kilometry')
+@app.route('/api/prognoza')
 @login_required
-def api_kilometry():
-    """Zwraca statystyki kilometrów"""
+@odpowiedz_wersjonowana
+def api_prognoza():
+    """Prognozuje zarobki na podstawie historii"""
+    return jsonify(sekcja_prognoza())
+
+# Domyślne osie siatki scenariuszy i limit liczby scenariuszy w jednym żądaniu
+OSIE_SCENARIUSZY = {
+    'cena_paliwa': [5.0, 5.5, 6.0, 6.5, 7.0, 7.5, 8.0],
+    'spalanie': [4.0, 5.0, 6.0, 7.0, 8.0, 9.0, 10.0],
+    'procent_dla_kierowcy': [60.0, 65.0, 70.0, 75.0, 80.0, 85.0, 90.0],
+}
+MAKS_SCENARIUSZY = 20000
+
+def os_scenariuszy(nazwa):
+    """Wartości osi siatki z parametru (liczby po przecinku) albo domyślne; błąd zgłasza ValueError."""
+    if not request.args.get(nazwa):
+        return OSIE_SCENARIUSZY[nazwa]
+    wartosci = [float(w) for w in request.args[nazwa].split(',')]
+    if not 0 < len(wartosci) <= 200 or any(w != w or abs(w) == float('inf') for w in wartosci):
+        raise ValueError(nazwa)
+    return wartosci
+
+@app.route('/api/scenariusze')
+@login_required
+@odpowiedz_wersjonowana
+def api_scenariusze():
+    """Co by było, gdyby: zysk i stawka z historii kursów dla siatki scenariuszy.
+    
+    Parametry cena_paliwa, spalanie i procent_dla_kierowcy to listy wartości po
+    przecinku (najwyżej 20000 kombinacji), od/do zawężają historię. Każde pole
+    wyniku to tablica [cena_paliwa][spalanie][procent_dla_kierowcy].
+    """
+    from analityka import siatka_scenariuszy
     try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return jsonify({
-            "calkowite": "0",
-            "miesiac": "0",
-            "srednia_dzien": "0",
-            "koszt_km": "0.00"
-        })
-    
-    kursy = []
-    kurs = {}
-    
-    for linia in linie:
-        if linia.startswith("["):
-            if kurs:
-                kursy.append(kurs)
-            kurs = {"data": linia[1:10]}
-        elif "Dystans dojazdu (km):" in linia:
-            kurs["dystans_dojazd"] = float(linia.strip().split(":")[1].strip())
-        elif "Dystans z klientem (km):" in linia:
-            kurs["dystans_kurs"] = float(linia.strip().split(":")[1].strip())
-        elif "Koszt paliwa:" in linia:
-            kurs["koszt_paliwa"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-    
-    if kurs:
-        kursy.append(kurs)
-    
-    calkowity_dystans = 0
-    calkowity_koszt = 0
+        osie = {nazwa: os_scenariuszy(nazwa) for nazwa in OSIE_SCENARIUSZY}
+        filtry = filtry_historii({'od': request.args.get('od'), 'do': request.args.get('do')})
+    except ValueError:
+        return jsonify({"error": "Nieprawidłowe parametry"}), 400
+    if len(osie['cena_paliwa']) * len(osie['spalanie']) * len(osie['procent_dla_kierowcy']) > MAKS_SCENARIUSZY:
+        return jsonify({"error": f"Najwyżej {MAKS_SCENARIUSZY} scenariuszy"}), 400
+    
+    min_stawka = float(wczytaj_cele().get("min_stawka", 30))
+    kursy = kolumny_historii()
+    maska = kursy.zakres(filtry.get('od'), filtry.get('do'))
+    siatka = siatka_scenariuszy(kursy.kwota[maska], kursy.km[maska], kursy.czas_h[maska], osie['cena_paliwa'],
+                                osie['spalanie'], osie['procent_dla_kierowcy'], min_stawka)
+    
+    wynik = dict(osie, liczba_kursow=int(maska.sum()), min_stawka=min_stawka)
+    for nazwa, tablica in siatka.items():
+        wynik[nazwa] = tablica.round(2).tolist()
+    return jsonify(wynik)
+
+def sekcja_kilometry():
+    """Zwraca statystyki kilometrów"""
+    historia = podsumowanie_historii()
+    calkowity_dystans = historia["suma_km"]
+    calkowity_koszt = historia["suma_paliwa"]
     
     dzisiaj = datetime.datetime.now()
     miesiac_obecny = dzisiaj.strftime("%Y-%m")
     dystans_miesiac = 0
     dni_w_miesiacu = set()
     
-    for k in kursy:
-        dystans = k.get("dystans_dojazd", 0) + k.get("dystans_kurs", 0)
-        calkowity_dystans += dystans
-        calkowity_koszt += k.get("koszt_paliwa", 0)
-        
-        if k.get("data", "")[:7] == miesiac_obecny:
-            dystans_miesiac += dystans
-            dni_w_miesiacu.add(k.get("data"))
+    for k in kursy_z_zakresu(*zakres_miesiaca(miesiac_obecny)):
+        dystans_miesiac += k.dystans
+        dni_w_miesiacu.add(k.data)
     
     koszt_na_km = (calkowity_koszt / calkowity_dystans) if calkowity_dystans > 0 else 0
     srednia_dzien = (dystans_miesiac / len(dni_w_miesiacu)) if len(dni_w_miesiacu) > 0 else 0
     
-    return jsonify({
+    return {
         "calkowite": f"{calkowity_dystans:.0f}",
         "miesiac": f"{dystans_miesiac:.0f}",
         "srednia_dzien": f"{srednia_dzien:.0f}",
         "koszt_km": f"{koszt_na_km:.2f}"
-    })
+    }
 
-@app.route('/api/heatmap_rentownosci')
+@app.route('/api/kilometry')
 @login_required
-def api_heatmap_rentownosci():
-    """Generuje heatmapę rentowności według dnia tygodnia i godziny"""
-    import plotly.graph_objects as go
-    import plotly.utils
-    import json
-    from collections import defaultdict
-    
-    try:
-        plik_path = get_user_file('kursy.txt')
-        with open(plik_path, "r", encoding="utf-8") as plik:
-            linie = plik.readlines()
-    except FileNotFoundError:
-        return jsonify({"error": "Brak danych"})
-    
-    kursy = []
-    kurs = {}
-    
-    for linia in linie:
-        if linia.startswith("["):
-            if kurs:
-                kursy.append(kurs)
-            kurs = {"data_pelna": linia[1:20]}
-        elif "Zysk netto:" in linia:
-            kurs["zysk"] = float(linia.strip().split(":")[1].replace("zł", "").strip())
-    
-    if kurs and "zysk" in kurs:
-        kursy.append(kurs)
-    
-    if not kursy:
-        return jsonify({"error": "Brak danych"})
-    
-    rentownosc = defaultdict(lambda: defaultdict(list))
+@odpowiedz_wersjonowana
+def api_kilometry():
+    """Zwraca statystyki kilometrów"""
+    return jsonify(sekcja_kilometry())
+
+def sekcja_heatmapa():
+    """Heatmapa rentowności według dnia tygodnia i godziny"""
     
     dni_tygodnia_pl = ['Poniedziałek', 'Wtorek', 'Środa', 'Czwartek', 'Piątek', 'Sobota', 'Niedziela']
     
-    for k in kursy:
-        if "data_pelna" in k and "zysk" in k:
-            try:
-                data_obj = datetime.datetime.strptime(k["data_pelna"], "%Y-%m-%d %H:%M:%S")
-                dzien_tygodnia = data_obj.weekday()
-                godzina = data_obj.hour
-                rentownosc[dzien_tygodnia][godzina].append(k["zysk"])
-            except (ValueError, KeyError, AttributeError) as e:
-                print(f"Błąd parsowania daty: {e}")
-                continue
+    liczby, sumy_zyskow = kolumny_historii().po_dniach_tygodnia_i_godzinach()
     
-    godziny = list(range(24))
-    macierz_rentownosci = []
+    if not liczby.any():
+        return {"error": "Brak danych"}
     
-    for dzien in range(7):
-        wiersz = []
-        for godzina in godziny:
-            if rentownosc[dzien][godzina]:
-                srednia = sum(rentownosc[dzien][godzina]) / len(rentownosc[dzien][godzina])
-                wiersz.append(srednia)
-            else:
-                wiersz.append(None)
-        macierz_rentownosci.append(wiersz)
-    
-    fig = go.Figure(data=go.Heatmap(
-        z=macierz_rentownosci,
-        x=[f"{g:02d}:00" for g in godziny],
-        y=dni_tygodnia_pl,
-        colorscale='RdYlGn',
-        hoverongaps=False,
-        hovertemplate='%{y}<br>%{x}<br>Średni zysk: %{z:.2f} zł<extra></extra>'
-    ))
-    
-    fig.update_layout(
-        title='Rentowność według dnia tygodnia i godziny',
-        xaxis_title='Godzina',
-        yaxis_title='Dzień tygodnia',
-        template='plotly_white',
-        height=500
-    )
+    godziny = list(range(24))
+    liczby, sumy_zyskow = liczby.tolist(), sumy_zyskow.tolist()
+    macierz_rentownosci = [[suma / liczba if liczba else None for liczba, suma in zip(wiersz_liczb, wiersz_sum)]
+                           for wiersz_liczb, wiersz_sum in zip(liczby, sumy_zyskow)]
+    
+    fig = wykres_odpowiedzi('heatmapa_rentownosci', {
+        "z": macierz_rentownosci,
+        "x": [f"{g:02d}:00" for g in godziny],
+        "y": dni_tygodnia_pl
+    })
     
     najlepsze_sloty = []
     for dzien in range(7):
         for godzina in godziny:
-            if rentownosc[dzien][godzina]:
-                srednia = sum(rentownosc[dzien][godzina]) / len(rentownosc[dzien][godzina])
-                liczba_kursow = len(rentownosc[dzien][godzina])
+            if liczby[dzien][godzina]:
                 najlepsze_sloty.append({
                     'dzien': dni_tygodnia_pl[dzien],
                     'godzina': f"{godzina:02d}:00",
-                    'sredni_zysk': srednia,
-                    'liczba_kursow': liczba_kursow
+                    'sredni_zysk': macierz_rentownosci[dzien][godzina],
+                    'liczba_kursow': liczby[dzien][godzina]
                 })
     
     najlepsze_sloty.sort(key=lambda x: x['sredni_zysk'], reverse=True)
     top_3 = najlepsze_sloty[:3]
     
-    return jsonify({
-        "wykres": json.loads(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder)),
+    return {
+        "wykres": fig,
         "top_sloty": top_3
-    })
+    }
+
+@app.route('/api/heatmap_rentownosci')
+@login_required
+@odpowiedz_wersjonowana
+def api_heatmap_rentownosci():
+    """Generuje heatmapę rentowności według dnia tygodnia i godziny"""
+    return jsonify(sekcja_heatmapa())
+
+# Sekcje panelu dostępne w /api/dashboard
+SEKCJE_PANELU = {
+    'statystyki': sekcja_statystyki,
+    'platformy': sekcja_platformy,
+    'raport': lambda: sekcja_raport(request.args),
+    'prognoza': sekcja_prognoza,
+    'kilometry': sekcja_kilometry,
+    'heatmapa': sekcja_heatmapa,
+}
+
+@app.route('/api/dashboard')
+@login_required
+@odpowiedz_wersjonowana
+def api_dashboard():
+    """Zwraca kilka sekcji panelu w jednej odpowiedzi.
+    
+    Parametr sections to lista nazw z SEKCJE_PANELU rozdzielona przecinkami;
+    parametry okresu (typ, data, od, do, dni) działają jak w /api/raport. Wynik ma postać {sekcja: dane}.
+    """
+    sekcje = [s.strip() for s in request.args.get('sections', '').split(',') if s.strip()]
+    if not sekcje:
+        return jsonify({"error": "Brak parametru sections"}), 400
+    nieznane = [s for s in sekcje if s not in SEKCJE_PANELU]
+    if nieznane:
+        return jsonify({"error": f"Nieznane sekcje: {', '.join(nieznane)}"}), 400
+    
+    wynik = {}
+    for sekcja in sekcje:
+        try:
+            wynik[sekcja] = SEKCJE_PANELU[sekcja]()
+        except ValueError:
+            wynik[sekcja] = {"error": "Nieprawidłowy format daty"}
+    return jsonify(wynik)
+
+def kursy_do_eksportu(od=None, do=None):
+    """Kursy z zakresu [od, do) czytane strumieniowo, bez cache całej historii.
+    
+    Z pliku kursy idą w kolejności zapisu (kursy z paczek offline tam, gdzie
+    zostały dopisane), z bazy - chronologicznie.
+    """
+    if kursy_w_bazie():
+        return Ride.iter_for_user(current_user.id, od, do)
+    kursy = czytaj_plik_kursow(get_user_file('kursy.txt'))
+    return (k for k in kursy if (od is None or k.data_czas >= od) and (do is None or k.data_czas < do))
+
+def miesiac_segmentu(od, do):
+    """RRRR-MM, jeśli zakres [od, do) to dokładnie jeden zamknięty miesiąc, inaczej None."""
+    if od is None or do is None or od[8:] != '01':
+        return None
+    miesiac = od[:7]
+    if zakres_miesiaca(miesiac) != (od, do) or miesiac >= datetime.date.today().strftime('%Y-%m'):
+        return None
+    return miesiac
+
+def segment_eksportu(miesiac, format):
+    """Ścieżka gotowego eksportu zamkniętego miesiąca, budowanego przy pierwszym żądaniu.
+    
+    Segment jest porzucany, jeśli w trakcie budowania zmieniły się dane
+    użytkownika; wtedy zwracane jest None i eksport idzie strumieniem.
+    """
+    import eksport
+    sciezka = f'{folder_segmentow(current_user.id)}/{miesiac}.{format}'
+    if os.path.exists(sciezka):
+        return sciezka
+    wersja = DataVersion.get(current_user.id)
+    tymczasowy = eksport.zapisz_segment(sciezka, kursy_do_eksportu(*zakres_miesiaca(miesiac)), format)
+    db.session.rollback()
+    if DataVersion.get(current_user.id) != wersja:
+        os.remove(tymczasowy)
+        return None
+    os.replace(tymczasowy, sciezka)
+    return sciezka
+
+@app.route('/api/export')
+@login_required
+def api_export():
+    """Eksport historii kursów (format=csv|ndjson, opcjonalnie od/do) jako plik do pobrania.
+    
+    Odpowiedź jest strumieniowana porcjami (chunked) prosto z pliku kursów lub
+    bazy. Zamknięty miesiąc jest zapisywany raz jako segment i potem wysyłany
+    przez send_file.
+    """
+    import eksport
+    format = request.args.get('format', 'csv')
+    if format not in eksport.FORMATY:
+        return jsonify({"error": "Nieobsługiwany format"}), 400
+    try:
+        filtry = filtry_historii({'od': request.args.get('od'), 'do': request.args.get('do')})
+    except ValueError:
+        return jsonify({"error": "Nieprawidłowy format daty"}), 400
+    od, do = filtry.get('od'), filtry.get('do')
+    nazwa = f"kursy{'_' + od if od else ''}{'_' + request.args['do'] if do else ''}.{format}"
+    
+    miesiac = miesiac_segmentu(od, do)
+    sciezka = segment_eksportu(miesiac, format) if miesiac else None
+    if sciezka:
+        return send_file(os.path.abspath(sciezka), mimetype=eksport.FORMATY[format],
+                         as_attachment=True, download_name=nazwa)
+    
+    return Response(stream_with_context(eksport.strumien(kursy_do_eksportu(od, do), format)),
+                    content_type=eksport.FORMATY[format],
+                    headers={"Content-Disposition": f"attachment; filename={nazwa}"})
 
 @app.route('/ai-asystent')
 @login_required
@@ -1182,98 +1561,48 @@ def ai_asystent():
     """Strona AI Asystenta"""
     return render_template('ai_asystent.html')
 
-@app.route('/api/ai-analiza', methods=['POST'])
-@login_required
-def ai_analiza():
-    """Endpoint do analizy danych przez AI"""
-    import json
-    import requests
-    
-    data = request.json
-    typ = data.get('typ')
-    pytanie = data.get('pytanie', '')
-    
-    # Pobierz dane kursów użytkownika
-    kursy = wczytaj_historie_kursow()
-    
-    if not kursy:
-        return jsonify({
-            'analiza': 'Nie masz jeszcze żadnych zapisanych kursów. Zacznij dodawać kursy w kalkulatorze, aby AI mogło przeanalizować Twoje dane.'
-        })
-    
-    # Przygotuj podsumowanie danych dla AI
-    ile_kursow = len(kursy)
-    platformy = {}
-    suma_zysk = 0
-    suma_stawka = 0
-    stawki_lista = []
-    
-    for kurs in kursy:
-        platforma = kurs.get('Platforma', 'Inne')
-        if platforma not in platformy:
-            platformy[platforma] = {'liczba': 0, 'zysk': 0, 'stawki': []}
-        platformy[platforma]['liczba'] += 1
-        
-        zysk_str = kurs.get('Zysk netto', '0').replace('zł', '').strip()
-        stawka_str = kurs.get('Stawka godzinowa', '0').replace('zł/h', '').strip()
-        
-        try:
-            zysk = float(zysk_str)
-            suma_zysk += zysk
-            platformy[platforma]['zysk'] += zysk
-        except:
-            pass
-        
-        try:
-            stawka = float(stawka_str)
-            suma_stawka += stawka
-            stawki_lista.append(stawka)
-            platformy[platforma]['stawki'].append(stawka)
-        except:
-            pass
-    
-    srednia_stawka = suma_stawka / len(stawki_lista) if stawki_lista else 0
+def dane_analizy(kolumny):
+    """Podsumowanie historii, z którego powstaje prompt analizy AI (kolumny z kolumny_historii()).
     
-    # Analiza czasowa
-    from collections import defaultdict
-    import datetime as dt
+    Kwoty są zaokrąglone do groszy jak w prompcie, więc skrót tych danych
+    zmienia się tylko wtedy, gdy zmieniłby się prompt.
+    """
+    liczba_dni, zysk_dni = (tablica.sum(axis=1) for tablica in kolumny.po_dniach_tygodnia_i_godzinach())
+    godziny, liczba_godzin, _, zysk_godzin = kolumny.po_godzinach()
     
-    zarobki_dzien_tygodnia = defaultdict(list)
-    zarobki_godzina = defaultdict(list)
+    def najlepszy(indeksy, liczba, suma_zyskow):
+        """(indeks, średni zysk) z najwyższym średnim zyskiem"""
+        if not len(indeksy):
+            return 0, 0.0
+        srednie = suma_zyskow / liczba
+        najlepszy = int(srednie.argmax())
+        return int(indeksy[najlepszy]), round(float(srednie[najlepszy]), 2)
     
-    for kurs in kursy:
-        try:
-            data_czas = kurs.get('data_czas', '')
-            zysk_str = kurs.get('Zysk netto', '0').replace('zł', '').strip()
-            zysk = float(zysk_str)
-            
-            data_obj = dt.datetime.strptime(data_czas, "%Y-%m-%d %H:%M:%S")
-            dzien_tygodnia = data_obj.weekday()
-            godzina = data_obj.hour
-            
-            zarobki_dzien_tygodnia[dzien_tygodnia].append(zysk)
-            zarobki_godzina[godzina].append(zysk)
-        except:
-            continue
+    dni = liczba_dni.nonzero()[0]
+    return {
+        'ile_kursow': len(kolumny),
+        'srednia_stawka': round(float(kolumny.stawka.mean()), 2) if len(kolumny) else 0.0,
+        'suma_zysk': round(float(kolumny.zysk.sum()), 2),
+        'platformy': [(nazwa, liczba, round(suma_stawek / liczba, 2))
+                      for nazwa, liczba, suma_stawek, _ in kolumny.po_platformach()],
+        'najlepszy_dzien': najlepszy(dni, liczba_dni[dni], zysk_dni[dni]),
+        'najlepsza_godzina': najlepszy(godziny, liczba_godzin, zysk_godzin),
+    }
+
+def prompt_analizy(typ, pytanie, dane):
+    """Prompt dla modelu z danymi z dane_analizy(); None dla nieznanego typu analizy"""
+    dni_pl = ['poniedziałek', 'wtorek', 'środa', 'czwartek', 'piątek', 'sobota', 'niedziela']
     
     # Tworzenie promptów dla różnych typów analizy
     if typ == 'wzorce':
-        # Znajdź najlepsze dni i godziny
-        najlepszy_dzien = max(zarobki_dzien_tygodnia.items(), 
-                             key=lambda x: sum(x[1])/len(x[1]) if x[1] else 0) if zarobki_dzien_tygodnia else (0, [0])
-        najlepsza_godzina = max(zarobki_godzina.items(), 
-                               key=lambda x: sum(x[1])/len(x[1]) if x[1] else 0) if zarobki_godzina else (0, [0])
-        
-        dni_pl = ['poniedziałek', 'wtorek', 'środa', 'czwartek', 'piątek', 'sobota', 'niedziela']
-        
-        prompt = f"""Jesteś ekspertem w analizie danych dla kierowców taxi. Przeanalizuj dane użytkownika i podaj konkretne wzorce czasowe.
+        return f"""Jesteś ekspertem w analizie danych dla kierowców taxi. Przeanalizuj dane użytkownika i podaj konkretne wzorce czasowe.
 
 DANE UŻYTKOWNIKA:
-- Liczba kursów: {ile_kursow}
-- Średnia stawka godzinowa: {srednia_stawka:.2f} zł/h
-- Całkowity zysk: {suma_zysk:.2f} zł
-- Najlepszy dzień tygodnia: {dni_pl[najlepszy_dzien[0]]} (średni zysk: {sum(najlepszy_dzien[1])/len(najlepszy_dzien[1]):.2f} zł)
-- Najlepsza godzina: {najlepsza_godzina[0]}:00 (średni zysk: {sum(najlepsza_godzina[1])/len(najlepsza_godzina[1]):.2f} zł)
+- Liczba kursów: {dane['ile_kursow']}
+- Średnia stawka godzinowa: {dane['srednia_stawka']:.2f} zł/h
+- Całkowity zysk: {dane['suma_zysk']:.2f} zł
+- Najlepszy dzień tygodnia: {dni_pl[dane['najlepszy_dzien'][0]]} (średni zysk: {dane['najlepszy_dzien'][1]:.2f} zł)
+- Najlepsza godzina: {dane['najlepsza_godzina'][0]}:00 (średni zysk: {dane['najlepsza_godzina'][1]:.2f} zł)
 
 Napisz krótką, konkretną analizę wzorców czasowych (max 200 słów). Podaj:
 1. W które dni tygodnia zarabia najlepiej
@@ -1283,12 +1612,12 @@ Napisz krótką, konkretną analizę wzorców czasowych (max 200 słów). Podaj:
 Pisz po polsku, bezpośrednio do kierowcy. Używaj konkretnych liczb z danych."""
 
     elif typ == 'optymalizacja':
-        prompt = f"""Jesteś ekspertem w optymalizacji zarobków kierowców taxi. Przeanalizuj dane i podaj konkretne porady.
+        return f"""Jesteś ekspertem w optymalizacji zarobków kierowców taxi. Przeanalizuj dane i podaj konkretne porady.
 
 DANE UŻYTKOWNIKA:
-- Liczba kursów: {ile_kursow}
-- Średnia stawka godzinowa: {srednia_stawka:.2f} zł/h
-- Platformy: {', '.join([f"{p} ({dane['liczba']} kursów)" for p, dane in platformy.items()])}
+- Liczba kursów: {dane['ile_kursow']}
+- Średnia stawka godzinowa: {dane['srednia_stawka']:.2f} zł/h
+- Platformy: {', '.join([f"{p} ({liczba} kursów)" for p, liczba, _ in dane['platformy']])}
 
 Napisz konkretne porady jak zwiększyć stawkę godzinową (max 200 słów). Podaj:
 1. Co robisz dobrze (na podstawie danych)
@@ -1298,12 +1627,10 @@ Napisz konkretne porady jak zwiększyć stawkę godzinową (max 200 słów). Pod
 Pisz po polsku, bezpośrednio do kierowcy. Używaj konkretnych liczb z danych."""
 
     elif typ == 'platformy':
-        platformy_info = []
-        for p, dane in platformy.items():
-            srednia_p = sum(dane['stawki'])/len(dane['stawki']) if dane['stawki'] else 0
-            platformy_info.append(f"{p}: {dane['liczba']} kursów, średnia stawka {srednia_p:.2f} zł/h")
+        platformy_info = [f"{p}: {liczba} kursów, średnia stawka {srednia_p:.2f} zł/h"
+                          for p, liczba, srednia_p in dane['platformy']]
         
-        prompt = f"""Jesteś ekspertem w porównywaniu platform taxi. Przeanalizuj dane użytkownika.
+        return f"""Jesteś ekspertem w porównywaniu platform taxi. Przeanalizuj dane użytkownika.
 
 DANE PLATFORM:
 {chr(10).join(['- ' + info for info in platformy_info])}
@@ -1317,80 +1644,224 @@ Pisz po polsku, bezpośrednio do kierowcy. Używaj konkretnych liczb z danych.""
 
     elif typ == 'pytanie':
         # Przygotuj kontekst dla dowolnego pytania
-        prompt = f"""Jesteś ekspertem w analizie danych dla kierowców taxi. Odpowiedz na pytanie użytkownika.
+        return f"""Jesteś ekspertem w analizie danych dla kierowców taxi. Odpowiedz na pytanie użytkownika.
 
 DANE UŻYTKOWNIKA:
-- Liczba kursów: {ile_kursow}
-- Średnia stawka godzinowa: {srednia_stawka:.2f} zł/h
-- Całkowity zysk: {suma_zysk:.2f} zł
-- Platformy: {', '.join([f"{p} ({dane['liczba']} kursów, średnia {sum(dane['stawki'])/len(dane['stawki']):.2f} zł/h)" for p, dane in platformy.items() if dane['stawki']])}
+- Liczba kursów: {dane['ile_kursow']}
+- Średnia stawka godzinowa: {dane['srednia_stawka']:.2f} zł/h
+- Całkowity zysk: {dane['suma_zysk']:.2f} zł
+- Platformy: {', '.join([f"{p} ({liczba} kursów, średnia {srednia_p:.2f} zł/h)" for p, liczba, srednia_p in dane['platformy']])}
 
 PYTANIE UŻYTKOWNIKA: {pytanie}
 
 Odpowiedz konkretnie i praktycznie (max 200 słów). Używaj danych użytkownika w odpowiedzi. Pisz po polsku."""
     
+    return None
+
+def klucz_analizy(typ, pytanie, dane):
+    """Klucz cache_analiz: użytkownik, typ, skrót danych promptu i znormalizowane pytanie"""
+    skrot = hashlib.sha256(json.dumps(dane, sort_keys=True).encode()).hexdigest()
+    pytanie = ' '.join(pytanie.split()).casefold() if typ == 'pytanie' else ''
+    return current_user.id, typ, skrot, pytanie
+
+def odpowiedz_modelu(prompt, referer):
+    """Odpowiedź modelu wybranego w AI_BACKEND (openrouter albo lokalny stub); błąd to asystent.BladModelu"""
+    if app.config["AI_BACKEND"] == "stub":
+        return asystent.odpowiedz_testowa(prompt, app.config["AI_STUB_DELAY"])
+    return klient_ai.zapytaj(prompt, os.environ.get('OPENROUTER_API_KEY'), referer)
+
+def analiza_modelu(klucz, prompt, referer):
+    """Odpowiedź modelu zapisywana w cache_analiz; równoległe analizy z tym samym kluczem
+    czekają na jedno zapytanie do modelu (analizy_w_toku)"""
+    def zapytaj():
+        analiza = odpowiedz_modelu(prompt, referer)
+        cache_analiz.zapisz(klucz, analiza)
+        return analiza
+    return analizy_w_toku.wykonaj(klucz, zapytaj, AI_JOB_TIMEOUT.total_seconds())
+
+def strumien_analizy(klucz, prompt, referer):
+    """Zdarzenia SSE z kolejnymi fragmentami odpowiedzi modelu i zdarzeniem koniec.
+    
+    Gdy ta sama analiza jest już w toku, strumień czeka na jej wynik i wysyła
+    go w całości. Pełna odpowiedź trafia do cache_analiz.
+    """
+    wywolanie, pierwsze = analizy_w_toku.rozpocznij(klucz)
+    if not pierwsze:
+        try:
+            yield asystent.zdarzenie_sse({'tekst': wywolanie.czekaj(AI_JOB_TIMEOUT.total_seconds())})
+        except asystent.BladModelu as e:
+            yield asystent.zdarzenie_sse({'tekst': str(e)})
+        except Exception as e:
+            yield asystent.zdarzenie_sse({'tekst': f'❌ Wystąpił nieoczekiwany błąd:\n\n{str(e)}'})
+        yield asystent.zdarzenie_sse({}, 'koniec')
+        return
+    
+    if app.config["AI_BACKEND"] == "stub":
+        fragmenty = asystent.strumien_testowy(prompt, app.config["AI_STUB_DELAY"])
     else:
-        return jsonify({'analiza': 'Nieznany typ analizy'})
-    
-    # Wywołaj OpenRouter API
+        fragmenty = klient_ai.strumien(prompt, os.environ.get('OPENROUTER_API_KEY'), referer)
+    tekst = []
+    blad = asystent.BladModelu('Przerwano analizę')
     try:
-        api_key = os.environ.get('OPENROUTER_API_KEY')
-        if not api_key:
-            return jsonify({
-                'analiza': '⚠️ AI Asystent wymaga klucza API OpenRouter.\n\nAby skonfigurować:\n1. Przejdź do zakładki Secrets (🔒)\n2. Dodaj nowy secret:\n   - Key: OPENROUTER_API_KEY\n   - Value: Twój klucz z openrouter.ai\n\n💡 Możesz uzyskać darmowy klucz na https://openrouter.ai'
-            })
-        
-        response = requests.post(
-            'https://openrouter.ai/api/v1/chat/completions',
-            headers={
-                'Authorization': f'Bearer {api_key}',
-                'Content-Type': 'application/json',
-                'HTTP-Referer': request.host_url,
-            },
-            json={
-                'model': 'qwen/qwen2.5-vl-72b-instruct:free',
-                'messages': [
-                    {
-                        'role': 'user',
-                        'content': prompt
-                    }
-                ],
-                'max_tokens': 500,
-                'temperature': 0.7
-            },
-            timeout=60
-        )
-        
-        if response.status_code == 200:
-            result = response.json()
-            analiza_text = result['choices'][0]['message']['content']
-            return jsonify({'analiza': analiza_text})
-        elif response.status_code == 429:
-            return jsonify({
-                'analiza': '⏳ Model AI jest teraz zajęty. Spróbuj ponownie za chwilę.\n\n💡 Darmowy model ma limity zapytań. Poczekaj 1-2 minuty i spróbuj ponownie.'
-            })
-        elif response.status_code == 401:
-            return jsonify({
-                'analiza': '🔑 Błąd autoryzacji. Sprawdź czy klucz API w Secrets jest prawidłowy.'
-            })
-        else:
-            error_msg = response.text if response.text else 'Nieznany błąd'
-            return jsonify({
-                'analiza': f'⚠️ API zwróciło błąd ({response.status_code}):\n\n{error_msg}\n\nSpróbuj ponownie za chwilę.'
-            })
-            
-    except requests.exceptions.Timeout:
-        return jsonify({
-            'analiza': '⏱️ Przekroczono czas oczekiwania (60s).\n\nModel AI nie odpowiedział na czas. Spróbuj ponownie - czasem darmowy model jest wolniejszy.'
-        })
-    except requests.exceptions.RequestException as e:
-        return jsonify({
-            'analiza': f'🌐 Błąd połączenia z API:\n\n{str(e)}\n\nSprawdź połączenie internetowe i spróbuj ponownie.'
-        })
+        for fragment in fragmenty:
+            tekst.append(fragment)
+            yield asystent.zdarzenie_sse({'tekst': fragment})
+        blad = None
+    except asystent.BladModelu as e:
+        blad = e
+        yield asystent.zdarzenie_sse({'tekst': str(e)})
     except Exception as e:
+        blad = e
+        yield asystent.zdarzenie_sse({'tekst': f'❌ Wystąpił nieoczekiwany błąd:\n\n{str(e)}'})
+    finally:
+        # Także gdy przeglądarka zamknęła połączenie w trakcie (GeneratorExit)
+        if blad is None:
+            cache_analiz.zapisz(klucz, ''.join(tekst))
+        analizy_w_toku.zakoncz(klucz, ''.join(tekst), blad)
+    yield asystent.zdarzenie_sse({}, 'koniec')
+
+def wykonaj_analize(zadanie, klucz, prompt, referer):
+    """Wykonuje zadanie analizy w wątku kolejki i zapisuje wynik w ai_jobs"""
+    with app.app_context():
+        AiJob.start(zadanie)
+        try:
+            analiza = analiza_modelu(klucz, prompt, referer)
+        except asystent.BladModelu as e:
+            AiJob.finish(zadanie, str(e), status='error')
+        except Exception as e:
+            AiJob.finish(zadanie, f'❌ Wystąpił nieoczekiwany błąd:\n\n{str(e)}', status='error')
+        else:
+            AiJob.finish(zadanie, analiza)
+
+@app.route('/api/ai-analiza', methods=['POST'])
+@login_required
+def ai_analiza():
+    """Zgłasza analizę danych przez AI; wynik odbiera się z /api/ai-analiza/<zadanie>.
+    
+    Zapytanie do modelu trwa do minuty, więc wykonuje je pula wątków
+    kolejka_analiz, a żądanie od razu zwraca 202 z identyfikatorem zadania.
+    Z "strumien": true odpowiedź to text/event-stream z fragmentami tekstu
+    przekazywanymi na bieżąco z modelu (miejsce w limicie kolejki zajmuje
+    wtedy samo żądanie). Odpowiedzi niewymagające modelu (brak kursów, brak
+    klucza, analiza z cache_analiz) są zwracane od razu jako JSON.
+    """
+    data = request.json
+    typ = data.get('typ')
+    pytanie = data.get('pytanie', '')
+    
+    # Podsumowanie kursów użytkownika z kolumn historii (cache na wersję danych)
+    kolumny = kolumny_historii()
+    
+    if not len(kolumny):
         return jsonify({
-            'analiza': f'❌ Wystąpił nieoczekiwany błąd:\n\n{str(e)}'
+            'analiza': 'Nie masz jeszcze żadnych zapisanych kursów. Zacznij dodawać kursy w kalkulatorze, aby AI mogło przeanalizować Twoje dane.'
         })
+    
+    dane = dane_analizy(kolumny)
+    prompt = prompt_analizy(typ, pytanie, dane)
+    if prompt is None:
+        return jsonify({'analiza': 'Nieznany typ analizy'})
+    
+    if app.config["AI_BACKEND"] != "stub" and not os.environ.get('OPENROUTER_API_KEY'):
+        return jsonify({'analiza': asystent.BRAK_KLUCZA})
+    
+    klucz = klucz_analizy(typ, pytanie, dane)
+    analiza = cache_analiz.pobierz(klucz)
+    if analiza is not None:
+        return jsonify({'analiza': analiza})
+    
+    if data.get('strumien'):
+        if not kolejka_analiz.rezerwuj():
+            return jsonify({'analiza': asystent.KOLEJKA_PELNA}), 503, {'Retry-After': '10'}
+        odpowiedz = Response(stream_with_context(strumien_analizy(klucz, prompt, request.host_url)),
+                             content_type='text/event-stream; charset=utf-8',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+        odpowiedz.call_on_close(kolejka_analiz.zwolnij)
+        return odpowiedz
+    
+    zadanie = AiJob.create(current_user.id, typ)
+    if not kolejka_analiz.zglos(wykonaj_analize, zadanie, klucz, prompt, request.host_url):
+        AiJob.finish(zadanie, asystent.KOLEJKA_PELNA, status='error')
+        return jsonify({'analiza': asystent.KOLEJKA_PELNA}), 503, {'Retry-After': '10'}
+    
+    return jsonify({'zadanie': zadanie, 'status': 'queued'}), 202, \
+        {'Location': url_for('ai_analiza_wynik', zadanie=zadanie)}
+
+@app.route('/api/ai-analiza/statystyki')
+@login_required
+def ai_analiza_statystyki():
+    """Liczniki cache analiz AI, kolejki i klienta API w tym workerze"""
+    return jsonify({
+        'cache_trafienia': cache_analiz.trafienia,
+        'cache_chybienia': cache_analiz.chybienia,
+        'cache_wpisy': len(cache_analiz),
+        'polaczone_zapytania': analizy_w_toku.polaczone,
+        'zapytania_w_toku': analizy_w_toku.w_toku(),
+        'kolejka_zgloszone': kolejka_analiz.zgloszone(),
+        'kolejka_odrzucone': kolejka_analiz.odrzucone,
+        'api_ponowienia': klient_ai.ponowienia,
+        'api_bezpiecznik': klient_ai.bezpiecznik.stan(),
+        'api_odrzucone_przez_bezpiecznik': klient_ai.bezpiecznik.odrzucone
+    })
+
+@app.route('/api/sesja/statystyki')
+@login_required
+def sesja_statystyki():
+    """Trafienia cache zalogowanych użytkowników (user_loader) w tym workerze"""
+    zapytania = cache_uzytkownikow.trafienia + cache_uzytkownikow.chybienia
+    return jsonify({
+        'cache_trafienia': cache_uzytkownikow.trafienia,
+        'cache_chybienia': cache_uzytkownikow.chybienia,
+        'cache_procent_trafien': round(100 * cache_uzytkownikow.trafienia / zapytania, 1) if zapytania else None,
+        'cache_wpisy': len(cache_uzytkownikow)
+    })
+
+@app.route('/api/limity/statystyki')
+@login_required
+def limity_statystyki():
+    """Przepuszczone i odrzucone próby logowania, rejestracji i ponownej wysyłki w tym workerze"""
+    return jsonify({
+        'magazyn': app.config["RATE_LIMIT_BACKEND"],
+        'przepuszczone': dict(ogranicznik_prob.przepuszczone),
+        'odrzucone': dict(ogranicznik_prob.odrzucone),
+        'kubelki_w_pamieci': len(kubelki_limitu)
+    })
+
+@app.route('/api/ai-analiza/<zadanie>')
+@login_required
+def ai_analiza_wynik(zadanie):
+    """Stan zadania analizy AI (queued, running, done, error) i jej tekst po zakończeniu"""
+    job = AiJob.get(current_user.id, zadanie)
+    if job is None:
+        return jsonify({"error": "Nie znaleziono zadania"}), 404
+    
+    odpowiedz = {'zadanie': job.id, 'status': job.status}
+    if job.finished:
+        odpowiedz['analiza'] = job.result
+    elif datetime.datetime.utcnow() - job.created_at > AI_JOB_TIMEOUT:
+        # Worker wykonujący zadanie zakończył się przed zapisaniem wyniku
+        odpowiedz.update(status='error', analiza='⏱️ Analiza trwała zbyt długo. Spróbuj ponownie.')
+    return jsonify(odpowiedz)
+
+@app.cli.command('importuj-kursy')
+def importuj_kursy():
+    """Importuje pliki kursy.txt wszystkich użytkowników do tabeli rides."""
+    for user in User.query.order_by(User.id):
+        plik_path = f'{get_user_folder(user.id)}/kursy.txt'
+        zaimportowano = importuj_plik_kursow(user.id, plik_path)
+        if zaimportowano:
+            RideRollup.invalidate(user.id)
+            usun_segmenty_eksportu(user.id)
+            DataVersion.bump(user.id, snapshots=(None, None))
+        print(f"Użytkownik {user.id}: zaimportowano {zaimportowano} kursów")
+
+@app.cli.command('wyslij-poczte')
+def wyslij_poczte():
+    """Wysyła od razu zaległe wiadomości z email_outbox (np. po restarcie aplikacji)."""
+    wyslij_zalegle_emaile()
+    polaczenie_smtp.zamknij()
+    for status, liczba in db.session.query(EmailOutbox.status, db.func.count()).group_by(EmailOutbox.status):
+        print(f"{status}: {liczba}")
 
 @app.errorhandler(404)
 def not_found(e):
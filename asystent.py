@@ -0,0 +1,307 @@
+import email.utils
+import json
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+
+OPENROUTER_BASE_URL = "https://openrouter.ai/api/v1"
+MODEL = "qwen/qwen2.5-vl-72b-instruct:free"
+
+BRAK_KLUCZA = (
+    "⚠️ AI Asystent wymaga klucza API OpenRouter.\n\nAby skonfigurować:\n"
+    "1. Przejdź do zakładki Secrets (🔒)\n2. Dodaj nowy secret:\n"
+    "   - Key: OPENROUTER_API_KEY\n   - Value: Twój klucz z openrouter.ai\n\n"
+    "💡 Możesz uzyskać darmowy klucz na https://openrouter.ai"
+)
+KOLEJKA_PELNA = (
+    "⏳ Asystent analizuje teraz zbyt wiele zapytań. Spróbuj ponownie za chwilę."
+)
+
+
+class BladModelu(Exception):
+    """Nieudane zapytanie do modelu; treść to komunikat dla kierowcy."""
+
+
+# Odpowiedzi API, po których warto ponowić zapytanie
+STATUSY_DO_PONOWIENIA = {429, 500, 502, 503, 504}
+NIEDOSTEPNY = (
+    "🔌 Model AI jest chwilowo niedostępny (kilka nieudanych prób z rzędu).\n\n"
+    "Spróbuj ponownie za minutę."
+)
+
+
+class Bezpiecznik:
+    """Bezpiecznik (circuit breaker) dla zapytań do niedziałającego API.
+
+    Po prog_bledow kolejnych awariach (błąd sieci, 5xx) zapytania są od razu
+    odrzucane przez przerwa sekund. Potem przechodzi jedna próba: sukces
+    zamyka bezpiecznik, a kolejna awaria otwiera go na następną przerwę.
+    """
+
+    def __init__(self, prog_bledow, przerwa, zegar=time.monotonic):
+        self.prog_bledow = prog_bledow
+        self.przerwa = przerwa
+        self.odrzucone = 0
+        self._zegar = zegar
+        self._bledy = 0
+        self._otwarty_do = None
+        self._blokada = threading.Lock()
+
+    def przepusc(self):
+        """Czy wolno teraz wysłać zapytanie (w stanie półotwartym - tylko jedno)."""
+        with self._blokada:
+            if self._otwarty_do is None:
+                return True
+            if self._zegar() >= self._otwarty_do:
+                # Próba: kolejne zapytania czekają na jej wynik jak przy otwartym
+                self._otwarty_do = self._zegar() + self.przerwa
+                return True
+            self.odrzucone += 1
+            return False
+
+    def sukces(self):
+        with self._blokada:
+            self._bledy = 0
+            self._otwarty_do = None
+
+    def awaria(self):
+        with self._blokada:
+            self._bledy += 1
+            if self._bledy >= self.prog_bledow:
+                self._otwarty_do = self._zegar() + self.przerwa
+
+    def stan(self):
+        """closed, open albo half-open (przerwa minęła, następne zapytanie to próba)."""
+        with self._blokada:
+            if self._otwarty_do is None:
+                return "closed"
+            return "open" if self._zegar() < self._otwarty_do else "half-open"
+
+
+def opoznienie_ponowienia(response, proba, baza, maks):
+    """Sekundy przed ponowieniem: Retry-After z odpowiedzi (sekundy albo data HTTP)
+    lub losowe opóźnienie z zakresu [0, baza * 2^proba], najwyżej maks (full jitter)."""
+    naglowek = response.headers.get("Retry-After") if response is not None else None
+    if naglowek:
+        try:
+            return max(0.0, float(naglowek))
+        except ValueError:
+            try:
+                termin = email.utils.parsedate_to_datetime(naglowek)
+                return max(0.0, termin.timestamp() - time.time())
+            except (TypeError, ValueError):
+                pass
+    return random.uniform(0, min(maks, baza * 2 ** proba))
+
+
+class KlientOpenRouter:
+    """Klient API zgodnego z OpenAI (/chat/completions) współdzielony przez wątki workera.
+
+    Jedna sesja requests trzyma pulę do rozmiar_puli połączeń keep-alive, więc
+    kolejne zapytania nie powtarzają nawiązywania TCP i TLS. Odpowiedzi 429
+    i 5xx oraz błędy połączenia są ponawiane do proby razy z opóźnieniem
+    z opoznienie_ponowienia(); Retry-After dłuższe niż maks_opoznienie kończy
+    próby od razu. timeout to para (połączenie, odczyt) w sekundach, a odczyt
+    w strumieniu liczy się między kolejnymi porcjami danych. Błąd zgłasza
+    BladModelu z komunikatem dla kierowcy.
+    """
+
+    def __init__(self, adres, rozmiar_puli=10, proby=3, timeout=(5, 60), opoznienie=0.5,
+                 maks_opoznienie=10, prog_bledow=5, przerwa=30):
+        self.adres = adres.rstrip("/")
+        self.proby = proby
+        self.timeout = timeout
+        self.opoznienie = opoznienie
+        self.maks_opoznienie = maks_opoznienie
+        self.bezpiecznik = Bezpiecznik(prog_bledow, przerwa)
+        self.ponowienia = 0
+        self.sesja = requests.Session()
+        adapter = requests.adapters.HTTPAdapter(pool_connections=1, pool_maxsize=rozmiar_puli)
+        self.sesja.mount("https://", adapter)
+        self.sesja.mount("http://", adapter)
+
+    def zapytaj(self, prompt, api_key, referer):
+        """Cała odpowiedź modelu."""
+        response = self._wyslij(prompt, api_key, referer, strumien=False)
+        try:
+            return response.json()["choices"][0]["message"]["content"]
+        except requests.exceptions.RequestException as e:
+            raise BladModelu(self._blad_polaczenia(e))
+
+    def strumien(self, prompt, api_key, referer):
+        """Generator kolejnych fragmentów odpowiedzi modelu (stream=true).
+
+        API wysyła zdarzenia SSE "data: {json}" z fragmentem w choices[0].delta.content
+        i kończy je "data: [DONE]"; linie komentarzy (":") są pomijane. Ponawiane
+        jest tylko zapytanie przed pierwszym fragmentem.
+        """
+        response = self._wyslij(prompt, api_key, referer, strumien=True)
+        # Strumień SSE jest zawsze w UTF-8, także bez charset w Content-Type
+        response.encoding = "utf-8"
+        try:
+            with response:
+                for linia in response.iter_lines(decode_unicode=True):
+                    if not linia or not linia.startswith("data:"):
+                        continue
+                    dane = linia[5:].strip()
+                    if dane == "[DONE]":
+                        return
+                    fragment = json.loads(dane)["choices"][0].get("delta", {}).get("content")
+                    if fragment:
+                        yield fragment
+        except requests.exceptions.RequestException as e:
+            raise BladModelu(self._blad_polaczenia(e))
+
+    def _wyslij(self, prompt, api_key, referer, strumien):
+        """Odpowiedź 200 na zapytanie, po ewentualnych ponowieniach."""
+        for proba in range(self.proby):
+            if not self.bezpiecznik.przepusc():
+                raise BladModelu(NIEDOSTEPNY)
+            response = None
+            try:
+                response = self.sesja.post(
+                    f"{self.adres}/chat/completions",
+                    headers={
+                        "Authorization": f"Bearer {api_key}",
+                        "Content-Type": "application/json",
+                        "HTTP-Referer": referer,
+                    },
+                    json={
+                        "model": MODEL,
+                        "messages": [{"role": "user", "content": prompt}],
+                        "max_tokens": 500,
+                        "temperature": 0.7,
+                        "stream": strumien,
+                    },
+                    timeout=self.timeout,
+                    stream=strumien,
+                )
+            except (requests.exceptions.ConnectionError, requests.exceptions.Timeout) as e:
+                self.bezpiecznik.awaria()
+                # Odczyt przekroczył limit: model nie zdążył, ponowienie zajęłoby drugie tyle
+                if isinstance(e, requests.exceptions.ReadTimeout) or proba + 1 == self.proby:
+                    raise BladModelu(self._blad_polaczenia(e))
+            except requests.exceptions.RequestException as e:
+                raise BladModelu(self._blad_polaczenia(e))
+            else:
+                if response.status_code == 200:
+                    self.bezpiecznik.sukces()
+                    return response
+                if response.status_code >= 500:
+                    self.bezpiecznik.awaria()
+                else:
+                    # 4xx: API działa, problem dotyczy zapytania lub limitu
+                    self.bezpiecznik.sukces()
+                if response.status_code not in STATUSY_DO_PONOWIENIA or proba + 1 == self.proby:
+                    raise BladModelu(self._blad_api(response))
+
+            czekaj = opoznienie_ponowienia(response, proba, self.opoznienie, self.maks_opoznienie)
+            if czekaj > self.maks_opoznienie:
+                raise BladModelu(self._blad_api(response))
+            if response is not None:
+                response.close()
+            self.ponowienia += 1
+            time.sleep(czekaj)
+
+    def _blad_polaczenia(self, e):
+        if isinstance(e, requests.exceptions.Timeout):
+            return (f"⏱️ Przekroczono czas oczekiwania ({self.timeout[1]:g}s).\n\nModel AI nie odpowiedział na czas. "
+                    "Spróbuj ponownie - czasem darmowy model jest wolniejszy.")
+        return f"🌐 Błąd połączenia z API:\n\n{str(e)}\n\nSprawdź połączenie internetowe i spróbuj ponownie."
+
+    @staticmethod
+    def _blad_api(response):
+        if response.status_code == 429:
+            return ("⏳ Model AI jest teraz zajęty. Spróbuj ponownie za chwilę.\n\n"
+                    "💡 Darmowy model ma limity zapytań. Poczekaj 1-2 minuty i spróbuj ponownie.")
+        if response.status_code == 401:
+            return "🔑 Błąd autoryzacji. Sprawdź czy klucz API w Secrets jest prawidłowy."
+        error_msg = response.text if response.text else "Nieznany błąd"
+        return f"⚠️ API zwróciło błąd ({response.status_code}):\n\n{error_msg}\n\nSpróbuj ponownie za chwilę."
+
+
+def _tekst_testowy(prompt):
+    return (f"🧪 Odpowiedź testowa (AI_BACKEND=stub) na prompt o długości {len(prompt)} znaków.\n\n"
+            "1. Jeździj w godzinach z najwyższą stawką.\n2. Unikaj długich dojazdów.\n"
+            "3. Porównuj platformy co tydzień.")
+
+
+def odpowiedz_testowa(prompt, opoznienie):
+    """Lokalny zastępczy model do testów obciążenia bez sieci i limitów API.
+
+    Czeka opoznienie sekund (jak wolne API) i zwraca stały tekst z długością promptu.
+    """
+    time.sleep(opoznienie)
+    return _tekst_testowy(prompt)
+
+
+def strumien_testowy(prompt, opoznienie):
+    """Odpowiedź odpowiedz_testowa() podawana słowo po słowie w ciągu opoznienie sekund."""
+    slowa = _tekst_testowy(prompt).split(" ")
+    for numer, slowo in enumerate(slowa):
+        time.sleep(opoznienie / len(slowa))
+        yield slowo if numer == 0 else " " + slowo
+
+
+def zdarzenie_sse(dane, nazwa=None):
+    """Zdarzenie Server-Sent Events z danymi w JSON."""
+    naglowek = f"event: {nazwa}\n" if nazwa else ""
+    return f"{naglowek}data: {json.dumps(dane, ensure_ascii=False)}\n\n"
+
+
+class KolejkaAnaliz:
+    """Pula wątków wykonująca analizy AI poza wątkiem obsługującym żądanie.
+
+    Naraz działa najwyżej liczba_watkow analiz, a najwyżej limit_kolejki
+    kolejnych czeka na wolny wątek. Zgłoszenie ponad ten limit jest od razu
+    odrzucane, więc zawieszone API nie gromadzi zadań bez końca. Wątki
+    startują przy pierwszym zgłoszeniu, już w procesie workera.
+    """
+
+    def __init__(self, liczba_watkow, limit_kolejki):
+        self.liczba_watkow = liczba_watkow
+        self.limit = liczba_watkow + limit_kolejki
+        self.odrzucone = 0
+        self._zgloszone = 0
+        self._blokada = threading.Lock()
+        self._pula = ThreadPoolExecutor(max_workers=liczba_watkow, thread_name_prefix="analiza-ai")
+
+    def zglos(self, zadanie, *argumenty):
+        """Przekazuje zadanie do puli; zwraca False, gdy kolejka jest pełna."""
+        if not self.rezerwuj():
+            return False
+        self._pula.submit(self._wykonaj, zadanie, argumenty)
+        return True
+
+    def rezerwuj(self):
+        """Zajmuje miejsce w limicie dla analizy wykonywanej poza pulą (strumieniowanej w żądaniu).
+
+        Zwraca False, gdy limit jest wyczerpany; zajęte miejsce zwalnia zwolnij().
+        """
+        with self._blokada:
+            if self._zgloszone >= self.limit:
+                self.odrzucone += 1
+                return False
+            self._zgloszone += 1
+            return True
+
+    def zwolnij(self):
+        with self._blokada:
+            self._zgloszone -= 1
+
+    def zgloszone(self):
+        """Liczba analiz wykonywanych i czekających w kolejce."""
+        with self._blokada:
+            return self._zgloszone
+
+    def _wykonaj(self, zadanie, argumenty):
+        try:
+            zadanie(*argumenty)
+        except Exception as e:
+            print(f"Analiza AI w tle nie powiodła się: {str(e)}")
+        finally:
+            self.zwolnij()
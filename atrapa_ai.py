@@ -0,0 +1,119 @@
+"""Lokalna atrapa API zgodnego z OpenAI (/chat/completions) do testów asystenta AI.
+
+Odpowiada stałym tekstem, także w trybie stream=true (zdarzenia SSE
+"data: {...}" zakończone "data: [DONE]"), z opóźnieniem przed pierwszym
+fragmentem i między fragmentami, jak prawdziwy model. Nie wymaga klucza API:
+
+    python atrapa_ai.py [port] [ms_do_pierwszego_fragmentu] [ms_miedzy_fragmentami]
+    OPENROUTER_BASE_URL=http://127.0.0.1:8089 OPENROUTER_API_KEY=test gunicorn ... main:app
+
+Awarie do testów ponawiania i bezpiecznika: adres bazowy z prefiksem
+/awaria/<status>/<ile> (np. http://127.0.0.1:8089/awaria/503/2) sprawia, że
+pierwsze <ile> zapytań pod tym prefiksem dostaje <status> z Retry-After: 1
+(ile=0 oznacza zawsze).
+"""
+import json
+import sys
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+ODPOWIEDZ = (
+    "**Analiza testowa** z lokalnej atrapy API.\n\n"
+    "1. Najlepiej zarabiasz w godzinach szczytu.\n"
+    "2. Ogranicz dojazdy dłuższe niż 5 km.\n"
+    "3. Porównuj stawki platform co tydzień."
+)
+
+
+class Atrapa(BaseHTTPRequestHandler):
+    # Keep-alive jak w prawdziwym API (strumień kończy się zamknięciem połączenia)
+    protocol_version = "HTTP/1.1"
+    pierwszy_fragment = 0.3
+    miedzy_fragmentami = 0.03
+    # Liczba zapytań pod każdym prefiksem /awaria/<status>/<ile>
+    zapytania_awarii = {}
+    blokada = threading.Lock()
+
+    def do_POST(self):
+        if not self.path.endswith("/chat/completions"):
+            self.send_error(404)
+            return
+        dlugosc = int(self.headers.get("Content-Length") or 0)
+        zapytanie = json.loads(self.rfile.read(dlugosc) or b"{}")
+        if self._awaria():
+            return
+        time.sleep(self.pierwszy_fragment)
+        if zapytanie.get("stream"):
+            self._strumien(zapytanie.get("model"))
+        else:
+            self._odpowiedz(200, {"model": zapytanie.get("model"), "choices": [
+                {"index": 0, "message": {"role": "assistant", "content": ODPOWIEDZ}, "finish_reason": "stop"}
+            ]})
+
+    def _awaria(self):
+        czesci = self.path.strip("/").split("/")
+        if len(czesci) < 3 or czesci[0] != "awaria":
+            return False
+        prefiks = "/".join(czesci[:3])
+        with self.blokada:
+            numer = self.zapytania_awarii[prefiks] = self.zapytania_awarii.get(prefiks, 0) + 1
+        ile = int(czesci[2])
+        if ile and numer > ile:
+            return False
+        tresc = json.dumps({"error": {"code": int(czesci[1]), "message": "Awaria testowa"}}).encode("utf-8")
+        self.send_response(int(czesci[1]))
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(tresc)))
+        self.send_header("Retry-After", "1")
+        self.end_headers()
+        self.wfile.write(tresc)
+        return True
+
+    def _odpowiedz(self, status, dane):
+        tresc = json.dumps(dane, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(tresc)))
+        self.end_headers()
+        self.wfile.write(tresc)
+
+    def _strumien(self, model):
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Cache-Control", "no-cache")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        self.close_connection = True
+        self._zdarzenie(": OPENROUTER PROCESSING")
+        slowa = ODPOWIEDZ.split(" ")
+        for numer, slowo in enumerate(slowa):
+            if numer:
+                time.sleep(self.miedzy_fragmentami)
+            fragment = slowo if numer == 0 else " " + slowo
+            self._zdarzenie("data: " + json.dumps({"model": model, "choices": [
+                {"index": 0, "delta": {"content": fragment}, "finish_reason": None}
+            ]}, ensure_ascii=False))
+        self._zdarzenie("data: [DONE]")
+
+    def _zdarzenie(self, linia):
+        self.wfile.write(f"{linia}\n\n".encode("utf-8"))
+        self.wfile.flush()
+
+    def log_message(self, format, *args):
+        pass
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 8089
+    if len(sys.argv) > 2:
+        Atrapa.pierwszy_fragment = int(sys.argv[2]) / 1000
+    if len(sys.argv) > 3:
+        Atrapa.miedzy_fragmentami = int(sys.argv[3]) / 1000
+    serwer = ThreadingHTTPServer(("127.0.0.1", port), Atrapa)
+    print(f"Atrapa API na http://127.0.0.1:{port} (OPENROUTER_BASE_URL)")
+    serwer.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
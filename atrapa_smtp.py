@@ -0,0 +1,69 @@
+"""Lokalny serwer SMTP do testów wysyłki poczty: przyjmuje każdą wiadomość i wypisuje ją.
+
+Nie obsługuje STARTTLS ani logowania, więc aplikację uruchamia się z:
+
+    python atrapa_smtp.py [port]
+    SMTP_SERVER=127.0.0.1 SMTP_PORT=1025 SMTP_STARTTLS=0 gunicorn ... main:app
+
+Z drugim argumentem (np. 451 albo 550) odpowiada tym kodem na każdą wiadomość,
+do testów ponawiania wysyłki.
+"""
+import socketserver
+import sys
+
+
+class Atrapa(socketserver.StreamRequestHandler):
+    kod_odpowiedzi = None
+    wiadomosci = 0
+
+    def _odpowiedz(self, linia):
+        self.wfile.write(f"{linia}\r\n".encode("ascii"))
+
+    def handle(self):
+        self._odpowiedz("220 atrapa-smtp gotowa")
+        polaczenie = self.client_address[1]
+        while True:
+            linia = self.rfile.readline()
+            if not linia:
+                return
+            polecenie = linia.decode("utf-8", "replace").strip()
+            nazwa = polecenie[:4].upper()
+            if nazwa == "EHLO":
+                self._odpowiedz("250-atrapa-smtp")
+                self._odpowiedz("250 8BITMIME")
+            elif nazwa in ("HELO", "MAIL", "RCPT", "RSET", "NOOP"):
+                self._odpowiedz("250 OK")
+            elif nazwa == "DATA":
+                self._odpowiedz("354 End data with <CR><LF>.<CR><LF>")
+                tresc = []
+                for linia in self.rfile:
+                    if linia in (b".\r\n", b".\n"):
+                        break
+                    tresc.append(linia.decode("utf-8", "replace"))
+                if self.kod_odpowiedzi:
+                    self._odpowiedz(f"{self.kod_odpowiedzi} Atrapa odrzuca wiadomosc")
+                    continue
+                Atrapa.wiadomosci += 1
+                naglowki = [t.strip() for t in tresc if t.startswith(("To:", "Subject:"))]
+                print(f"[połączenie :{polaczenie}] wiadomość {Atrapa.wiadomosci}: {' | '.join(naglowki)}", flush=True)
+                self._odpowiedz("250 OK")
+            elif nazwa == "QUIT":
+                self._odpowiedz("221 Bye")
+                return
+            else:
+                self._odpowiedz("502 Command not implemented")
+
+
+def main():
+    port = int(sys.argv[1]) if len(sys.argv) > 1 else 1025
+    if len(sys.argv) > 2:
+        Atrapa.kod_odpowiedzi = int(sys.argv[2])
+    socketserver.ThreadingTCPServer.allow_reuse_address = True
+    serwer = socketserver.ThreadingTCPServer(("127.0.0.1", port), Atrapa)
+    serwer.daemon_threads = True
+    print(f"Atrapa SMTP na 127.0.0.1:{port} (SMTP_STARTTLS=0)")
+    serwer.serve_forever()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,174 @@
+"""Pomiar czasu CPU na żądanie dla endpointów ze statystykami i wykresami.
+
+Tworzy tymczasowego użytkownika z syntetyczną historią kursów, mierzy medianę
+czasu procesora (time.process_time) każdego endpointu i sprząta po sobie.
+Czas jest podawany osobno dla liczenia od zera (pusty cache odpowiedzi i kolumn),
+odpowiedzi z cache i rewalidacji zakończonej 304. Druga tabela porównuje na tych
+samych danych wykresów budowanie go.Figure z podwójną serializacją (przed) ze
+zwykłymi słownikami wykresy.wykres() (po).
+Wymaga tych samych zmiennych środowiskowych co aplikacja (SESSION_SECRET,
+DATABASE_URL, opcjonalnie RIDES_STORAGE):
+
+    python benchmark.py [liczba_kursow] [powtorzenia] > bench_output.txt
+"""
+import datetime
+import json
+import random
+import shutil
+import statistics
+import sys
+import time
+import uuid
+
+import app as aplikacja
+import wykresy
+from app import app
+from database import db, User, Ride, RideRollup, RideRollupStatus, get_user_folder
+from kursy import Kurs
+
+ENDPOINTY = [
+    '/api/historia',
+    '/dane_statystyk',
+    '/statystyki_platform',
+    '/api/prognoza',
+    '/api/heatmap_rentownosci',
+    '/api/dashboard?sections=statystyki,heatmapa',
+]
+
+
+def generuj_kursy(liczba, seed=1):
+    """Syntetyczne kursy w równych odstępach, kończące się teraz."""
+    losowe = random.Random(seed)
+    czas = datetime.datetime.now().replace(microsecond=0) - datetime.timedelta(minutes=40 * liczba)
+    for _ in range(liczba):
+        czas += datetime.timedelta(minutes=losowe.randint(10, 70))
+        dystans_dojazdu, dystans_kursu = losowe.uniform(0.5, 5), losowe.uniform(2, 25)
+        czas_dojazdu, czas_kursu = losowe.randint(2, 12), losowe.randint(5, 45)
+        kwota, procent = losowe.uniform(15, 120), losowe.choice([75, 80, 85])
+        koszt_paliwa = (dystans_dojazdu + dystans_kursu) * 7.0 / 100 * 6.5
+        zysk = kwota * procent / 100 - koszt_paliwa
+        stawka = zysk / ((czas_dojazdu + czas_kursu) / 60)
+        yield Kurs(czas.strftime("%Y-%m-%d %H:%M:%S"), losowe.choice(['Uber', 'Bolt', 'FreeNow']),
+                   dystans_dojazdu, czas_dojazdu, dystans_kursu, czas_kursu, kwota, procent,
+                   koszt_paliwa, zysk, stawka, losowe.random() < 0.3, "👍 Kurs opłacalny.")
+
+
+def zapisz_historie(user_id, kursy):
+    """Zapisuje historię w magazynie wybranym przez RIDES_STORAGE."""
+    if app.config["RIDES_STORAGE"] == "baza":
+        db.session.add_all(Ride.from_kurs(user_id, kurs) for kurs in kursy)
+        db.session.commit()
+        return
+    with open(f'{get_user_folder(user_id)}/kursy.txt', "w", encoding="utf-8") as plik:
+        for kurs in kursy:
+            plik.write(f"\n[{kurs.data_czas}]\n")
+            for klucz, wartosc in kurs.pola_tekstowe().items():
+                plik.write(f"{klucz}: {wartosc}\n")
+            plik.write("-" * 40 + "\n")
+
+
+def _mediana_ms(zadanie, powtorzenia, przed=None):
+    czasy = []
+    for _ in range(powtorzenia):
+        if przed:
+            przed()
+        start = time.process_time()
+        zadanie()
+        czasy.append((time.process_time() - start) * 1000)
+    return statistics.median(czasy)
+
+
+def wyczysc_cache():
+    """Czyści gotowe odpowiedzi i kolumny historii; sparsowany plik kursów zostaje."""
+    aplikacja.cache_odpowiedzi.wyczysc()
+    aplikacja.cache_kolumn.wyczysc()
+
+
+def zmierz(klient, url, powtorzenia):
+    """Zwraca (ms bez cache, ms z cache, ms dla 304, rozmiar odpowiedzi w bajtach)."""
+    odpowiedz = klient.get(url)
+    etag = odpowiedz.headers.get('ETag')
+    bez_cache = _mediana_ms(lambda: klient.get(url), powtorzenia, wyczysc_cache)
+    z_cache = _mediana_ms(lambda: klient.get(url), powtorzenia)
+    niezmienione = _mediana_ms(lambda: klient.get(url, headers={'If-None-Match': etag}), powtorzenia)
+    return bez_cache, z_cache, niezmienione, len(odpowiedz.data)
+
+
+def zbierz_wykresy(klient, url):
+    """Wywołania wykres(typ, *dane) wykonane przez endpoint liczony od zera."""
+    wywolania = []
+    oryginal = wykresy.wykres
+
+    def zapisz(typ, *dane):
+        wywolania.append((typ, dane))
+        return oryginal(typ, *dane)
+
+    wykresy.wykres = zapisz
+    try:
+        wyczysc_cache()
+        klient.get(url)
+    finally:
+        wykresy.wykres = oryginal
+    return wywolania
+
+
+def figura_plotly(typ, *dane):
+    """Wykres jak przed słownikami: go.Figure z walidacją, potem json.loads(json.dumps(fig))."""
+    import plotly.graph_objects as go
+    import plotly.utils
+    definicja = wykresy.WYKRESY[typ]
+    fig = go.Figure(data=definicja["slady"])
+    for slad, kolumny in zip(fig.data, dane):
+        slad.update(kolumny)
+    fig.update_layout(definicja["uklad"], template='plotly_white')
+    return json.loads(json.dumps(fig, cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def porownaj_wykresy(wywolania, powtorzenia):
+    """Zwraca (ms go.Figure, ms słowniki, czy wynik identyczny) dla wykresów jednego endpointu."""
+    przed = _mediana_ms(lambda: [json.dumps(figura_plotly(typ, *dane)) for typ, dane in wywolania], powtorzenia)
+    po = _mediana_ms(lambda: [json.dumps(wykresy.wykres(typ, *dane)) for typ, dane in wywolania], powtorzenia)
+    identyczne = all(figura_plotly(typ, *dane) == wykresy.wykres(typ, *dane) for typ, dane in wywolania)
+    return przed, po, identyczne
+
+
+def main():
+    liczba_kursow = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    powtorzenia = int(sys.argv[2]) if len(sys.argv) > 2 else 20
+
+    with app.app_context():
+        user = User.create(f"benchmark-{uuid.uuid4().hex}@example.com", uuid.uuid4().hex)
+        user_id = user.id
+        try:
+            zapisz_historie(user_id, list(generuj_kursy(liczba_kursow)))
+
+            klient = app.test_client()
+            with klient.session_transaction() as sesja:
+                sesja['_user_id'] = str(user_id)
+                sesja['_fresh'] = True
+
+            print(f"Kursów: {liczba_kursow}, powtórzeń: {powtorzenia}, magazyn: {app.config['RIDES_STORAGE']}")
+            print(f"{'endpoint':50} {'bez cache':>10} {'z cache':>10} {'304':>10} {'rozmiar':>10}")
+            for url in ENDPOINTY:
+                bez_cache, z_cache, niezmienione, bajty = zmierz(klient, url, powtorzenia)
+                print(f"{url:50} {bez_cache:7.1f} ms {z_cache:7.1f} ms {niezmienione:7.1f} ms {bajty:8d} B")
+
+            print()
+            print(f"{'wykresy endpointu':50} {'go.Figure':>10} {'słowniki':>10} {'identyczne':>10}")
+            for url in ENDPOINTY:
+                wywolania = zbierz_wykresy(klient, url)
+                if wywolania:
+                    przed, po, identyczne = porownaj_wykresy(wywolania, powtorzenia)
+                    print(f"{url:50} {przed:7.1f} ms {po:7.1f} ms {'tak' if identyczne else 'NIE':>10}")
+        finally:
+            db.session.rollback()
+            Ride.query.filter_by(user_id=user_id).delete()
+            RideRollup.query.filter_by(user_id=user_id).delete()
+            RideRollupStatus.query.filter_by(user_id=user_id).delete()
+            User.query.filter_by(id=user_id).delete()
+            db.session.commit()
+            shutil.rmtree(get_user_folder(user_id), ignore_errors=True)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,9 +1,12 @@
 import os
 import secrets
+import datetime
 from flask_sqlalchemy import SQLAlchemy
 from flask_login import UserMixin
 from werkzeug.security import generate_password_hash, check_password_hash
+from sqlalchemy.exc import IntegrityError
 from sqlalchemy.orm import DeclarativeBase
+from kursy import Kurs, czytaj_plik_kursow
 
 class Base(DeclarativeBase):
     pass
@@ -25,6 +28,12 @@ class User(UserMixin, db.Model):
         """Pobiera użytkownika po ID"""
         return User.query.get(int(user_id))
     
+    @staticmethod
+    def get_identity(user_id):
+        """Pobiera tylko id, email i stan weryfikacji jako UserIdentity (bez obiektu sesji) albo None"""
+        wiersz = db.session.query(User.id, User.email, User.email_verified).filter_by(id=int(user_id)).first()
+        return UserIdentity(*wiersz) if wiersz else None
+    
     @staticmethod
     def get_by_email(email):
         """Pobiera użytkownika po email"""
@@ -85,6 +94,725 @@ class User(UserMixin, db.Model):
         """Pobiera użytkownika po tokenie weryfikacyjnym"""
         return User.query.filter_by(verification_token=token).first()
 
+class UserIdentity(UserMixin):
+    """Lekka, niezwiązana z sesją bazy kopia użytkownika dla Flask-Login (current_user)"""
+    def __init__(self, id, email, email_verified):
+        self.id = id
+        self.email = email
+        self.email_verified = email_verified
+
+class Ride(db.Model):
+    __tablename__ = 'rides'
+    __table_args__ = (
+        db.Index('ix_rides_user_id_timestamp', 'user_id', 'timestamp'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False)
+    timestamp = db.Column(db.DateTime, nullable=False)
+    platform = db.Column(db.String(50), nullable=True)
+    pickup_km = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    pickup_min = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    ride_km = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    ride_min = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    amount = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    driver_percent = db.Column(db.Numeric(5, 2, asdecimal=False), nullable=False, default=0)
+    fuel_cost = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    net_profit = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    hourly_rate = db.Column(db.Numeric(10, 2, asdecimal=False), nullable=False, default=0)
+    cash = db.Column(db.Boolean, default=False, nullable=False)
+    rating = db.Column(db.String(100), nullable=True)
+    
+    @staticmethod
+    def from_kurs(user_id, kurs):
+        """Tworzy wiersz tabeli z rekordu kursu"""
+        return Ride(
+            user_id=user_id,
+            timestamp=datetime.datetime.fromisoformat(kurs.data_czas),
+            platform=kurs.platforma,
+            pickup_km=round(kurs.dystans_dojazdu, 2),
+            pickup_min=round(kurs.czas_dojazdu, 2),
+            ride_km=round(kurs.dystans_kursu, 2),
+            ride_min=round(kurs.czas_kursu, 2),
+            amount=round(kurs.kwota, 2),
+            driver_percent=round(kurs.procent, 2),
+            fuel_cost=round(kurs.koszt_paliwa, 2),
+            net_profit=round(kurs.zysk, 2),
+            hourly_rate=round(kurs.stawka, 2),
+            cash=kurs.gotowka,
+            rating=kurs.ocena
+        )
+    
+    @staticmethod
+    def add(user_id, kursy, batch_id=None):
+        """Zapisuje kursy użytkownika razem z agregatami w jednej transakcji
+        
+        Z batch_id w tej samej transakcji zapisywana jest najpierw paczka (RideBatch);
+        jeśli ta paczka już istnieje, nic nie jest zapisywane i zwracane jest False.
+        """
+        try:
+            if batch_id is not None:
+                try:
+                    db.session.add(RideBatch(user_id=user_id, batch_id=batch_id, rides=len(kursy)))
+                    db.session.flush()
+                except IntegrityError:
+                    db.session.rollback()
+                    return False
+            db.session.add_all(Ride.from_kurs(user_id, kurs) for kurs in kursy)
+            RideRollup.record(user_id, kursy)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+    
+    @staticmethod
+    def _kurs_columns():
+        return (
+            Ride.timestamp, Ride.platform, Ride.pickup_km, Ride.pickup_min,
+            Ride.ride_km, Ride.ride_min, Ride.amount, Ride.driver_percent,
+            Ride.fuel_cost, Ride.net_profit, Ride.hourly_rate, Ride.cash, Ride.rating
+        )
+    
+    @staticmethod
+    def _in_range(query, od, do):
+        if od is not None:
+            query = query.filter(Ride.timestamp >= datetime.datetime.fromisoformat(od))
+        if do is not None:
+            query = query.filter(Ride.timestamp < datetime.datetime.fromisoformat(do))
+        return query
+    
+    @staticmethod
+    def iter_for_user(user_id, od=None, do=None):
+        """Zwraca kursy użytkownika chronologicznie, opcjonalnie z zakresu [od, do)"""
+        query = db.session.query(*Ride._kurs_columns()).filter(Ride.user_id == user_id)
+        query = Ride._in_range(query, od, do)
+        
+        for wiersz in query.order_by(Ride.timestamp, Ride.id).yield_per(1000):
+            yield Kurs(str(wiersz[0])[:19], *wiersz[1:])
+    
+    @staticmethod
+    def page_for_user(user_id, limit, before=None, od=None, do=None, platform=None,
+                      cash=None, min_profit=None, max_profit=None):
+        """Zwraca do limit par (id, kurs) od najnowszych, starszych niż kursor before=(timestamp, id)
+        
+        Platforma None w bazie odpowiada nazwie 'Nieznana', tak jak w agregatach.
+        """
+        query = db.session.query(Ride.id, *Ride._kurs_columns()).filter(Ride.user_id == user_id)
+        query = Ride._in_range(query, od, do)
+        if before is not None:
+            timestamp = datetime.datetime.fromisoformat(before[0])
+            query = query.filter(db.or_(
+                Ride.timestamp < timestamp,
+                db.and_(Ride.timestamp == timestamp, Ride.id < before[1])
+            ))
+        if platform is not None:
+            query = query.filter(db.func.coalesce(Ride.platform, 'Nieznana') == platform)
+        if cash is not None:
+            query = query.filter(Ride.cash == cash)
+        if min_profit is not None:
+            query = query.filter(Ride.net_profit >= min_profit)
+        if max_profit is not None:
+            query = query.filter(Ride.net_profit <= max_profit)
+        
+        wiersze = query.order_by(Ride.timestamp.desc(), Ride.id.desc()).limit(limit).all()
+        return [(wiersz[0], Kurs(str(wiersz[1])[:19], *wiersz[2:])) for wiersz in wiersze]
+    
+    @staticmethod
+    def totals(user_id):
+        """Zwraca sumy z całej historii kursów użytkownika"""
+        wiersz = db.session.query(
+            db.func.count(Ride.id),
+            db.func.sum(Ride.amount),
+            db.func.sum(Ride.net_profit),
+            db.func.sum(Ride.hourly_rate),
+            db.func.sum(Ride.pickup_km + Ride.ride_km),
+            db.func.sum(Ride.fuel_cost)
+        ).filter(Ride.user_id == user_id).one()
+        return {
+            "liczba": wiersz[0],
+            "suma_kwot": float(wiersz[1] or 0),
+            "suma_zysku": float(wiersz[2] or 0),
+            "suma_stawek": float(wiersz[3] or 0),
+            "suma_km": float(wiersz[4] or 0),
+            "suma_paliwa": float(wiersz[5] or 0)
+        }
+
+class RideRollup(db.Model):
+    """Sumy kursów użytkownika w kubełkach (dzień, godzina, platforma, gotówka)"""
+    __tablename__ = 'ride_rollups'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    day = db.Column(db.Date, primary_key=True)
+    hour = db.Column(db.SmallInteger, primary_key=True)
+    platform = db.Column(db.String(50), primary_key=True)
+    cash = db.Column(db.Boolean, primary_key=True)
+    rides = db.Column(db.Integer, default=0, nullable=False)
+    profit_sum = db.Column(db.Float, default=0, nullable=False)
+    profit_sq = db.Column(db.Float, default=0, nullable=False)
+    rate_sum = db.Column(db.Float, default=0, nullable=False)
+    rate_sq = db.Column(db.Float, default=0, nullable=False)
+    km_sum = db.Column(db.Float, default=0, nullable=False)
+    km_sq = db.Column(db.Float, default=0, nullable=False)
+    fuel_sum = db.Column(db.Float, default=0, nullable=False)
+    fuel_sq = db.Column(db.Float, default=0, nullable=False)
+    
+    @staticmethod
+    def _bucket(user_id, kurs):
+        return {
+            'user_id': user_id,
+            'day': datetime.date.fromisoformat(kurs.data),
+            'hour': kurs.godzina,
+            'platform': kurs.platforma or 'Nieznana',
+            'cash': kurs.gotowka
+        }
+    
+    @staticmethod
+    def _values(kurs):
+        zysk = round(kurs.zysk, 2)
+        stawka = round(kurs.stawka, 2)
+        km = round(kurs.dystans, 2)
+        paliwo = round(kurs.koszt_paliwa, 2)
+        return {
+            'rides': 1,
+            'profit_sum': zysk, 'profit_sq': zysk * zysk,
+            'rate_sum': stawka, 'rate_sq': stawka * stawka,
+            'km_sum': km, 'km_sq': km * km,
+            'fuel_sum': paliwo, 'fuel_sq': paliwo * paliwo
+        }
+    
+    @staticmethod
+    def _sum_buckets(user_id, kursy):
+        """Sumuje kursy w kubełkach; zwraca listę par (kubełek, sumy)"""
+        buckets = {}
+        for kurs in kursy:
+            bucket = RideRollup._bucket(user_id, kurs)
+            klucz = tuple(bucket.values())
+            values = RideRollup._values(kurs)
+            if klucz in buckets:
+                sumy = buckets[klucz][1]
+                for pole, wartosc in values.items():
+                    sumy[pole] += wartosc
+            else:
+                buckets[klucz] = (bucket, values)
+        return list(buckets.values())
+    
+    @staticmethod
+    def lock(user_id):
+        """Blokuje wiersz użytkownika do końca transakcji (SELECT ... FOR UPDATE)
+        
+        Serializuje między workerami przeliczanie agregatów użytkownika
+        i dopisywanie do nich nowych kursów.
+        """
+        db.session.query(User.id).filter_by(id=user_id).with_for_update().first()
+    
+    @staticmethod
+    def record(user_id, kursy):
+        """Dolicza kursy do ich kubełków, po jednej zmianie na kubełek (bez commita)"""
+        RideRollup.lock(user_id)
+        for bucket, values in RideRollup._sum_buckets(user_id, kursy):
+            zmiany = {getattr(RideRollup, pole): getattr(RideRollup, pole) + wartosc for pole, wartosc in values.items()}
+            if RideRollup.query.filter_by(**bucket).update(zmiany, synchronize_session=False):
+                continue
+            try:
+                with db.session.begin_nested():
+                    db.session.add(RideRollup(**bucket, **values))
+            except IntegrityError:
+                # Kubełek utworzył w międzyczasie inny worker
+                RideRollup.query.filter_by(**bucket).update(zmiany, synchronize_session=False)
+    
+    @staticmethod
+    def add(user_id, kursy):
+        """Dolicza kursy zapisane poza bazą"""
+        try:
+            RideRollup.record(user_id, kursy)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+    
+    @staticmethod
+    def is_built(user_id):
+        """Czy agregaty użytkownika obejmują całą historię"""
+        return db.session.get(RideRollupStatus, user_id) is not None
+    
+    @staticmethod
+    def rebuild(user_id, wczytaj_kursy):
+        """Przelicza od nowa wszystkie agregaty użytkownika z kursów zwróconych przez wczytaj_kursy()
+        
+        Kursy są czytane pod blokadą użytkownika (lock), więc równoległe
+        przeliczanie w innym workerze czeka i po nim nie powtarza pracy, a kurs
+        dopisywany w tym czasie jest doliczany dopiero po przeliczeniu.
+        Zwraca False, jeśli agregaty przeliczył już ktoś inny.
+        """
+        try:
+            RideRollup.lock(user_id)
+            if db.session.get(RideRollupStatus, user_id) is not None:
+                db.session.commit()
+                return False
+            buckets = RideRollup._sum_buckets(user_id, wczytaj_kursy())
+            RideRollup.query.filter_by(user_id=user_id).delete(synchronize_session=False)
+            db.session.add_all(RideRollup(**bucket, **values) for bucket, values in buckets)
+            db.session.add(RideRollupStatus(user_id=user_id))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+    
+    @staticmethod
+    def invalidate(user_id):
+        """Oznacza agregaty użytkownika do ponownego przeliczenia"""
+        RideRollupStatus.query.filter_by(user_id=user_id).delete()
+        db.session.commit()
+    
+    @staticmethod
+    def day_totals(user_id, day):
+        """Zwraca (liczba kursów, suma zysków, suma stawek) dla jednego dnia"""
+        wiersz = db.session.query(
+            db.func.sum(RideRollup.rides),
+            db.func.sum(RideRollup.profit_sum),
+            db.func.sum(RideRollup.rate_sum)
+        ).filter_by(user_id=user_id, day=day).one()
+        return wiersz[0] or 0, wiersz[1] or 0.0, wiersz[2] or 0.0
+    
+    @staticmethod
+    def daily_profit(user_id, limit):
+        """Zwraca (dzień, suma zysków) dla ostatnich dni z kursami, chronologicznie"""
+        wiersze = db.session.query(
+            RideRollup.day,
+            db.func.sum(RideRollup.profit_sum)
+        ).filter_by(user_id=user_id).group_by(RideRollup.day).order_by(RideRollup.day.desc()).limit(limit).all()
+        return [(day.isoformat(), zysk) for day, zysk in reversed(wiersze)]
+    
+    @staticmethod
+    def by_platform(user_id):
+        """Zwraca listę (platforma, liczba kursów, suma stawek, suma zysków)"""
+        return [tuple(wiersz) for wiersz in db.session.query(
+            RideRollup.platform,
+            db.func.sum(RideRollup.rides),
+            db.func.sum(RideRollup.rate_sum),
+            db.func.sum(RideRollup.profit_sum)
+        ).filter_by(user_id=user_id).group_by(RideRollup.platform).order_by(
+            db.func.min(RideRollup.day), RideRollup.platform
+        ).all()]
+
+class RideRollupStatus(db.Model):
+    __tablename__ = 'ride_rollup_status'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    built_at = db.Column(db.DateTime, server_default=db.func.now())
+
+class RideImport(db.Model):
+    __tablename__ = 'ride_imports'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    imported = db.Column(db.Integer, default=0, nullable=False)
+    updated_at = db.Column(db.DateTime, server_default=db.func.now(), onupdate=db.func.now())
+
+class RideBatch(db.Model):
+    """Paczki kursów z kolejki offline, już zapisane (ochrona przed powtórną wysyłką)"""
+    __tablename__ = 'ride_batches'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    batch_id = db.Column(db.String(64), primary_key=True)
+    rides = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    
+    @staticmethod
+    def get(user_id, batch_id):
+        """Zwraca zapisaną paczkę albo None"""
+        return db.session.get(RideBatch, (user_id, batch_id))
+    
+    @staticmethod
+    def claim(user_id, batch_id, rides, commit=True):
+        """Rezerwuje paczkę przed zapisem jej kursów; False, jeśli już była zapisana
+        
+        Klucz główny (user_id, batch_id) sprawia, że z dwóch równoległych
+        wysyłek tej samej paczki (np. w różnych workerach) przechodzi jedna.
+        Z commit=False rezerwacja czeka na commit transakcji zapisującej kursy,
+        a druga wysyłka tej paczki czeka na jej wynik.
+        """
+        try:
+            db.session.add(RideBatch(user_id=user_id, batch_id=batch_id, rides=rides))
+            if commit:
+                db.session.commit()
+            else:
+                db.session.flush()
+            return True
+        except IntegrityError:
+            db.session.rollback()
+            return False
+        except Exception:
+            db.session.rollback()
+            raise
+
+
+class ReportSnapshot(db.Model):
+    """Sumy raportu za zamknięty okres, liczone raz i usuwane tylko przez zaległy kurs z tego okresu"""
+    __tablename__ = 'report_snapshots'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    period_start = db.Column(db.Date, primary_key=True)
+    period_end = db.Column(db.Date, primary_key=True)
+    rides = db.Column(db.Integer, default=0, nullable=False)
+    gross = db.Column(db.Float, default=0, nullable=False)
+    net = db.Column(db.Float, default=0, nullable=False)
+    km = db.Column(db.Float, default=0, nullable=False)
+    cash_sum = db.Column(db.Float, default=0, nullable=False)
+    cash_rides = db.Column(db.Integer, default=0, nullable=False)
+    card_sum = db.Column(db.Float, default=0, nullable=False)
+    card_rides = db.Column(db.Integer, default=0, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=db.func.now())
+    
+    # Klucz sum raportu -> kolumna
+    POLA = {
+        'liczba_kursow': 'rides', 'zarobki_brutto': 'gross', 'zarobki_netto': 'net',
+        'przejechane_km': 'km', 'gotowka_razem': 'cash_sum', 'gotowka_kursy': 'cash_rides',
+        'karta_razem': 'card_sum', 'karta_kursy': 'card_rides'
+    }
+    
+    def sumy(self):
+        """Sumy raportu w postaci zwracanej przez sumy_okresu()"""
+        return {klucz: getattr(self, kolumna) for klucz, kolumna in ReportSnapshot.POLA.items()}
+    
+    @staticmethod
+    def get_many(user_id, okresy):
+        """Zwraca {(od, do): sumy} dla okresów (pary dat), które mają zapisaną migawkę"""
+        if not okresy:
+            return {}
+        poczatki = [od for od, _ in okresy]
+        wiersze = ReportSnapshot.query.filter(
+            ReportSnapshot.user_id == user_id,
+            ReportSnapshot.period_start.between(min(poczatki), max(poczatki))
+        ).all()
+        szukane = set(okresy)
+        return {(w.period_start, w.period_end): w.sumy() for w in wiersze
+                if (w.period_start, w.period_end) in szukane}
+    
+    @staticmethod
+    def save(user_id, od, do, sumy, version):
+        """Zapisuje migawkę okresu [od, do) policzoną z danych w wersji version
+        
+        Wersja jest sprawdzana pod blokadą wiersza data_versions (DataVersion.lock),
+        więc zapis kursu nie może jej podbić i usunąć migawek między sprawdzeniem
+        a zapisem tej migawki. Zwraca False, gdy dane zmieniły się od policzenia sum;
+        istniejąca migawka zostaje bez zmian.
+        """
+        try:
+            if DataVersion.lock(user_id) != version:
+                db.session.rollback()
+                return False
+            db.session.add(ReportSnapshot(
+                user_id=user_id, period_start=od, period_end=do,
+                **{kolumna: sumy[klucz] for klucz, kolumna in ReportSnapshot.POLA.items()}))
+            db.session.commit()
+        except IntegrityError:
+            db.session.rollback()
+        except Exception:
+            db.session.rollback()
+            raise
+        return True
+    
+    @staticmethod
+    def invalidate(user_id, first_day=None, last_day=None, commit=True):
+        """Usuwa migawki okresów zawierających dni [first_day, last_day] albo wszystkie migawki użytkownika"""
+        query = ReportSnapshot.query.filter_by(user_id=user_id)
+        if first_day is not None:
+            query = query.filter(ReportSnapshot.period_start <= last_day, ReportSnapshot.period_end > first_day)
+        try:
+            query.delete(synchronize_session=False)
+            if commit:
+                db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+class AiJob(db.Model):
+    """Zadanie analizy AI wykonywane w tle; stan jest w bazie, bo wynik może odebrać inny worker"""
+    __tablename__ = 'ai_jobs'
+    
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=False, index=True)
+    kind = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(10), default='queued', nullable=False)
+    result = db.Column(db.Text, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    # Zakończone zadania starsze niż doba są usuwane przy tworzeniu nowych
+    RETENTION = datetime.timedelta(days=1)
+    
+    @property
+    def finished(self):
+        return self.status in ('done', 'error')
+    
+    @staticmethod
+    def get(user_id, job_id):
+        """Zwraca zadanie użytkownika albo None"""
+        return AiJob.query.filter_by(id=job_id, user_id=user_id).first()
+    
+    @staticmethod
+    def create(user_id, kind):
+        """Tworzy zadanie w kolejce i zwraca jego identyfikator"""
+        job_id = secrets.token_hex(16)
+        try:
+            AiJob.query.filter(
+                AiJob.user_id == user_id,
+                AiJob.created_at < datetime.datetime.utcnow() - AiJob.RETENTION
+            ).delete(synchronize_session=False)
+            db.session.add(AiJob(id=job_id, user_id=user_id, kind=kind, status='queued'))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return job_id
+    
+    @staticmethod
+    def start(job_id):
+        """Oznacza zadanie jako wykonywane"""
+        AiJob._update(job_id, status='running')
+    
+    @staticmethod
+    def finish(job_id, result, status='done'):
+        """Zapisuje wynik zadania (status done albo error)"""
+        AiJob._update(job_id, status=status, result=result, finished_at=datetime.datetime.utcnow())
+    
+    @staticmethod
+    def _update(job_id, **values):
+        try:
+            AiJob.query.filter_by(id=job_id).update(values, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+class EmailOutbox(db.Model):
+    """Wiadomości email do wysłania w tle, ze stanem i historią prób"""
+    __tablename__ = 'email_outbox'
+    __table_args__ = (
+        db.Index('ix_email_outbox_status_next_attempt_at', 'status', 'next_attempt_at'),
+    )
+    
+    id = db.Column(db.Integer, primary_key=True)
+    recipient = db.Column(db.String(120), nullable=False)
+    subject = db.Column(db.String(200), nullable=False)
+    body_text = db.Column(db.Text, nullable=False)
+    body_html = db.Column(db.Text, nullable=False)
+    # pending (czeka), sending (pobrana przez wysyłkę), sent, failed (bez dalszych prób)
+    status = db.Column(db.String(10), default='pending', nullable=False)
+    attempts = db.Column(db.Integer, default=0, nullable=False)
+    last_error = db.Column(db.Text, nullable=True)
+    next_attempt_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    claimed_at = db.Column(db.DateTime, nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.datetime.utcnow, nullable=False)
+    sent_at = db.Column(db.DateTime, nullable=True)
+    
+    # Wiadomość pobraną dawniej i nie wysłaną (np. restart workera) można pobrać ponownie
+    CLAIM_TIMEOUT = datetime.timedelta(minutes=10)
+    
+    @staticmethod
+    def add(recipient, subject, body_text, body_html):
+        """Dodaje wiadomość do wysłania i zwraca jej id"""
+        try:
+            message = EmailOutbox(recipient=recipient, subject=subject, body_text=body_text,
+                                  body_html=body_html, status='pending')
+            db.session.add(message)
+            db.session.commit()
+            return message.id
+        except Exception:
+            db.session.rollback()
+            raise
+    
+    @staticmethod
+    def claim(limit):
+        """Pobiera do wysłania najwyżej limit zaległych wiadomości.
+        
+        Każda jest oznaczana warunkowym UPDATE, więc dwa workery nie wyślą tej samej.
+        """
+        now = datetime.datetime.utcnow()
+        due = db.or_(
+            db.and_(EmailOutbox.status == 'pending', EmailOutbox.next_attempt_at <= now),
+            db.and_(EmailOutbox.status == 'sending', EmailOutbox.claimed_at < now - EmailOutbox.CLAIM_TIMEOUT)
+        )
+        try:
+            ids = [row.id for row in db.session.query(EmailOutbox.id).filter(due)
+                   .order_by(EmailOutbox.next_attempt_at).limit(limit)]
+            claimed = [message_id for message_id in ids
+                       if EmailOutbox.query.filter(EmailOutbox.id == message_id, due)
+                       .update({'status': 'sending', 'claimed_at': now}, synchronize_session=False)]
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return EmailOutbox.query.filter(EmailOutbox.id.in_(claimed)).order_by(EmailOutbox.id).all() if claimed else []
+    
+    @staticmethod
+    def sent(message_id):
+        """Oznacza wiadomość jako wysłaną"""
+        EmailOutbox._update(message_id, status='sent', sent_at=datetime.datetime.utcnow(),
+                            attempts=EmailOutbox.attempts + 1, last_error=None)
+    
+    @staticmethod
+    def failed(message_id, error, retry_at=None):
+        """Zapisuje nieudaną próbę; bez retry_at wiadomość nie będzie już wysyłana"""
+        values = {'attempts': EmailOutbox.attempts + 1, 'last_error': error}
+        if retry_at is None:
+            values['status'] = 'failed'
+        else:
+            values.update(status='pending', next_attempt_at=retry_at)
+        EmailOutbox._update(message_id, **values)
+    
+    @staticmethod
+    def release(message_id, retry_at):
+        """Oddaje pobraną, niewysłaną wiadomość do kolejki bez liczenia próby"""
+        EmailOutbox._update(message_id, status='pending', next_attempt_at=retry_at)
+    
+    @staticmethod
+    def _update(message_id, **values):
+        try:
+            EmailOutbox.query.filter_by(id=message_id).update(values, synchronize_session=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+class RateLimitBucket(db.Model):
+    """Kubełek tokenów limitu prób logowania/rejestracji wspólny dla wszystkich workerów"""
+    __tablename__ = 'rate_limit_buckets'
+    
+    key = db.Column(db.String(200), primary_key=True)
+    tokens = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, index=True)
+    
+    # Kubełek nieużywany tak długo jest już pełny, więc można go usunąć
+    RETENTION = datetime.timedelta(days=1)
+    
+    @staticmethod
+    def take(key, capacity, per_second, tokens=1):
+        """Zabiera token i zwraca 0 albo sekundy do następnego tokenu (jak limity.PamiecKubelkow.pobierz).
+        
+        tokens=-1 oddaje token zabrany przez próbę odrzuconą przez inny kubełek.
+        
+        Wiersz jest blokowany (SELECT ... FOR UPDATE) na czas jednej krótkiej transakcji.
+        Przy błędzie bazy próba jest przepuszczana, żeby awaria nie blokowała logowania.
+        """
+        now = datetime.datetime.utcnow()
+        try:
+            bucket = RateLimitBucket.query.filter_by(key=key).with_for_update().first()
+            if bucket is None:
+                RateLimitBucket.query.filter(
+                    RateLimitBucket.updated_at < now - RateLimitBucket.RETENTION
+                ).delete(synchronize_session=False)
+                db.session.add(RateLimitBucket(key=key, tokens=min(capacity, capacity - tokens), updated_at=now))
+                db.session.commit()
+                return 0
+            available = min(capacity, bucket.tokens + max((now - bucket.updated_at).total_seconds(), 0) * per_second)
+            wait = 0 if available >= tokens else (tokens - available) / per_second
+            bucket.tokens = available if wait else min(capacity, available - tokens)
+            bucket.updated_at = now
+            db.session.commit()
+            return wait
+        except IntegrityError:
+            # Ten sam kubełek utworzył równolegle inny worker - teraz już istnieje
+            db.session.rollback()
+            return RateLimitBucket.take(key, capacity, per_second, tokens)
+        except Exception as e:
+            db.session.rollback()
+            print(f"Error updating rate limit bucket: {str(e)}")
+            return 0
+
+class DataVersion(db.Model):
+    __tablename__ = 'data_versions'
+    
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), primary_key=True)
+    version = db.Column(db.Integer, default=0, nullable=False)
+    
+    @staticmethod
+    def get(user_id):
+        """Zwraca wersję danych użytkownika (0, jeśli dane jeszcze się nie zmieniały)"""
+        return db.session.query(DataVersion.version).filter_by(user_id=user_id).scalar() or 0
+    
+    @staticmethod
+    def lock(user_id):
+        """Zwraca wersję danych użytkownika, blokując jej wiersz do końca transakcji (bez commita)
+        
+        Brakujący wiersz jest tworzony z wersją 0, żeby było co zablokować;
+        bump() w innym workerze czeka wtedy na koniec tej transakcji.
+        """
+        query = db.session.query(DataVersion.version).filter_by(user_id=user_id).with_for_update()
+        version = query.scalar()
+        if version is None:
+            try:
+                with db.session.begin_nested():
+                    db.session.add(DataVersion(user_id=user_id, version=0))
+            except IntegrityError:
+                # Wiersz utworzył w międzyczasie inny worker
+                pass
+            version = query.scalar()
+        return version
+    
+    @staticmethod
+    def bump(user_id, snapshots=None):
+        """Podbija wersję danych użytkownika po zapisie kursu lub celów
+        
+        snapshots=(first_day, last_day) usuwa w tej samej transakcji migawki raportów
+        tych dni ((None, None) - wszystkie), więc żadne żądanie nie zobaczy nowej
+        wersji razem z nieaktualną migawką i nie zapisze jej w cache pod nową wersją.
+        """
+        zmiana = {DataVersion.version: DataVersion.version + 1}
+        try:
+            if not DataVersion.query.filter_by(user_id=user_id).update(zmiana, synchronize_session=False):
+                try:
+                    with db.session.begin_nested():
+                        db.session.add(DataVersion(user_id=user_id, version=1))
+                except IntegrityError:
+                    # Wiersz utworzył w międzyczasie inny worker
+                    DataVersion.query.filter_by(user_id=user_id).update(zmiana, synchronize_session=False)
+            if snapshots is not None:
+                # Wiersz wersji jest już zablokowany, więc ReportSnapshot.save czeka do commita
+                ReportSnapshot.invalidate(user_id, *snapshots, commit=False)
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+
+def importuj_plik_kursow(user_id, plik_path, rozmiar_paczki=500):
+    """Importuje kursy z pliku do tabeli rides, wznawiając od ostatniej zapisanej paczki.
+    
+    Postęp (liczba zaimportowanych kursów) jest zapisywany w tej samej transakcji
+    co paczka kursów, więc przerwany import można bezpiecznie uruchomić ponownie.
+    """
+    postep = db.session.get(RideImport, user_id)
+    if postep is None:
+        postep = RideImport(user_id=user_id, imported=0)
+        db.session.add(postep)
+    
+    pominiete = postep.imported
+    zaimportowano = 0
+    paczka = []
+    
+    for numer, kurs in enumerate(czytaj_plik_kursow(plik_path)):
+        if numer < pominiete:
+            continue
+        paczka.append(Ride.from_kurs(user_id, kurs))
+        if len(paczka) >= rozmiar_paczki:
+            zaimportowano += _zapisz_paczke(postep, paczka)
+            paczka = []
+    
+    zaimportowano += _zapisz_paczke(postep, paczka)
+    return zaimportowano
+
+def _zapisz_paczke(postep, paczka):
+    try:
+        db.session.add_all(paczka)
+        postep.imported += len(paczka)
+        db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    return len(paczka)
+
 def get_user_folder(user_id):
     """Zwraca ścieżkę folderu użytkownika"""
     return f'user_data/{user_id}'
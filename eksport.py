@@ -0,0 +1,82 @@
+import csv
+import io
+import json
+import os
+
+
+# Kolumny eksportu w kolejności CSV (te same klucze w NDJSON)
+KOLUMNY = [
+    "data_czas", "platforma", "dystans_dojazdu_km", "czas_dojazdu_min",
+    "dystans_kursu_km", "czas_kursu_min", "kwota", "procent_dla_kierowcy",
+    "koszt_paliwa", "zysk_netto", "stawka_godzinowa", "gotowka", "ocena"
+]
+
+_GOTOWKA = KOLUMNY.index("gotowka")
+
+FORMATY = {
+    "csv": "text/csv; charset=utf-8",
+    "ndjson": "application/x-ndjson; charset=utf-8",
+}
+
+# Rozmiar porcji wysyłanej w jednym kawałku odpowiedzi chunked
+ROZMIAR_PORCJI = 64 * 1024
+
+
+def _kwota(wartosc):
+    return round(float(wartosc), 2)
+
+
+def wiersz(kurs):
+    """Wartości kursu w kolejności KOLUMNY."""
+    return [
+        kurs.data_czas, kurs.platforma or "",
+        _kwota(kurs.dystans_dojazdu), _kwota(kurs.czas_dojazdu),
+        _kwota(kurs.dystans_kursu), _kwota(kurs.czas_kursu),
+        _kwota(kurs.kwota), _kwota(kurs.procent), _kwota(kurs.koszt_paliwa),
+        _kwota(kurs.zysk), _kwota(kurs.stawka), bool(kurs.gotowka), kurs.ocena or ""
+    ]
+
+
+def _linie_csv(kursy):
+    bufor = io.StringIO()
+    pisarz = csv.writer(bufor, lineterminator="\n")
+    pisarz.writerow(KOLUMNY)
+    for kurs in kursy:
+        wartosci = wiersz(kurs)
+        wartosci[_GOTOWKA] = "tak" if wartosci[_GOTOWKA] else "nie"
+        pisarz.writerow(wartosci)
+        yield bufor.getvalue()
+        bufor.seek(0)
+        bufor.truncate()
+    yield bufor.getvalue()
+
+
+def _linie_ndjson(kursy):
+    for kurs in kursy:
+        yield json.dumps(dict(zip(KOLUMNY, wiersz(kurs))), ensure_ascii=False) + "\n"
+
+
+def strumien(kursy, format):
+    """Generator porcji bajtów eksportu; w pamięci jest najwyżej jedna porcja."""
+    linie = _linie_csv(kursy) if format == "csv" else _linie_ndjson(kursy)
+    porcja = []
+    rozmiar = 0
+    for linia in linie:
+        porcja.append(linia)
+        rozmiar += len(linia)
+        if rozmiar >= ROZMIAR_PORCJI:
+            yield "".join(porcja).encode("utf-8")
+            porcja = []
+            rozmiar = 0
+    if porcja:
+        yield "".join(porcja).encode("utf-8")
+
+
+def zapisz_segment(sciezka, kursy, format):
+    """Zapisuje eksport do pliku tymczasowego obok sciezka i zwraca jego nazwę."""
+    os.makedirs(os.path.dirname(sciezka), exist_ok=True)
+    tymczasowy = f"{sciezka}.{os.getpid()}.tmp"
+    with open(tymczasowy, "wb") as plik:
+        for porcja in strumien(kursy, format):
+            plik.write(porcja)
+    return tymczasowy
@@ -0,0 +1,388 @@
+import bisect
+import json
+import os
+import sys
+import tempfile
+import threading
+from collections import OrderedDict
+
+
+class Kurs:
+    """Pojedynczy zapisany kurs z polami liczbowymi."""
+
+    __slots__ = (
+        'data_czas', 'platforma', 'dystans_dojazdu', 'czas_dojazdu',
+        'dystans_kursu', 'czas_kursu', 'kwota', 'procent', 'koszt_paliwa',
+        'zysk', 'stawka', 'gotowka', 'ocena'
+    )
+
+    def __init__(self, data_czas, platforma=None, dystans_dojazdu=0.0, czas_dojazdu=0.0,
+                 dystans_kursu=0.0, czas_kursu=0.0, kwota=0.0, procent=0.0,
+                 koszt_paliwa=0.0, zysk=0.0, stawka=0.0, gotowka=False, ocena=None):
+        self.data_czas = data_czas
+        self.platforma = platforma
+        self.dystans_dojazdu = dystans_dojazdu
+        self.czas_dojazdu = czas_dojazdu
+        self.dystans_kursu = dystans_kursu
+        self.czas_kursu = czas_kursu
+        self.kwota = kwota
+        self.procent = procent
+        self.koszt_paliwa = koszt_paliwa
+        self.zysk = zysk
+        self.stawka = stawka
+        self.gotowka = gotowka
+        self.ocena = ocena
+
+    @property
+    def data(self):
+        """Data kursu w formacie RRRR-MM-DD"""
+        return self.data_czas[:10]
+
+    @property
+    def godzina(self):
+        """Godzina rozpoczęcia kursu (0-23)"""
+        return int(self.data_czas[11:13])
+
+    @property
+    def dystans(self):
+        """Łączny dystans kursu z dojazdem"""
+        return self.dystans_dojazdu + self.dystans_kursu
+
+    def pola_tekstowe(self):
+        """Zwraca pola kursu w postaci tekstowej, tak jak są zapisane w pliku."""
+        slownik = {}
+        if self.platforma is not None:
+            slownik["Platforma"] = self.platforma
+        slownik.update({
+            "Dystans dojazdu (km)": f"{self.dystans_dojazdu:.2f}",
+            "Czas dojazdu (min)": f"{self.czas_dojazdu:.0f}",
+            "Dystans z klientem (km)": f"{self.dystans_kursu:.2f}",
+            "Czas kursu (min)": f"{self.czas_kursu:.0f}",
+            "Kwota (z napiwkiem)": f"{self.kwota:.2f} zł",
+            "Procent dla kierowcy": f"{self.procent:.0f}%",
+            "Koszt paliwa": f"{self.koszt_paliwa:.2f} zł",
+            "Zysk netto": f"{self.zysk:.2f} zł",
+            "Stawka godzinowa": f"{self.stawka:.2f} zł/h",
+            "Płatność gotówką": "tak" if self.gotowka else "nie",
+        })
+        if self.ocena is not None:
+            slownik["Ocena"] = self.ocena
+        return slownik
+
+    def jako_slownik(self):
+        """Zwraca kurs w postaci tekstowej razem z datą i czasem."""
+        slownik = self.pola_tekstowe()
+        slownik["data_czas"] = self.data_czas
+        return slownik
+
+
+def _liczba(wartosc):
+    return float(wartosc.replace("zł/h", "").replace("zł", "").replace("%", "").strip())
+
+
+# Etykieta w pliku -> (atrybut Kursu, konwersja wartości)
+POLA = {
+    "Platforma": ("platforma", str.strip),
+    "Dystans dojazdu (km)": ("dystans_dojazdu", _liczba),
+    "Czas dojazdu (min)": ("czas_dojazdu", _liczba),
+    "Dystans z klientem (km)": ("dystans_kursu", _liczba),
+    "Czas kursu (min)": ("czas_kursu", _liczba),
+    "Kwota (z napiwkiem)": ("kwota", _liczba),
+    "Procent dla kierowcy": ("procent", _liczba),
+    "Koszt paliwa": ("koszt_paliwa", _liczba),
+    "Zysk netto": ("zysk", _liczba),
+    "Stawka godzinowa": ("stawka", _liczba),
+    "Płatność gotówką": ("gotowka", lambda wartosc: wartosc.strip() == "tak"),
+    "Ocena": ("ocena", str.strip),
+}
+
+
+def _ustaw_pole(kurs, linia):
+    klucz, separator, wartosc = linia.partition(":")
+    pole = POLA.get(klucz.strip()) if separator else None
+    if pole:
+        atrybut, konwersja = pole
+        try:
+            setattr(kurs, atrybut, konwersja(wartosc))
+        except ValueError:
+            pass
+
+
+def parsuj_kursy(linie):
+    """Generator zwracający kolejne kursy z linii pliku kursy.txt."""
+    kurs = None
+    for linia in linie:
+        if linia.startswith("["):
+            if kurs is not None:
+                yield kurs
+            kurs = Kurs(linia[1:20])
+        elif kurs is None:
+            continue
+        elif linia.startswith("-"):
+            yield kurs
+            kurs = None
+        else:
+            _ustaw_pole(kurs, linia)
+    if kurs is not None:
+        yield kurs
+
+
+def czytaj_plik_kursow(plik_path):
+    """Strumieniowo czyta kursy z pliku; brak pliku oznacza brak kursów."""
+    try:
+        with open(plik_path, "r", encoding="utf-8") as plik:
+            yield from parsuj_kursy(plik)
+    except FileNotFoundError:
+        return
+
+
+
+SEPARATOR = ("-" * 40 + "\n").encode("utf-8")
+
+
+def czytaj_kursy_od(plik_path, pozycja=0):
+    """Czyta zakończone kursy od podanego bajtu pliku.
+
+    Zwraca pary (kurs, pozycja za kursem). Niedokończony kurs na końcu
+    pliku jest pomijany, żeby kolejny odczyt mógł zacząć od tej pozycji.
+    """
+    try:
+        plik = open(plik_path, "rb")
+    except FileNotFoundError:
+        return
+    with plik:
+        plik.seek(pozycja)
+        kurs = None
+        for surowa in plik:
+            if surowa.startswith(b"["):
+                if kurs is not None:
+                    yield kurs, pozycja
+                kurs = Kurs(surowa[1:20].decode("utf-8"))
+            elif kurs is None:
+                pass
+            elif surowa.startswith(b"-"):
+                yield kurs, pozycja + len(surowa)
+                kurs = None
+            else:
+                _ustaw_pole(kurs, surowa.decode("utf-8"))
+            pozycja += len(surowa)
+
+
+def mozna_doczytac(plik_path, stat, inode, pozycja):
+    """Czy plik jest tym samym, tylko dopisanym plikiem co przy ostatnim odczycie."""
+    if stat.st_ino != inode or stat.st_size < pozycja:
+        return False
+    if pozycja < len(SEPARATOR):
+        return True
+    with open(plik_path, "rb") as plik:
+        plik.seek(pozycja - len(SEPARATOR))
+        return plik.read(len(SEPARATOR)) == SEPARATOR
+
+
+def _puste_sumy():
+    return {"liczba": 0, "suma_kwot": 0.0, "suma_zysku": 0.0, "suma_stawek": 0.0,
+            "suma_km": 0.0, "suma_paliwa": 0.0}
+
+
+def podsumuj_historie(plik_path, stan_path):
+    """Zwraca sumy z całej historii, doczytując tylko kursy dopisane od ostatniego razu.
+
+    Pozycja w pliku, jego i-węzeł i dotychczasowe sumy są zapisywane w stan_path.
+    Jeśli plik został podmieniony lub skrócony, sumy są liczone od początku.
+    """
+    try:
+        stat = os.stat(plik_path)
+    except FileNotFoundError:
+        return _puste_sumy()
+
+    try:
+        with open(stan_path, "r", encoding="utf-8") as plik:
+            stan = json.load(plik)
+    except (FileNotFoundError, ValueError):
+        stan = None
+    if stan is None or not mozna_doczytac(plik_path, stat, stan["inode"], stan["pozycja"]):
+        stan = {"inode": stat.st_ino, "pozycja": 0, "sumy": _puste_sumy()}
+    elif stat.st_size == stan["pozycja"]:
+        return stan["sumy"]
+
+    sumy = stan["sumy"]
+    pozycja = stan["pozycja"]
+    for kurs, pozycja in czytaj_kursy_od(plik_path, pozycja):
+        sumy["liczba"] += 1
+        sumy["suma_kwot"] += kurs.kwota
+        sumy["suma_zysku"] += kurs.zysk
+        sumy["suma_stawek"] += kurs.stawka
+        sumy["suma_km"] += kurs.dystans
+        sumy["suma_paliwa"] += kurs.koszt_paliwa
+
+    if pozycja != stan["pozycja"]:
+        stan["pozycja"] = pozycja
+        _zapisz_stan(stan_path, stan)
+    return sumy
+
+
+def _zapisz_stan(stan_path, stan):
+    """Zapisuje stan sum przez własny plik tymczasowy (równoległe zapisy się nie mieszają).
+
+    Stan jest tylko przyspieszeniem, więc nieudany zapis nie przerywa żądania.
+    """
+    try:
+        deskryptor, tymczasowy = tempfile.mkstemp(dir=os.path.dirname(stan_path) or ".", suffix=".tmp")
+    except OSError as e:
+        print(f"Error saving history totals checkpoint: {str(e)}")
+        return
+    try:
+        with os.fdopen(deskryptor, "w", encoding="utf-8") as plik:
+            json.dump(stan, plik)
+        os.replace(tymczasowy, stan_path)
+    except OSError as e:
+        print(f"Error saving history totals checkpoint: {str(e)}")
+        try:
+            os.remove(tymczasowy)
+        except OSError:
+            pass
+
+
+def _rozmiar_kursu(kurs):
+    return sys.getsizeof(kurs) + sum(sys.getsizeof(getattr(kurs, pole)) for pole in Kurs.__slots__)
+
+
+def _indeks_czasow(kursy, indeks=None):
+    """Indeks (liczba kursów, posortowane czasy, kolejność lub None) dla listy kursów.
+    
+    Kolejność None oznacza, że lista jest już chronologiczna. Kursy dopisane
+    za ostatnim czasem tylko przedłużają istniejący indeks; kurs wcześniejszy
+    (np. zaległy z kolejki offline) wymusza przebudowę. Istniejący indeks nie
+    jest zmieniany, bo inne wątki mogą w nim właśnie szukać.
+    """
+    if indeks is not None:
+        liczba, czasy, kolejnosc = indeks
+        nowe = [kurs.data_czas for kurs in kursy[liczba:]]
+        if not nowe:
+            return indeks
+        if (not czasy or czasy[-1] <= nowe[0]) and all(a <= b for a, b in zip(nowe, nowe[1:])):
+            if kolejnosc is not None:
+                kolejnosc = kolejnosc + list(range(liczba, len(kursy)))
+            return len(kursy), czasy + nowe, kolejnosc
+    
+    czasy = [kurs.data_czas for kurs in kursy]
+    if all(a <= b for a, b in zip(czasy, czasy[1:])):
+        return len(kursy), czasy, None
+    kolejnosc = sorted(range(len(kursy)), key=czasy.__getitem__)
+    return len(kursy), [czasy[i] for i in kolejnosc], kolejnosc
+
+
+class CacheKursow:
+    """Pamięć podręczna sparsowanych historii kursów z globalnym limitem bajtów.
+
+    Dla każdego użytkownika pamiętana jest pozycja w pliku za ostatnim pełnym
+    kursem, więc po dopisaniu kursów parsowany jest tylko nowy fragment pliku.
+    Podmieniony lub skrócony plik jest czytany od nowa. Po przekroczeniu limitu
+    usuwane są najdawniej używane historie (LRU).
+    
+    Do zapytań o zakres dat każda historia ma indeks posortowanych czasów,
+    uzupełniany przy dopisaniu kursów w kolejności chronologicznej. Plik nie musi
+    być chronologiczny (paczka z kolejki offline dopisuje starsze kursy na końcu),
+    dlatego kolejność czasów dają tylko zakres(), a pobierz() - kolejność w pliku.
+    """
+
+    def __init__(self, limit_bajtow):
+        self.limit_bajtow = limit_bajtow
+        self._wpisy = OrderedDict()
+        self._zajete = 0
+        self._blokada = threading.Lock()
+
+    def pobierz(self, klucz, plik_path):
+        """Zwraca listę kursów z pliku (tylko do odczytu), doczytując nowe kursy."""
+        try:
+            stat = os.stat(plik_path)
+        except FileNotFoundError:
+            self.usun(klucz)
+            return []
+        sygnatura = (stat.st_ino, stat.st_mtime_ns, stat.st_size)
+
+        with self._blokada:
+            wpis = self._wpisy.get(klucz)
+            if wpis is not None:
+                self._wpisy.move_to_end(klucz)
+                if wpis["sygnatura"] == sygnatura:
+                    return wpis["kursy"]
+
+        # Zwrócona wcześniej lista może być właśnie czytana przez inny wątek, więc
+        # doczytane kursy trafiają do nowej listy; indeks czasów starej listy
+        # opisuje początek nowej i jest tylko przedłużany
+        indeks = None
+        if wpis is not None and mozna_doczytac(plik_path, stat, wpis["sygnatura"][0], wpis["pozycja"]):
+            kursy, pozycja, indeks = wpis["kursy"], wpis["pozycja"], wpis.get("indeks")
+        else:
+            kursy, pozycja = [], 0
+        nowe = []
+        for kurs, pozycja in czytaj_kursy_od(plik_path, pozycja):
+            nowe.append(kurs)
+        kursy = kursy + nowe
+        rozmiar = len(kursy) * _rozmiar_kursu(kursy[0]) if kursy else 0
+
+        with self._blokada:
+            self._usun(klucz)
+            if rozmiar <= self.limit_bajtow:
+                self._wpisy[klucz] = {"sygnatura": sygnatura, "pozycja": pozycja,
+                                      "kursy": kursy, "rozmiar": rozmiar, "indeks": indeks}
+                self._zajete += rozmiar
+                while self._zajete > self.limit_bajtow:
+                    _, usuniety = self._wpisy.popitem(last=False)
+                    self._zajete -= usuniety["rozmiar"]
+        return kursy
+
+    def zakres(self, klucz, plik_path, od=None, do=None):
+        """Kursy z zakresu [od, do) chronologicznie, wyszukane bisekcją w indeksie czasów.
+        
+        Bez granic dla chronologicznego pliku zwraca listę z pobierz() bez kopiowania.
+        """
+        kursy, (_, czasy, kolejnosc) = self._z_indeksem(klucz, plik_path)
+        poczatek = bisect.bisect_left(czasy, od) if od is not None else 0
+        koniec = bisect.bisect_left(czasy, do) if do is not None else len(czasy)
+        if kolejnosc is None:
+            if od is None and do is None:
+                return kursy
+            return kursy[poczatek:koniec]
+        return [kursy[i] for i in kolejnosc[poczatek:koniec]]
+
+    def od_najnowszych(self, klucz, plik_path, od=None, do=None, przed=None):
+        """Pary (pozycja w pliku, kurs) z zakresu [od, do) od najnowszych, po indeksie czasów.
+        
+        przed=(data_czas, pozycja) zaczyna za kursorem poprzedniej strony. Kursy
+        z tą samą sekundą idą od najdalszej pozycji w pliku. Pobranie k kursów
+        kosztuje bisekcję i k kroków, niezależnie od długości historii.
+        """
+        kursy, (_, czasy, kolejnosc) = self._z_indeksem(klucz, plik_path)
+        poczatek = bisect.bisect_left(czasy, od) if od is not None else 0
+        koniec = bisect.bisect_left(czasy, do) if do is not None else len(czasy)
+        if przed is not None:
+            koniec = min(koniec, bisect.bisect_right(czasy, przed[0]))
+        for i in range(koniec - 1, poczatek - 1, -1):
+            pozycja = i if kolejnosc is None else kolejnosc[i]
+            if przed is not None and (czasy[i], pozycja) >= przed:
+                continue
+            yield pozycja, kursy[pozycja]
+
+    def _z_indeksem(self, klucz, plik_path):
+        """Lista kursów z pobierz() i jej aktualny indeks czasów."""
+        kursy = self.pobierz(klucz, plik_path)
+        with self._blokada:
+            wpis = self._wpisy.get(klucz)
+            indeks = wpis.get("indeks") if wpis is not None and wpis["kursy"] is kursy else None
+        indeks = _indeks_czasow(kursy, indeks)
+        with self._blokada:
+            if wpis is not None and self._wpisy.get(klucz) is wpis:
+                wpis["indeks"] = indeks
+        return kursy, indeks
+
+    def usun(self, klucz):
+        """Usuwa historię użytkownika z pamięci podręcznej."""
+        with self._blokada:
+            self._usun(klucz)
+
+    def _usun(self, klucz):
+        wpis = self._wpisy.pop(klucz, None)
+        if wpis is not None:
+            self._zajete -= wpis["rozmiar"]
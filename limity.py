@@ -0,0 +1,77 @@
+import threading
+import time
+from collections import Counter, OrderedDict
+
+
+class PamiecKubelkow:
+    """Kubełki tokenów w pamięci workera (każdy worker liczy osobno).
+
+    pobierz(klucz, pojemnosc, na_sekunde) zabiera token i zwraca 0, a przy
+    pustym kubełku zwraca sekundy do następnego tokenu; tokeny=-1 oddaje
+    token. Przechowuje najwyżej limit_kluczy kubełków; najdawniej używane są
+    zapominane, co daje im najwyżej pełny kubełek.
+    """
+
+    def __init__(self, limit_kluczy=100000, zegar=time.monotonic):
+        self.limit_kluczy = limit_kluczy
+        self._zegar = zegar
+        self._kubelki = OrderedDict()
+        self._blokada = threading.Lock()
+
+    def __len__(self):
+        return len(self._kubelki)
+
+    def pobierz(self, klucz, pojemnosc, na_sekunde, tokeny=1):
+        with self._blokada:
+            teraz = self._zegar()
+            stan, czas = self._kubelki.pop(klucz, (pojemnosc, teraz))
+            stan = min(pojemnosc, stan + (teraz - czas) * na_sekunde)
+            czekaj = 0 if stan >= tokeny else (tokeny - stan) / na_sekunde
+            if not czekaj:
+                stan = min(pojemnosc, stan - tokeny)
+            self._kubelki[klucz] = (stan, teraz)
+            while len(self._kubelki) > self.limit_kluczy:
+                self._kubelki.popitem(last=False)
+            return czekaj
+
+
+class Ogranicznik:
+    """Limit prób logowania, rejestracji itp. na adres IP i na email (token bucket).
+
+    reguly to słownik rodzaj klucza -> (pojemnosc, tokeny na minutę), np.
+    {"ip": (10, 10), "email": (5, 1)}. magazyn to funkcja jak
+    PamiecKubelkow.pobierz albo database.RateLimitBucket.take (wspólna dla
+    workerów), której czwarty argument -1 oddaje token. Odrzucenie
+    kosztuje tylko sprawdzenie kubełków, bez liczenia hasha hasła.
+    """
+
+    def __init__(self, reguly, magazyn):
+        self.reguly = reguly
+        self.magazyn = magazyn
+        self.przepuszczone = Counter()
+        self.odrzucone = Counter()
+
+    def sprawdz(self, akcja, **klucze):
+        """Zabiera token z każdego kubełka (np. ip=..., email=...) i zwraca 0,
+        albo sekundy do ponownej próby, gdy któryś kubełek jest pusty.
+
+        Klucz IP jest wspólny dla wszystkich akcji, klucz email osobny dla każdej.
+        Puste wartości kluczy są pomijane. Odrzucona próba nie zużywa tokenów:
+        zabrane już z wcześniejszych kubełków są oddawane, więc np. próby na cudzy
+        email nie wyczerpują limitu całego adresu IP (NAT, sieć komórkowa).
+        """
+        zabrane = []
+        for rodzaj, wartosc in klucze.items():
+            if not wartosc:
+                continue
+            pojemnosc, na_minute = self.reguly[rodzaj]
+            klucz = f"{rodzaj}:{wartosc}" if rodzaj == "ip" else f"{akcja}:{rodzaj}:{wartosc}"
+            czekaj = self.magazyn(klucz, pojemnosc, na_minute / 60)
+            if czekaj:
+                for zabrany in zabrane:
+                    self.magazyn(*zabrany, -1)
+                self.odrzucone[f"{akcja}:{rodzaj}"] += 1
+                return czekaj
+            zabrane.append((klucz, pojemnosc, na_minute / 60))
+        self.przepuszczone[akcja] += 1
+        return 0
@@ -0,0 +1,177 @@
+import threading
+import time
+from collections import OrderedDict
+
+
+class CacheLRU:
+    """Pamięć podręczna z limitem łącznego rozmiaru wpisów w bajtach.
+
+    Po przekroczeniu limitu usuwane są najdawniej używane wpisy. Wpis większy
+    niż cały limit nie jest zapamiętywany. Liczniki trafień i chybień pozwalają
+    ocenić skuteczność cache.
+    """
+
+    def __init__(self, limit_bajtow):
+        self.limit_bajtow = limit_bajtow
+        self.trafienia = 0
+        self.chybienia = 0
+        self._wpisy = OrderedDict()
+        self._zajete = 0
+        self._blokada = threading.Lock()
+
+    def pobierz(self, klucz):
+        """Zwraca zapamiętaną wartość albo None."""
+        with self._blokada:
+            wpis = self._wpisy.get(klucz)
+            if wpis is None:
+                self.chybienia += 1
+                return None
+            self._wpisy.move_to_end(klucz)
+            self.trafienia += 1
+            return wpis[0]
+
+    def zapisz(self, klucz, wartosc, rozmiar):
+        """Zapamiętuje wartość o podanym rozmiarze w bajtach."""
+        with self._blokada:
+            self._usun(klucz)
+            if rozmiar > self.limit_bajtow:
+                return
+            self._wpisy[klucz] = (wartosc, rozmiar)
+            self._zajete += rozmiar
+            while self._zajete > self.limit_bajtow:
+                _, (_, usuniety) = self._wpisy.popitem(last=False)
+                self._zajete -= usuniety
+
+    def usun(self, klucz):
+        """Usuwa wpis, jeśli istnieje."""
+        with self._blokada:
+            self._usun(klucz)
+
+    def wyczysc(self):
+        """Usuwa wszystkie wpisy."""
+        with self._blokada:
+            self._wpisy.clear()
+            self._zajete = 0
+
+    def _usun(self, klucz):
+        wpis = self._wpisy.pop(klucz, None)
+        if wpis is not None:
+            self._zajete -= wpis[1]
+
+
+class CacheTTL:
+    """Pamięć podręczna z limitem liczby wpisów i czasem ważności wpisu (w sekundach).
+
+    Po przekroczeniu limitu usuwane są najdawniej używane wpisy, a wpis
+    starszy niż ttl jest traktowany jak brakujący.
+    """
+
+    def __init__(self, limit_wpisow, ttl, zegar=time.monotonic):
+        self.limit_wpisow = limit_wpisow
+        self.ttl = ttl
+        self.trafienia = 0
+        self.chybienia = 0
+        self._zegar = zegar
+        self._wpisy = OrderedDict()
+        self._blokada = threading.Lock()
+
+    def __len__(self):
+        return len(self._wpisy)
+
+    def pobierz(self, klucz):
+        """Zwraca ważną zapamiętaną wartość albo None."""
+        with self._blokada:
+            wpis = self._wpisy.get(klucz)
+            if wpis is not None and wpis[1] <= self._zegar():
+                del self._wpisy[klucz]
+                wpis = None
+            if wpis is None:
+                self.chybienia += 1
+                return None
+            self._wpisy.move_to_end(klucz)
+            self.trafienia += 1
+            return wpis[0]
+
+    def zapisz(self, klucz, wartosc):
+        """Zapamiętuje wartość na ttl sekund."""
+        with self._blokada:
+            self._wpisy.pop(klucz, None)
+            self._wpisy[klucz] = (wartosc, self._zegar() + self.ttl)
+            while len(self._wpisy) > self.limit_wpisow:
+                self._wpisy.popitem(last=False)
+
+    def usun(self, klucz):
+        """Usuwa wpis, jeśli istnieje."""
+        with self._blokada:
+            self._wpisy.pop(klucz, None)
+
+    def wyczysc(self):
+        """Usuwa wszystkie wpisy."""
+        with self._blokada:
+            self._wpisy.clear()
+
+
+class _Wywolanie:
+    def __init__(self):
+        self.wynik = None
+        self.blad = None
+        self.gotowe = threading.Event()
+
+    def czekaj(self, limit_czasu=None):
+        """Wynik obliczenia; zgłasza jego wyjątek albo TimeoutError po limit_czasu sekund."""
+        if not self.gotowe.wait(limit_czasu):
+            raise TimeoutError(limit_czasu)
+        if self.blad is not None:
+            raise self.blad
+        return self.wynik
+
+
+class JednoWywolanie:
+    """Łączy równoległe obliczenia tej samej wartości (singleflight).
+
+    Pierwszy wywołujący z danym kluczem liczy wartość, a ci, którzy przyjdą
+    z tym kluczem przed końcem obliczenia, czekają na jego wynik (albo
+    wyjątek). Licznik polaczone mówi, ilu obliczeń udało się uniknąć.
+    """
+
+    def __init__(self):
+        self.polaczone = 0
+        self._w_toku = {}
+        self._blokada = threading.Lock()
+
+    def wykonaj(self, klucz, oblicz, limit_czasu=None):
+        """Wynik oblicz() albo trwającego już obliczenia z tym samym kluczem."""
+        wywolanie, pierwsze = self.rozpocznij(klucz)
+        if not pierwsze:
+            return wywolanie.czekaj(limit_czasu)
+        try:
+            wynik = oblicz()
+        except Exception as e:
+            self.zakoncz(klucz, blad=e)
+            raise
+        self.zakoncz(klucz, wynik)
+        return wynik
+
+    def rozpocznij(self, klucz):
+        """Zwraca (wywołanie, True) pierwszemu wywołującemu, który musi potem
+        wywołać zakoncz(), a pozostałym (wywołanie, False) do czekania."""
+        with self._blokada:
+            wywolanie = self._w_toku.get(klucz)
+            if wywolanie is not None:
+                self.polaczone += 1
+                return wywolanie, False
+            wywolanie = self._w_toku[klucz] = _Wywolanie()
+            return wywolanie, True
+
+    def zakoncz(self, klucz, wynik=None, blad=None):
+        """Kończy obliczenie rozpoczęte przez rozpocznij() i budzi czekających."""
+        with self._blokada:
+            wywolanie = self._w_toku.pop(klucz)
+        wywolanie.wynik = wynik
+        wywolanie.blad = blad
+        wywolanie.gotowe.set()
+
+    def w_toku(self):
+        """Liczba trwających obliczeń."""
+        with self._blokada:
+            return len(self._w_toku)
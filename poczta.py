@@ -0,0 +1,144 @@
+import smtplib
+import threading
+import time
+from email.mime.multipart import MIMEMultipart
+from email.mime.text import MIMEText
+
+
+# Nieudana wysyłka jest ponawiana najwyżej tyle razy, z rosnącą przerwą
+MAKS_PROB = 6
+
+
+def opoznienie_proby(proba):
+    """Sekundy do kolejnej próby po proba nieudanych: 1, 2, 4... minut, najwyżej godzina."""
+    return min(60 * 2 ** (proba - 1), 3600)
+
+
+def rodzaj_bledu(e):
+    """Jak potraktować błąd wysyłki wiadomości.
+
+    "polaczenie" - serwer niedostępny albo odrzucił połączenie lub logowanie
+    (pozostałe wiadomości też by nie przeszły), "odrzucona" - serwer trwale
+    odrzucił tę wiadomość (kod 5xx, odrzuceni odbiorcy), "chwilowy" - inny
+    błąd, po którym warto spróbować później.
+    """
+    if isinstance(e, (smtplib.SMTPAuthenticationError, smtplib.SMTPConnectError, smtplib.SMTPHeloError,
+                      smtplib.SMTPServerDisconnected, smtplib.SMTPNotSupportedError)):
+        return "polaczenie"
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return "odrzucona"
+    if isinstance(e, smtplib.SMTPResponseException):
+        return "odrzucona" if e.smtp_code >= 500 else "chwilowy"
+    # SMTPException dziedziczy po OSError, więc błędy gniazda sprawdzamy na końcu
+    if isinstance(e, OSError) and not isinstance(e, smtplib.SMTPException):
+        return "polaczenie"
+    return "chwilowy"
+
+
+def wiadomosc(nadawca, odbiorca, temat, tekst, html):
+    """Wiadomość z treścią tekstową i HTML (multipart/alternative)."""
+    msg = MIMEMultipart('alternative')
+    msg['Subject'] = temat
+    msg['From'] = nadawca
+    msg['To'] = odbiorca
+    msg.attach(MIMEText(tekst, 'plain'))
+    msg.attach(MIMEText(html, 'html'))
+    return msg
+
+
+class PolaczenieSmtp:
+    """Połączenie z serwerem SMTP używane dla kolejnych wiadomości.
+
+    STARTTLS i logowanie odbywają się raz, przy otwarciu połączenia; zerwane
+    połączenie jest otwierane ponownie przy następnej wiadomości, a po
+    bezczynnosc sekundach bez wysyłki zamykane. Bez użytkownika i hasła
+    i z starttls=False pasuje do lokalnego serwera testowego (atrapa_smtp.py).
+    """
+
+    def __init__(self, serwer, port, uzytkownik=None, haslo=None, starttls=True, timeout=30, bezczynnosc=60):
+        self.serwer = serwer
+        self.port = port
+        self.uzytkownik = uzytkownik
+        self.haslo = haslo
+        self.starttls = starttls
+        self.timeout = timeout
+        self.bezczynnosc = bezczynnosc
+        self.polaczenia = 0
+        self._smtp = None
+        self._ostatnia_wysylka = 0
+
+    def wyslij(self, msg):
+        """Wysyła wiadomość, w razie zerwanego połączenia raz ponawiając na nowym."""
+        try:
+            try:
+                self._polacz().send_message(msg)
+            except smtplib.SMTPServerDisconnected:
+                self._smtp = None
+                self._polacz().send_message(msg)
+        finally:
+            self._ostatnia_wysylka = time.monotonic()
+
+    def zamknij_bezczynne(self):
+        """Zamyka połączenie nieużywane dłużej niż bezczynnosc sekund."""
+        if self._smtp is not None and time.monotonic() - self._ostatnia_wysylka > self.bezczynnosc:
+            self.zamknij()
+
+    def zamknij(self):
+        if self._smtp is None:
+            return
+        try:
+            self._smtp.quit()
+        except (smtplib.SMTPException, OSError):
+            pass
+        self._smtp = None
+
+    def _polacz(self):
+        if self._smtp is None:
+            smtp = smtplib.SMTP(self.serwer, self.port, timeout=self.timeout)
+            try:
+                if self.starttls:
+                    smtp.starttls()
+                if self.uzytkownik and self.haslo:
+                    smtp.login(self.uzytkownik, self.haslo)
+            except Exception:
+                smtp.close()
+                raise
+            self._smtp = smtp
+            self.polaczenia += 1
+        return self._smtp
+
+
+class WatekWysylki:
+    """Wątek w tle wywołujący funkcja() po obudz() albo co odstep sekund.
+
+    Startuje przy pierwszym obudz() lub uruchom(), więc w gunicornie działa już
+    w procesie workera. Wyjątek funkcji jest wypisywany, a wątek działa dalej.
+    """
+
+    def __init__(self, funkcja, odstep):
+        self.funkcja = funkcja
+        self.odstep = odstep
+        self._zdarzenie = threading.Event()
+        self._watek = None
+        self._blokada = threading.Lock()
+
+    def obudz(self):
+        with self._blokada:
+            if self._watek is None:
+                self._watek = threading.Thread(target=self._petla, name="wysylka-poczty", daemon=True)
+                self._watek.start()
+        self._zdarzenie.set()
+
+    def uruchom(self):
+        """Startuje wątek od razu z jednym wywołaniem funkcji (np. zaległe sprawy po restarcie)."""
+        if self._watek is None:
+            self.obudz()
+
+    def _petla(self):
+        while True:
+            self._zdarzenie.wait(self.odstep)
+            self._zdarzenie.clear()
+            try:
+                self.funkcja()
+            except Exception as e:
+                print(f"Error sending queued emails: {str(e)}")
@@ -0,0 +1,135 @@
+// Kolejka kursów zapisanych bez zasięgu (IndexedDB), wysyłana paczkami do /oblicz/batch.
+// Używana przez service worker (importScripts); działa też w oknie przeglądarki.
+// Każdy wpis pamięta kierowcę, który go zapisał (wspólny telefon): paczka zawiera
+// kursy jednego kierowcy i serwer przyjmuje ją tylko w jego sesji.
+
+const KOLEJKA_DB = 'taxi-calculator';
+const KOLEJKA_STORE = 'kolejka-kursow';
+const KOLEJKA_SYNC = 'kolejka-kursow';
+const ROZMIAR_PACZKI = 100;
+// Limit serwera (MAKS_PACZKA_KURSOW w app.py); większa paczka jest dzielona przed wysłaniem
+const MAKS_PACZKA = 500;
+
+function otworzKolejke() {
+  return new Promise((resolve, reject) => {
+    const zadanie = indexedDB.open(KOLEJKA_DB, 1);
+    zadanie.onupgradeneeded = () => {
+      zadanie.result.createObjectStore(KOLEJKA_STORE, { keyPath: 'id', autoIncrement: true });
+    };
+    zadanie.onsuccess = () => resolve(zadanie.result);
+    zadanie.onerror = () => reject(zadanie.error);
+  });
+}
+
+function transakcja(tryb, dzialanie) {
+  return otworzKolejke().then(db => new Promise((resolve, reject) => {
+    const tx = db.transaction(KOLEJKA_STORE, tryb);
+    const wynik = dzialanie(tx.objectStore(KOLEJKA_STORE));
+    tx.oncomplete = () => { db.close(); resolve(wynik && 'result' in wynik ? wynik.result : undefined); };
+    tx.onerror = () => { db.close(); reject(tx.error); };
+  }));
+}
+
+// Czas lokalny urządzenia w formacie zapisu kursów (RRRR-MM-DD GG:MM:SS)
+function czasLokalny(data) {
+  const dwie = n => String(n).padStart(2, '0');
+  return `${data.getFullYear()}-${dwie(data.getMonth() + 1)}-${dwie(data.getDate())} ` +
+         `${dwie(data.getHours())}:${dwie(data.getMinutes())}:${dwie(data.getSeconds())}`;
+}
+
+function dodajDoKolejki(dane, uzytkownik) {
+  const wpis = {
+    dane: Object.assign({}, dane, { data_czas: czasLokalny(new Date()) }),
+    uzytkownik: String(uzytkownik),
+    paczka: null
+  };
+  return transakcja('readwrite', store => store.add(wpis));
+}
+
+function liczbaWKolejce() {
+  return transakcja('readonly', store => store.count());
+}
+
+// Wybiera następną paczkę: najpierw niepotwierdzoną wysłaną wcześniej (ten sam
+// identyfikator, więc serwer jej nie zdubluje), potem nowe kursy z kolejki.
+// Ze znanym zalogowanym kierowcą (uzytkownik) pomija kursy innych kierowców.
+function nastepnaPaczka(uzytkownik) {
+  return transakcja('readwrite', store => {
+    const wynik = { result: null };
+    store.getAll().onsuccess = (e) => {
+      const wpisy = e.target.result.filter(w => uzytkownik === undefined || w.uzytkownik === uzytkownik);
+      if (!wpisy.length) {
+        return;
+      }
+      const rozpoczeta = wpisy.find(w => w.paczka);
+      if (rozpoczeta) {
+        wynik.result = {
+          id: rozpoczeta.paczka,
+          uzytkownik: rozpoczeta.uzytkownik,
+          wpisy: wpisy.filter(w => w.paczka === rozpoczeta.paczka)
+        };
+        return;
+      }
+      const id = `${Date.now().toString(36)}-${Math.random().toString(36).slice(2, 10)}`;
+      const nowe = wpisy.filter(w => w.uzytkownik === wpisy[0].uzytkownik).slice(0, ROZMIAR_PACZKI);
+      nowe.forEach(w => { w.paczka = id; store.put(w); });
+      wynik.result = { id: id, uzytkownik: wpisy[0].uzytkownik, wpisy: nowe };
+    };
+    return wynik;
+  });
+}
+
+function usunZKolejki(ids) {
+  return transakcja('readwrite', store => { ids.forEach(id => store.delete(id)); });
+}
+
+// Odłącza drugą połowę paczki (dostanie nową paczkę przy następnym wyborze);
+// pierwsza zachowuje identyfikator, bo serwer odrzucił ją w całości bez zapisu.
+function podzielPaczke(paczka) {
+  const reszta = paczka.wpisy.slice(Math.ceil(paczka.wpisy.length / 2));
+  return transakcja('readwrite', store => {
+    reszta.forEach(w => { w.paczka = null; store.put(w); });
+  });
+}
+
+// Wysyła kursy zalogowanego kierowcy paczkami. Kursy są usuwane z kolejki tylko po
+// odpowiedzi 2xx; błąd sieci, 4xx, 429 lub 5xx przerywa wysyłkę, kursy zostają w kolejce
+// i Background Sync (albo następne odzyskanie sieci) ponowi próbę. Kursy innego
+// kierowcy (409) czekają w kolejce, aż on znów się zaloguje.
+async function wyslijKolejke() {
+  let wyslane = 0;
+  let uzytkownik;  // zalogowany kierowca - znany po pierwszej odpowiedzi 409
+  for (;;) {
+    const paczka = await nastepnaPaczka(uzytkownik);
+    if (!paczka) {
+      return wyslane;
+    }
+    if (paczka.wpisy.length > MAKS_PACZKA) {
+      await podzielPaczke(paczka);
+      continue;
+    }
+    const response = await fetch('/oblicz/batch', {
+      method: 'POST',
+      credentials: 'same-origin',
+      headers: { 'Content-Type': 'application/json' },
+      body: JSON.stringify({ paczka: paczka.id, uzytkownik: paczka.uzytkownik, kursy: paczka.wpisy.map(w => w.dane) })
+    });
+    const json = (response.headers.get('Content-Type') || '').includes('application/json');
+    if (response.status === 409 && json && uzytkownik === undefined) {
+      // Zalogowany jest inny kierowca - wysyłamy tylko jego kursy
+      uzytkownik = String((await response.json()).uzytkownik);
+      continue;
+    }
+    if (response.status === 400 && paczka.wpisy.length > 1) {
+      // Paczka odrzucona w całości (np. za duża) - wysyłamy ją w dwóch częściach
+      await podzielPaczke(paczka);
+      continue;
+    }
+    if (!json || !response.ok) {
+      // Wylogowanie (przekierowanie na stronę logowania), limit prób lub awaria - spróbujemy później
+      throw new Error(`Kolejka kursów: odpowiedź ${response.status}`);
+    }
+    wyslane += (await response.json()).zapisane;
+    await usunZKolejki(paczka.wpisy.map(w => w.id));
+  }
+}
@@ -26,38 +26,46 @@ document.addEventListener('DOMContentLoaded', function() {
     // Inicjalizacja formularza kalkulatora tylko jeśli istnieje
     const kalkulatorForm = document.getElementById('kalkulator-form');
     if (kalkulatorForm) {
+        // Szacunek na żywo podczas wpisywania (bez zapisu kursu)
+        let opoznienieWyceny = null;
+        let wycenaWToku = null;
+
         kalkulatorForm.addEventListener('submit', async function(e) {
             e.preventDefault();
 
-            const formData = new FormData(this);
-            const data = {};
-            formData.forEach((value, key) => {
-                data[key] = value;
-            });
-
-            // Dodanie obsługi pola płatności gotówką
-            data.platnosc_gotowka = document.getElementById('platnosc_gotowka').checked ? 'tak' : 'nie';
+            // Przyjęcie kursu - spóźniony szacunek nie może nadpisać wyniku zapisu
+            clearTimeout(opoznienieWyceny);
+            if (wycenaWToku) {
+                wycenaWToku.abort();
+            }
 
+            const data = daneFormularza(this);
 
             try {
                 const response = await fetch('/oblicz', {
                     method: 'POST',
                     headers: {
                         'Content-Type': 'application/json',
+                        // Kurs zakolejkowany offline jest oznaczony kierowcą, który go zapisał
+                        'X-Uzytkownik': kalkulatorForm.dataset.uzytkownik
                     },
                     body: JSON.stringify(data)
                 });
 
                 const wynik = await response.json();
 
+                // Brak zasięgu - service worker zapisał kurs w kolejce offline
+                if (response.status === 202 && wynik.w_kolejce) {
+                    document.getElementById('wyniki').style.display = 'block';
+                    pokazPowiadomienia([{
+                        typ: 'info',
+                        tekst: `📶 Brak połączenia - kurs zapisany na urządzeniu (w kolejce: ${wynik.liczba}). Zostanie wysłany po odzyskaniu zasięgu.`
+                    }]);
+                    return;
+                }
+
                 // Aktualizacja wyników
-                document.getElementById('dystans_calkowity').textContent = wynik.dystans_calkowity + ' km';
-                document.getElementById('czas_calkowity_h').textContent = wynik.czas_calkowity_h + ' h';
-                document.getElementById('koszt_paliwa').textContent = wynik.koszt_paliwa + ' zł';
-                document.getElementById('zarobek_dla_kierowcy').textContent = wynik.zarobek_dla_kierowcy + ' zł';
-                document.getElementById('zysk_netto').textContent = wynik.zysk_netto + ' zł';
-                document.getElementById('stawka_godzinowa').textContent = wynik.stawka_godzinowa + ' zł/h';
-                document.getElementById('ocena-text').textContent = wynik.ocena;
+                pokazWyniki(wynik, 'Kurs przyjęty i zapisany.');
 
                 // Aktualizacja średniej dnia
                 document.getElementById('srednia-dnia').textContent = wynik.srednia_dnia + ' zł/h';
@@ -72,23 +80,66 @@ document.addEventListener('DOMContentLoaded', function() {
                     pokazPowiadomienia(wynik.powiadomienia);
                 }
 
-                // Zmiana koloru alertu
-                const alertDiv = document.getElementById('ocena-alert');
-                alertDiv.className = 'alert alert-' + wynik.ocena_klasa;
-
                 // Pokazanie wyników z animacją
-                const wynikiDiv = document.getElementById('wyniki');
-                wynikiDiv.style.display = 'block';
-                wynikiDiv.scrollIntoView({ behavior: 'smooth', block: 'nearest' });
+                document.getElementById('wyniki').scrollIntoView({ behavior: 'smooth', block: 'nearest' });
 
             } catch (error) {
                 console.error('Błąd:', error);
                 alert('Wystąpił błąd podczas obliczania!');
             }
         });
+
+        kalkulatorForm.addEventListener('input', function() {
+            clearTimeout(opoznienieWyceny);
+            opoznienieWyceny = setTimeout(async () => {
+                if (!kalkulatorForm.checkValidity()) {
+                    return;
+                }
+                if (wycenaWToku) {
+                    wycenaWToku.abort();
+                }
+                wycenaWToku = new AbortController();
+                try {
+                    const response = await fetch('/oblicz/quote', {
+                        method: 'POST',
+                        headers: { 'Content-Type': 'application/json' },
+                        body: JSON.stringify(daneFormularza(kalkulatorForm)),
+                        signal: wycenaWToku.signal
+                    });
+                    if (response.ok) {
+                        pokazWyniki(await response.json(), 'Szacunek - kurs nie jest jeszcze zapisany.');
+                        pokazPowiadomienia([]);
+                    }
+                } catch (error) {
+                    // Przerwany lub offline - szacunek pojawi się przy kolejnej zmianie
+                }
+            }, 150);
+        });
     }
 });
 
+function daneFormularza(form) {
+    const data = {};
+    new FormData(form).forEach((value, key) => {
+        data[key] = value;
+    });
+    data.platnosc_gotowka = document.getElementById('platnosc_gotowka').checked ? 'tak' : 'nie';
+    return data;
+}
+
+function pokazWyniki(wynik, status) {
+    document.getElementById('dystans_calkowity').textContent = wynik.dystans_calkowity + ' km';
+    document.getElementById('czas_calkowity_h').textContent = wynik.czas_calkowity_h + ' h';
+    document.getElementById('koszt_paliwa').textContent = wynik.koszt_paliwa + ' zł';
+    document.getElementById('zarobek_dla_kierowcy').textContent = wynik.zarobek_dla_kierowcy + ' zł';
+    document.getElementById('zysk_netto').textContent = wynik.zysk_netto + ' zł';
+    document.getElementById('stawka_godzinowa').textContent = wynik.stawka_godzinowa + ' zł/h';
+    document.getElementById('ocena-text').textContent = wynik.ocena;
+    document.getElementById('ocena-status').textContent = status;
+    document.getElementById('ocena-alert').className = 'alert alert-' + wynik.ocena_klasa;
+    document.getElementById('wyniki').style.display = 'block';
+}
+
 // Funkcje obsługi celów
 async function wczytajCele() {
     try {
@@ -258,13 +309,24 @@ function wczytajMotyw() {
 
 // Rejestracja Service Workera
 if ('serviceWorker' in navigator) {
-    navigator.serviceWorker.register('/static/service-worker.js')
+    navigator.serviceWorker.register('/static/service-worker.js', { scope: '/' })
         .then(registration => {
             console.log('Service Worker zarejestrowany:', registration);
         })
         .catch(error => {
             console.log('Błąd rejestracji Service Workera:', error);
         });
+
+    // Wysyłka kolejki offline po odzyskaniu sieci (gdy przeglądarka nie ma Background Sync)
+    const wyslijKolejkeOffline = () => {
+        navigator.serviceWorker.ready.then(registration => {
+            if (registration.active) {
+                registration.active.postMessage({ type: 'WYSLIJ_KOLEJKE' });
+            }
+        });
+    };
+    window.addEventListener('online', wyslijKolejkeOffline);
+    window.addEventListener('load', wyslijKolejkeOffline);
 }
 
 // Wczytanie danych przy starcie
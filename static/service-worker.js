@@ -1,10 +1,14 @@
-const CACHE = "taxi-calculator-offline-v3";
-const RUNTIME = "taxi-calculator-runtime-v3";
+importScripts('/static/kolejka.js');
+
+const CACHE = "taxi-calculator-offline-v8";
+const RUNTIME = "taxi-calculator-runtime-v8";
 
 const PRECACHE_URLS = [
   '/',
   '/static/style.css',
   '/static/script.js',
+  '/static/wykresy.js',
+  '/static/kolejka.js',
   '/static/manifest.json',
   '/generated-icon.png'
 ];
@@ -30,8 +34,50 @@ self.addEventListener('activate', (event) => {
   );
 });
 
+// Pliki statyczne i układy wykresów (adres z wersją) nie zmieniają się pod tym samym adresem
+function czyStatyczny(url) {
+  return url.pathname.startsWith('/static/') || url.pathname.startsWith('/wykresy/');
+}
+
+// Kurs policzony bez zasięgu trafia do kolejki i jest wysyłany później przez Background Sync
+function zakolejkujKurs(request) {
+  const uzytkownik = request.headers.get('X-Uzytkownik');
+  return request.json()
+    .then(dane => dodajDoKolejki(dane, uzytkownik))
+    .then(() => self.registration.sync ? self.registration.sync.register(KOLEJKA_SYNC) : null)
+    .then(() => liczbaWKolejce())
+    .then(liczba => new Response(JSON.stringify({ w_kolejce: true, liczba: liczba }), {
+      status: 202,
+      headers: { 'Content-Type': 'application/json' }
+    }));
+}
+
+// Wylogowanie lub logowanie kolejnego kierowcy: strony zapamiętane dla poprzedniego
+// użytkownika nie mogą być pokazane następnemu offline (wspólny telefon). Kolejka
+// kursów zostaje - każdy kurs jest wysyłany tylko pod sesją swojego kierowcy.
+function czyZmianaUzytkownika(request) {
+  const sciezka = new URL(request.url).pathname;
+  return sciezka === '/logout' || (request.method === 'POST' && sciezka === '/login');
+}
+
 self.addEventListener('fetch', (event) => {
-  if (event.request.url.startsWith(self.location.origin)) {
+  if (!event.request.url.startsWith(self.location.origin)) {
+    return;
+  }
+
+  if (czyZmianaUzytkownika(event.request)) {
+    const kopia = event.request.clone();
+    event.respondWith(caches.delete(RUNTIME).then(() => fetch(kopia)));
+    return;
+  }
+
+  if (event.request.method === 'POST' && new URL(event.request.url).pathname === '/oblicz') {
+    const kopia = event.request.clone();
+    event.respondWith(fetch(event.request).catch(() => zakolejkujKurs(kopia)));
+    return;
+  }
+
+  if (czyStatyczny(new URL(event.request.url))) {
     event.respondWith(
       caches.match(event.request).then(cachedResponse => {
         if (cachedResponse) {
@@ -46,14 +92,41 @@ self.addEventListener('fetch', (event) => {
               });
             }
             return response;
-          }).catch(() => {
-            if (event.request.destination === 'document') {
-              return caches.match('/');
-            }
           });
         });
       })
     );
+    return;
+  }
+
+  // Strony i dane API: najpierw sieć (przeglądarka rewaliduje je ETagiem). Offline
+  // zapamiętywane są tylko strony; dane użytkownika (/api/*, statystyki) nie trafiają do cache
+  event.respondWith(
+    caches.open(RUNTIME).then(cache => {
+      return fetch(event.request).then(response => {
+        if (event.request.method === 'GET' && event.request.destination === 'document' && response.status === 200) {
+          return cache.put(event.request, response.clone()).then(() => {
+            return response;
+          });
+        }
+        return response;
+      }).catch(() => {
+        return caches.match(event.request).then(cachedResponse => {
+          if (cachedResponse) {
+            return cachedResponse;
+          }
+          if (event.request.destination === 'document') {
+            return caches.match('/');
+          }
+        });
+      });
+    })
+  );
+});
+
+self.addEventListener('sync', (event) => {
+  if (event.tag === KOLEJKA_SYNC) {
+    event.waitUntil(wyslijKolejke());
   }
 });
 
@@ -61,4 +134,8 @@ self.addEventListener("message", (event) => {
   if (event.data && event.data.type === "SKIP_WAITING") {
     self.skipWaiting();
   }
+  // Przeglądarki bez Background Sync: strona prosi o wysyłkę po odzyskaniu sieci
+  if (event.data && event.data.type === "WYSLIJ_KOLEJKE") {
+    event.waitUntil(wyslijKolejke().catch(error => console.log('Kolejka kursów:', error)));
+  }
 });
@@ -0,0 +1,30 @@
+// Składanie wykresów Plotly z odpowiedzi kompaktowych (?wykresy=kompakt).
+// Style śladów, układy i szablon są w UKLADY_WYKRESOW (/wykresy/uklady.js),
+// wczytywanym raz i trzymanym w cache przeglądarki i service workera.
+
+function kopiaWykresu(obiekt) {
+    return JSON.parse(JSON.stringify(obiekt));
+}
+
+function scalWykres(styl, dane) {
+    const wynik = Object.assign({}, styl);
+    for (const [klucz, wartosc] of Object.entries(dane)) {
+        const obiekt = wartosc && typeof wartosc === 'object' && !Array.isArray(wartosc);
+        const obiektStylu = wynik[klucz] && typeof wynik[klucz] === 'object' && !Array.isArray(wynik[klucz]);
+        wynik[klucz] = obiekt && obiektStylu ? scalWykres(wynik[klucz], wartosc) : wartosc;
+    }
+    return wynik;
+}
+
+function rysujWykres(elementId, wykres) {
+    // Pełny wykres Plotly (data + layout) rysujemy bez zmian
+    if (!wykres.typ) {
+        return Plotly.newPlot(elementId, wykres.data, wykres.layout);
+    }
+    
+    const definicja = UKLADY_WYKRESOW.wykresy[wykres.typ];
+    const slady = definicja.slady.map((styl, i) => scalWykres(kopiaWykresu(styl), wykres.dane[i] || {}));
+    const uklad = kopiaWykresu(definicja.uklad);
+    uklad.template = UKLADY_WYKRESOW.szablon;
+    return Plotly.newPlot(elementId, slady, uklad);
+}
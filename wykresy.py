@@ -0,0 +1,117 @@
+import copy
+import functools
+import hashlib
+import json
+
+
+# Skala RdYlGn rozwinięta tak, jak zapisuje ją Plotly (plotly.js nie zna jej nazwy)
+RDYLGN = [
+    [0.0, 'rgb(165,0,38)'], [0.1, 'rgb(215,48,39)'], [0.2, 'rgb(244,109,67)'],
+    [0.3, 'rgb(253,174,97)'], [0.4, 'rgb(254,224,139)'], [0.5, 'rgb(255,255,191)'],
+    [0.6, 'rgb(217,239,139)'], [0.7, 'rgb(166,217,106)'], [0.8, 'rgb(102,189,99)'],
+    [0.9, 'rgb(26,152,80)'], [1.0, 'rgb(0,104,55)']
+]
+
+
+def _uklad(tytul, os_x, os_y, wysokosc=400):
+    return {
+        "title": {"text": tytul},
+        "xaxis": {"title": {"text": os_x}},
+        "yaxis": {"title": {"text": os_y}},
+        "height": wysokosc
+    }
+
+
+# Identyfikator wykresu -> style śladów (bez danych) i układ bez szablonu
+WYKRESY = {
+    "stawka_w_czasie": {
+        "slady": [{"type": "scatter", "mode": "lines+markers", "name": "Stawka godzinowa",
+                   "line": {"color": "#667eea", "width": 3}, "marker": {"size": 8}}],
+        "uklad": _uklad('Stawka godzinowa w czasie', 'Data i czas', 'Stawka (zł/h)')
+    },
+    "zysk_kursow": {
+        "slady": [{"type": "bar", "name": "Zysk netto", "marker": {"color": "#10b981"}}],
+        "uklad": _uklad('Zysk netto z kursów', 'Data i czas', 'Zysk (zł)')
+    },
+    "stawka_wg_godzin": {
+        "slady": [{"type": "bar", "name": "Średnia stawka",
+                   "marker": {"colorscale": RDYLGN, "showscale": True}}],
+        "uklad": _uklad('Średnia stawka godzinowa według godzin dnia', 'Godzina', 'Średnia stawka (zł/h)')
+    },
+    "platformy_stawki": {
+        "slady": [{"type": "bar", "name": "Średnia stawka", "textposition": "auto",
+                   "marker": {"colorscale": RDYLGN, "showscale": True}}],
+        "uklad": _uklad('Średnia stawka godzinowa według platform', 'Platforma', 'Średnia stawka (zł/h)')
+    },
+    "platformy_zyski": {
+        "slady": [{"type": "bar", "name": "Suma zysków", "textposition": "auto",
+                   "marker": {"color": "#10b981"}}],
+        "uklad": _uklad('Suma zysków według platform', 'Platforma', 'Suma zysków (zł)')
+    },
+    "platformy_liczba": {
+        "slady": [{"type": "bar", "name": "Liczba kursów", "textposition": "auto",
+                   "marker": {"color": "#667eea"}}],
+        "uklad": _uklad('Liczba kursów według platform', 'Platforma', 'Liczba kursów')
+    },
+    "zarobki_dzienne": {
+        "slady": [{"type": "scatter", "mode": "lines+markers", "name": "Dzienny zysk",
+                   "line": {"color": "#667eea", "width": 2}},
+                  {"type": "scatter", "mode": "lines", "name": "Średnia",
+                   "line": {"color": "#10b981", "width": 2, "dash": "dash"}}],
+        "uklad": _uklad('Historia zarobków dziennych', 'Data', 'Zysk (zł)', 300)
+    },
+    "heatmapa_rentownosci": {
+        "slady": [{"type": "heatmap", "colorscale": RDYLGN, "hoverongaps": False,
+                   "hovertemplate": '%{y}<br>%{x}<br>Średni zysk: %{z:.2f} zł<extra></extra>'}],
+        "uklad": _uklad('Rentowność według dnia tygodnia i godziny', 'Godzina', 'Dzień tygodnia', 500)
+    },
+}
+
+
+@functools.lru_cache(maxsize=None)
+def szablon(nazwa='plotly_white'):
+    """Szablon Plotly jako zwykły słownik, przygotowywany raz na proces."""
+    import plotly.io as pio
+    import plotly.utils
+    return json.loads(json.dumps(pio.templates[nazwa], cls=plotly.utils.PlotlyJSONEncoder))
+
+
+def _scal(styl, dane):
+    wynik = dict(styl)
+    for klucz, wartosc in dane.items():
+        if isinstance(wartosc, dict) and isinstance(wynik.get(klucz), dict):
+            wynik[klucz] = _scal(wynik[klucz], wartosc)
+        else:
+            wynik[klucz] = wartosc
+    return wynik
+
+
+def wykres(typ, *dane):
+    """Pełny wykres Plotly (data + layout) jako zwykłe słowniki.
+
+    Każdy argument dane to kolumny jednego śladu (x, y, z, text, marker.color),
+    łączone ze stylem śladu z WYKRESY. Wynik trafia prosto do jsonify i jest
+    serializowany tylko raz, bez walidacji graph_objects.
+    """
+    definicja = WYKRESY[typ]
+    uklad = copy.deepcopy(definicja["uklad"])
+    uklad["template"] = szablon()
+    return {"data": [_scal(styl, kolumny) for styl, kolumny in zip(definicja["slady"], dane)],
+            "layout": uklad}
+
+
+def wykres_kompaktowy(typ, *dane):
+    """Same kolumny danych i identyfikator wykresu; resztę składa przeglądarka (static/wykresy.js)."""
+    return {"typ": typ, "dane": list(dane)}
+
+
+@functools.lru_cache(maxsize=None)
+def uklady_json():
+    """Style śladów, układy i szablon wszystkich wykresów jako JSON."""
+    return json.dumps({"szablon": szablon(), "wykresy": WYKRESY}, ensure_ascii=False, sort_keys=True)
+
+
+@functools.lru_cache(maxsize=None)
+def wersja_ukladow():
+    """Skrót treści układów; zmienia adres pliku z układami po każdej zmianie."""
+    return hashlib.sha1(uklady_json().encode("utf-8")).hexdigest()[:12]